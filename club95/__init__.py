@@ -1,4 +1,5 @@
 # import flask - from 'package' import 'Class'
+import click
 from datetime import datetime, timedelta
 from flask import Flask, app, render_template 
 from flask_bootstrap import Bootstrap5
@@ -6,6 +7,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from pathlib import Path
 from sqlalchemy import func
+from sqlalchemy.engine import make_url
 from werkzeug.exceptions import HTTPException, InternalServerError
 from urllib.parse import quote_plus
 
@@ -17,8 +19,11 @@ db = SQLAlchemy()
 
 # create a function that creates a web application
 # a web server will run this web application
-def create_app():
+def create_app(test_config=None):
    app = Flask(__name__)  # this is the name of the module/package that is calling this app
+   # enforces the upload size limits below while request bodies are parsed
+   from .uploads import UploadRequest
+   app.request_class = UploadRequest
    # Should be set to false in a production environment
    app.debug = False
    app.secret_key = 'group_49'
@@ -52,13 +57,89 @@ def create_app():
    # set the app configuration data - where the db is located "provider://location.name"
    database_path = Path(app.instance_path) / DATABASE_FILENAME
    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{database_path.as_posix()}"
+   # SQLite allows one writer at a time; wait this many seconds for the lock instead of
+   # failing straight away with "database is locked" when purchases arrive together
+   app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+
+   # number of cards per page on the paginated listings (browse, search, My Events, My Tickets)
+   app.config['PAGE_SIZE'] = 12
+   # upper bound for the ?per_page= override
+   app.config['MAX_PAGE_SIZE'] = 48
+   # how long the home page "upcoming events" carousel may be served from cache
+   app.config['UPCOMING_CACHE_SECONDS'] = 300
+   # apply pending schema migrations when the app is created; off by default so several
+   # workers starting together don't all migrate at once - run `flask db-upgrade` instead
+   app.config['MIGRATE_ON_STARTUP'] = False
+   # rows per transaction for migration backfills
+   app.config['MIGRATION_BATCH_SIZE'] = 500
+   # minutes a checkout reservation holds its tickets before they go back on sale
+   app.config['HOLD_MINUTES'] = 10
+   # seconds between background sweeps that release expired holds (0 turns the sweeper off)
+   app.config['HOLD_SWEEP_SECONDS'] = 60
+   # waiting room for queue-enabled events: buyers let through per minute, and how many
+   # may go straight in when nobody is waiting
+   app.config['QUEUE_ADMISSIONS_PER_MINUTE'] = 120
+   app.config['QUEUE_BURST'] = 20
+   # how long an admitted buyer may browse and buy before having to queue again
+   app.config['QUEUE_PASS_MINUTES'] = 15
+   # how often the queue page asks for an updated position
+   app.config['QUEUE_POLL_SECONDS'] = 5
+   # how long purchase idempotency keys are remembered, and how often old ones are purged
+   app.config['IDEMPOTENCY_KEY_HOURS'] = 24
+   app.config['IDEMPOTENCY_PURGE_SECONDS'] = 3600
+   # seconds between background sweeps that close past events and flip SOLD OUT/OPEN
+   # (0 turns the sweeper off; run `flask sweep-statuses` from cron instead)
+   app.config['STATUS_SWEEP_SECONDS'] = 60
+   # seconds between keep-alive comments on the live availability stream, and how long
+   # one stream stays open before the browser is told to reconnect
+   app.config['LIVE_KEEPALIVE_SECONDS'] = 15
+   app.config['LIVE_STREAM_SECONDS'] = 60
+   # widths of the resized copies made of uploaded images (needs Pillow), their
+   # WebP/JPEG quality, and how many background threads make them
+   app.config['IMAGE_WIDTHS'] = (320, 640, 1280)
+   app.config['IMAGE_QUALITY'] = 80
+   app.config['IMAGE_WORKERS'] = 2
+   # upload limits: the whole request (refused up front from its Content-Length), each file
+   # (refused as soon as it passes the limit), and how much of each file is buffered in
+   # memory before it spills to a temporary file
+   app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
+   app.config['MAX_UPLOAD_FILE_BYTES'] = 8 * 1024 * 1024
+   app.config['UPLOAD_SPOOL_BYTES'] = 64 * 1024
+   # fingerprint and precompress club95/static into static/dist when the app is created;
+   # off by default so workers don't rebuild and prune it at once - run `flask build-assets`
+   # once per deploy instead (startup just loads the manifest it writes)
+   app.config['BUILD_ASSETS_ON_STARTUP'] = False
+   # `flask gc-media` leaves unreferenced uploads alone until they are this old, and
+   # moves them here instead of deleting them unless --delete is given
+   app.config['MEDIA_GC_GRACE_HOURS'] = 24
+   app.config['MEDIA_QUARANTINE_DIR'] = str(Path(app.instance_path) / 'media-quarantine')
+   # removing a ticket tier with more buyers than this refunds them in a background job,
+   # REFUND_BATCH_SIZE orders per transaction, checked every REFUND_JOB_SECONDS
+   app.config['REFUND_INLINE_ORDERS'] = 200
+   app.config['REFUND_BATCH_SIZE'] = 500
+   app.config['REFUND_JOB_SECONDS'] = 5
+   # events imported per transaction by `flask import-events` and the import page
+   app.config['IMPORT_CHUNK_SIZE'] = 200
+   # rows fetched from the database per batch while a sales export is streamed
+   app.config['EXPORT_BATCH_SIZE'] = 1000
+   # run the periodic jobs below (hold sweep, status sweep, key purge, refunds) in this
+   # process; None means on, except under TESTING. Turn it off in every web worker and
+   # run `flask run-jobs` once when serving with several worker processes
+   app.config['RUN_BACKGROUND_JOBS'] = None
+
+   # any of the settings above can be overridden with FLASK_-prefixed environment variables,
+   # e.g. FLASK_PAGE_SIZE=24 or FLASK_MIGRATE_ON_STARTUP=true
+   app.config.from_prefixed_env()
+   # tests pass their own settings (e.g. a temporary database) on top of everything else
+   if test_config:
+      app.config.update(test_config)
+   if app.config['RUN_BACKGROUND_JOBS'] is None:
+      app.config['RUN_BACKGROUND_JOBS'] = not app.testing
 
    # initialise db with flask app
    db.init_app(app)
 
    Bootstrap5(app)
-
-   db.Model.metadata.clear()
    
    # initialise the login manager
    login_manager = LoginManager()
@@ -93,8 +174,151 @@ def create_app():
    from .auth import auth_bp
    app.register_blueprint(auth_bp)
 
+   # fingerprinted static files, served from /assets/ with long-lived caching
+   from .assets import build_assets, init_assets
+   init_assets(app)
+   if app.config['BUILD_ASSETS_ON_STARTUP']:
+      build_assets(app)
+
+   # `flask build-assets` fingerprints and precompresses the static files
+   @app.cli.command('build-assets')
+   def build_assets_command():
+      manifest = build_assets(app)
+      click.echo(f"Fingerprinted {len(manifest)} static files.")
+
    # checks for and then creates database
    _ensure_database(app)
+
+   from .search import rebuild_search_index
+
+   # `flask db-upgrade` applies pending schema migrations to an existing database
+   @app.cli.command('db-upgrade')
+   @click.option('--batch-size', type=int, default=None, help='Rows per transaction for backfills.')
+   def db_upgrade_command(batch_size):
+      from .migrations import current_version, upgrade_database
+      applied = upgrade_database(batch_size=batch_size, echo=click.echo)
+      if not applied:
+         click.echo("Database is already up to date.")
+      click.echo(f"Schema version: {current_version()}")
+
+   # `flask search-reindex` rebuilds the search index from the events table
+   @app.cli.command('search-reindex')
+   def search_reindex_command():
+      indexed = rebuild_search_index()
+      db.session.commit()
+      click.echo(f"Indexed {indexed} events.")
+
+   from .reservations import release_expired_holds
+   from .scheduler import run_jobs, start_jobs_with_first_request
+
+   # (name, seconds between runs, job) for every periodic job; 0 seconds turns one off
+   background_jobs = []
+
+   # `flask release-holds` puts expired checkout reservations back on sale
+   @app.cli.command('release-holds')
+   def release_holds_command():
+      released = release_expired_holds()
+      click.echo(f"Released {released} expired holds.")
+
+   # release expired holds in the background while the app is running
+   background_jobs.append(('release-holds', app.config['HOLD_SWEEP_SECONDS'], release_expired_holds))
+
+   from .idempotency import purge_idempotency_keys
+
+   # `flask purge-idempotency-keys` deletes purchase idempotency keys past their TTL
+   @app.cli.command('purge-idempotency-keys')
+   @click.option('--batch-size', type=int, default=None, help='Rows deleted per transaction.')
+   def purge_idempotency_keys_command(batch_size):
+      purged = purge_idempotency_keys(batch_size)
+      click.echo(f"Purged {purged} idempotency keys.")
+
+   background_jobs.append(('purge-idempotency-keys', app.config['IDEMPOTENCY_PURGE_SECONDS'], purge_idempotency_keys))
+
+   from .events import sweep_event_statuses
+
+   # `flask sweep-statuses` brings every event's status up to date
+   @app.cli.command('sweep-statuses')
+   def sweep_statuses_command():
+      changed = sweep_event_statuses()
+      click.echo(f"Updated the status of {changed} events.")
+
+   background_jobs.append(('sweep-statuses', app.config['STATUS_SWEEP_SECONDS'], sweep_event_statuses))
+
+   from .refunds import process_refund_jobs
+
+   # `flask process-refunds` runs any pending refund jobs for removed ticket tiers
+   @app.cli.command('process-refunds')
+   @click.option('--batch-size', type=int, default=None, help='Orders refunded per transaction.')
+   def process_refunds_command(batch_size):
+      refunded = process_refund_jobs(batch_size)
+      click.echo(f"Refunded {refunded} orders.")
+
+   background_jobs.append(('process-refunds', app.config['REFUND_JOB_SECONDS'], process_refund_jobs))
+
+   # `flask run-jobs` runs the periodic jobs in the foreground, for deployments that
+   # turn them off in the web workers (FLASK_RUN_BACKGROUND_JOBS=false)
+   @app.cli.command('run-jobs')
+   def run_jobs_command():
+      run_jobs(app, background_jobs, echo=click.echo)
+
+   # otherwise the process serving requests starts them with its first request, so
+   # other `flask` commands never do
+   if app.config['RUN_BACKGROUND_JOBS']:
+      start_jobs_with_first_request(app, background_jobs)
+
+   from .importer import FORMATS, detect_format, import_events
+
+   # `flask import-events events.csv --owner promoter@example.com` bulk-loads events from CSV or NDJSON
+   @app.cli.command('import-events')
+   @click.argument('source', type=click.File('rb'))
+   @click.option('--owner', required=True, help='Email of the user the events are created for.')
+   @click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None, help='Defaults to the file extension.')
+   @click.option('--chunk-size', type=int, default=None, help='Events inserted per transaction.')
+   def import_events_command(source, owner, fmt, chunk_size):
+      fmt = fmt or detect_format(source.name)
+      if not fmt:
+         raise click.UsageError("Can't tell the format from the file name; pass --format.")
+      user = User.query.filter_by(email=owner).first()
+      if not user:
+         raise click.UsageError(f"No user with email {owner}.")
+      report = import_events(source, fmt, user.id, chunk_size, max_errors=1000)
+      for line_number, message in report['errors']:
+         click.echo(f"Line {line_number}: {message}")
+      hidden = report['failed'] - len(report['errors'])
+      if hidden > 0:
+         click.echo(f"... and {hidden} more errors.")
+      click.echo(f"Read {report['rows']} rows: imported {report['created']} events, {report['failed']} rows failed.")
+
+   from .images import Image, derive_missing, image_srcset
+
+   # `flask derive-images` makes resized copies of uploads that don't have them yet
+   # (e.g. images uploaded before the pipeline existed, or while Pillow was missing)
+   @app.cli.command('derive-images')
+   @click.option('--batch-size', type=int, default=100, help='Images processed per transaction.')
+   def derive_images_command(batch_size):
+      if Image is None:
+         click.echo("Pillow is not installed; nothing to do.")
+         return
+      processed = derive_missing(batch_size)
+      click.echo(f"Processed {processed} images.")
+
+   from .media import collect_orphans
+
+   # `flask gc-media` removes uploaded files that no event or user refers to any more
+   @app.cli.command('gc-media')
+   @click.option('--dry-run', is_flag=True, help='Report orphaned files without touching them.')
+   @click.option('--delete', is_flag=True, help='Delete orphans instead of moving them to the quarantine folder.')
+   @click.option('--grace-hours', type=float, default=None, help='Skip files modified more recently than this.')
+   @click.option('--batch-size', type=int, default=500, help='Files checked against the database per query.')
+   def gc_media_command(dry_run, delete, grace_hours, batch_size):
+      quarantine_dir = None if delete else app.config['MEDIA_QUARANTINE_DIR']
+      report = collect_orphans(grace_hours, batch_size, dry_run, quarantine_dir, echo=click.echo)
+      action = 'Would remove' if dry_run else 'Removed' if delete else 'Quarantined'
+      click.echo(
+         f"Scanned {report['scanned']} files: {report['referenced']} in use, "
+         f"{report['recent']} inside the grace period. "
+         f"{action} {report['orphaned']} orphans ({report['bytes'] / (1024 * 1024):.1f} MB)."
+      )
    
  # -------------------------------------------------------------
    # Context Processor for Dynamic Filter Options
@@ -112,6 +336,14 @@ def create_app():
    # Reference: https://flask.palletsprojects.com/en/3.0.x/templating/#context-processors
    # -------------------------------------------------------------
 
+   # Event start/end times are TIME columns; show them as HH:MM like the forms do
+   @app.template_filter('hhmm')
+   def format_hhmm(value):
+      return value.strftime('%H:%M') if hasattr(value, 'strftime') else (value or '')
+
+   # srcset for the resized copies of an uploaded image (see partials/images.html)
+   app.add_template_global(image_srcset)
+
    from .models import Genre, EventType  # import models used to fetch data
 
    @app.context_processor
@@ -139,13 +371,56 @@ def create_app():
 
 def _ensure_database(app: Flask) -> None:
    # Create the SQLite database on first launch if it doesn't exist.
-   database_path = Path(app.instance_path) / DATABASE_FILENAME
+   from .migrations import missing_tables, pending_migrations, stamp_latest_version, upgrade_database
+
+   database_path = Path(make_url(app.config['SQLALCHEMY_DATABASE_URI']).database)
    if database_path.exists():
+      # databases created by older versions of the app are upgraded with `flask db-upgrade`,
+      # once per deploy; a single-process dev server can opt in with FLASK_MIGRATE_ON_STARTUP=true
+      with app.app_context():
+         # new tables don't always come with a numbered migration, so look for those too
+         if not pending_migrations() and not missing_tables():
+            return
+         if app.config.get('MIGRATE_ON_STARTUP'):
+            upgrade_database()
+            return
+      app.logger.error("Database schema is out of date; pages return 503 until `flask db-upgrade` is run.")
+      _serve_maintenance_until_upgraded(app)
       return
 
    with app.app_context():
       db.create_all()
+      stamp_latest_version()
       populate_database(app)
+      # the FTS table isn't a model, so create_all() doesn't build it
+      from .search import ensure_search_index
+      ensure_search_index()
+      # resized copies of the sample images are made in the background, like uploads
+      from .images import queue_missing
+      queue_missing()
+      db.session.commit()
+
+def _serve_maintenance_until_upgraded(app: Flask) -> None:
+   # Answer every request with a 503 while the schema is behind the code, instead of
+   # letting each page fail on a missing column. The schema is looked at again on each
+   # request, so workers carry on by themselves once `flask db-upgrade` has run.
+   # The CLI doesn't go through here, so the upgrade itself still works.
+   from flask import request
+   from .migrations import missing_tables, pending_migrations
+
+   upgraded = False
+
+   @app.before_request
+   def maintenance_page():
+      nonlocal upgraded
+      if upgraded or request.endpoint == 'static':
+         return None
+      if not pending_migrations() and not missing_tables():
+         upgraded = True
+         return None
+      # plain text: the error template loads the current user, which may not work yet
+      message = "Club95 is down for maintenance while its database is upgraded. Please try again in a few minutes."
+      return message, 503, {'Content-Type': 'text/plain; charset=utf-8', 'Retry-After': '60'}
 
 # Populate db with sample events
 def populate_database(app: Flask) -> None:
@@ -164,6 +439,7 @@ def populate_database(app: Flask) -> None:
          Comment,
          Order,
          OrderTicket,
+         parse_event_time,
       )
 
       # Helper methods
@@ -379,7 +655,7 @@ def populate_database(app: Flask) -> None:
             "title": "DJ Spreadsheet Live",
             "type": "DJ Set",
             "status": "CANCELLED",
-            "date": (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d"),
+            "date": (datetime.now() + timedelta(days=30)).date(),
             "description": "Watch DJ Spreadsheet seamlessly mix quarterly reports into smooth beats. Free Wi-Fi included.",
             "start_time": "09:00",
             "end_time": "17:00",
@@ -396,7 +672,7 @@ def populate_database(app: Flask) -> None:
             "title": "Crescent City Players",
             "type": "Live Concert",
             "status": "OPEN",
-            "date": (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d"),
+            "date": (datetime.now() + timedelta(days=30)).date(),
             "description": 
                "An intimate evening of smooth jazz and improvisation, featuring local hit talent, " + 
                "Crescent City Players, joined by The Walters and Mojo Webb. Enjoy classic standards and modern tunes " + 
@@ -420,7 +696,7 @@ def populate_database(app: Flask) -> None:
             "title": "Moonlight Resonance",
             "type": "Orchestra",
             "status": "OPEN",
-            "date": (datetime.now() + timedelta(days=15)).strftime("%Y-%m-%d"),
+            "date": (datetime.now() + timedelta(days=15)).date(),
             "description": 
                "A riverside orchestral showcase blending timeless symphonies " +
                "with modern composition.",
@@ -439,7 +715,7 @@ def populate_database(app: Flask) -> None:
             "title": "The Overwhelming Festival",
             "type": "Music Festival",
             "status": "OPEN",
-            "date": (datetime.now() + timedelta(days=10)).strftime("%Y-%m-%d"),
+            "date": (datetime.now() + timedelta(days=10)).date(),
             "description": 
                "Three stages, 600 bands, 30 taco trucks, 1 working portaloo. " +
                "An afternoon to remember (or forget).",
@@ -459,7 +735,7 @@ def populate_database(app: Flask) -> None:
             "title": "Optimistic Yeti: Doom Jazz",
             "type": "Solo Artist Performance",
             "status": "SOLD OUT",
-            "date": (datetime.now() + timedelta(days=5)).strftime("%Y-%m-%d"),
+            "date": (datetime.now() + timedelta(days=5)).date(),
             "description": 
                "The elusive Optimistic Yeti descends from the Blue Mountains once a year to " +
                "perform a doom jazz set that critics describe as \"The kind of music you hear " +
@@ -479,7 +755,7 @@ def populate_database(app: Flask) -> None:
             "title": "Sydney Indie Nights: Local Showcase",
             "type": "Live Concert",
             "status": "INACTIVE",
-            "date": (datetime.now() + timedelta(days=3)).strftime("%Y-%m-%d"),
+            "date": (datetime.now() + timedelta(days=3)).date(),
             "description": "A lineup of Sydney's top emerging indie and alternative bands, " +
             "offerning an energetic night of original music and live performances.",
             "start_time": "20:00",
@@ -512,10 +788,11 @@ def populate_database(app: Flask) -> None:
             event = Event(
                title=seed["title"],
                status=seed["status"],
+               cancelled=seed["status"] == "CANCELLED",
                date=seed["date"],
                description=seed["description"],
-               start_time=seed["start_time"],
-               end_time=seed["end_time"],
+               start_time=parse_event_time(seed["start_time"]),
+               end_time=parse_event_time(seed["end_time"]),
                image=seed["image"],
                user=user,
                venue=venue,
@@ -550,6 +827,7 @@ def populate_database(app: Flask) -> None:
                      event=event
                   )
                   db.session.add(comment)
+               event.comment_count = len(sample_comments)
 
          else:
             # ? This block could be changed to fill in missing data for seeded events
@@ -0,0 +1,254 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import tempfile
+
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip copies are always written
+    brotli = None
+
+# Fingerprinted, precompressed copies of the files in club95/static.
+#
+# build_assets() copies every static file to static/dist/ under a name containing a
+# hash of its contents (styles/base.css -> styles/base.1a2b3c4d5e6f.css), writes
+# .gz (and, with the brotli package, .br) copies of the text formats next to them,
+# and records the mapping in static/dist/manifest.json. References between
+# stylesheets (@import, url()) are rewritten to the fingerprinted names, so a
+# change to base.css also changes the name of styles.css that imports it.
+#
+# Images stay out of dist: they are large, already compressed and rarely change,
+# so they keep being served from /static. A rebuild only reads the files whose
+# size or modification time changed since the last one (stylesheets are always
+# re-read, since their names depend on what they import), and deletes built files
+# that neither the new manifest nor the one before it names, so pages rendered just
+# before a deploy can still load theirs.
+#
+# Templates keep calling url_for('static', filename=...); the url_for installed by
+# init_assets() swaps in /assets/<fingerprinted name> whenever the manifest has the
+# file. Those URLs change whenever the content does, so they are served with a
+# year-long `immutable` Cache-Control and browsers never revalidate them. Files not
+# in the manifest (uploads, or everything when it hasn't been built) use the plain
+# static URL as before.
+
+ASSET_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+# size and mtime of each source at the last build, so unchanged files aren't re-read
+SOURCES_NAME = 'sources.json'
+
+# the build output, and images (uploads, derived copies and the site's own pictures)
+_EXCLUDED_DIRS = {ASSET_DIR, 'img'}
+
+# formats worth compressing (images and woff/woff2 fonts are compressed already)
+_COMPRESSIBLE = {'.css', '.js', '.svg', '.txt', '.json', '.otf', '.ttf', '.map'}
+_MIN_COMPRESS_BYTES = 256
+
+_ONE_YEAR = 365 * 24 * 3600
+
+_CSS_REFERENCE = re.compile(r'''(@import\s+|url\(\s*)(["']?)([^"')\s]+)\2''')
+
+
+def _asset_root(app) -> str:
+    return os.path.join(app.static_folder, ASSET_DIR)
+
+
+def _source_files(static_folder: str) -> list:
+    # Every static file as a posix path relative to static/, skipping excluded folders.
+    found = []
+    for directory, subdirectories, filenames in os.walk(static_folder):
+        relative_dir = os.path.relpath(directory, static_folder).replace(os.sep, '/')
+        relative_dir = '' if relative_dir == '.' else relative_dir
+        subdirectories[:] = sorted(
+            name for name in subdirectories
+            if not name.startswith('.') and posixpath.join(relative_dir, name) not in _EXCLUDED_DIRS
+        )
+        for filename in filenames:
+            if not filename.startswith('.'):
+                found.append(posixpath.join(relative_dir, filename))
+    return sorted(found)
+
+
+def _write_atomically(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.build-')
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            out.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def _emit(root: str, source: str, data: bytes) -> str:
+    # Write one fingerprinted file (plus compressed copies) and return its name.
+    stem, extension = posixpath.splitext(source)
+    name = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+    path = os.path.join(root, *name.split('/'))
+    # same name means same content, so files from an earlier build are reused
+    if not os.path.exists(path):
+        if extension.lower() in _COMPRESSIBLE and len(data) >= _MIN_COMPRESS_BYTES:
+            compressed = [('.gz', gzip.compress(data, 9, mtime=0))]
+            if brotli is not None:
+                compressed.append(('.br', brotli.compress(data)))
+            for suffix, payload in compressed:
+                if len(payload) < len(data):
+                    _write_atomically(path + suffix, payload)
+        # the uncompressed file goes last: its presence marks the set as complete
+        _write_atomically(path, data)
+    return name
+
+
+def _read_json(path: str) -> dict:
+    try:
+        with open(path, encoding='utf-8') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def _prune(root: str, keep: set) -> int:
+    # Delete built files (and their compressed copies) not named in `keep`.
+    removed = 0
+    for directory, _, filenames in os.walk(root, topdown=False):
+        relative_dir = os.path.relpath(directory, root).replace(os.sep, '/')
+        relative_dir = '' if relative_dir == '.' else relative_dir
+        for filename in filenames:
+            name = posixpath.join(relative_dir, filename)
+            # dotfiles are another build's temporary files
+            if filename.startswith('.') or name in (MANIFEST_NAME, SOURCES_NAME):
+                continue
+            if name.endswith(('.gz', '.br')) and name[:-3] in keep:
+                continue
+            if name not in keep:
+                os.remove(os.path.join(directory, filename))
+                removed += 1
+        if directory != root and not os.listdir(directory):
+            os.rmdir(directory)
+    return removed
+
+
+def _rewrite_css(source: str, text: str, resolve, unversioned) -> str:
+    # Point @import / url() references at the fingerprinted names, or at /static for
+    # files left out of the build.
+    base = posixpath.dirname(source)
+
+    def replace(match):
+        prefix, quote, target = match.groups()
+        if target.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        path, _, fragment = target.partition('#')
+        path, _, query = path.partition('?')
+        target_source = posixpath.normpath(posixpath.join(base, path))
+        suffix = (f"?{query}" if query else '') + (f"#{fragment}" if fragment else '')
+        fingerprinted = resolve(target_source)
+        if not fingerprinted:
+            # the stylesheet is served from /assets, so a relative reference to a file
+            # that isn't there (e.g. an image) has to point back at /static
+            url = unversioned(target_source)
+            return f"{prefix}{quote}{url}{suffix}{quote}" if url else match.group(0)
+        relative = posixpath.relpath(fingerprinted, base)
+        return f"{prefix}{quote}{relative}{suffix}{quote}"
+
+    return _CSS_REFERENCE.sub(replace, text)
+
+
+def build_assets(app) -> dict:
+    # Fingerprint and precompress static/ into static/dist and write the manifest.
+    root = _asset_root(app)
+    sources = _source_files(app.static_folder)
+    known = set(sources)
+    previous = _read_json(os.path.join(root, MANIFEST_NAME))
+    last_seen = _read_json(os.path.join(root, SOURCES_NAME))
+    manifest = {}
+    seen = {}
+    resolving = set()
+
+    def source_path(source):
+        return os.path.join(app.static_folder, *source.split('/'))
+
+    def unversioned(source):
+        return f"{app.static_url_path}/{source}" if os.path.isfile(source_path(source)) else None
+
+    def resolve(source):
+        if source not in known:
+            return None
+        if source not in manifest:
+            if source in resolving:
+                # circular @import; leave the reference unversioned
+                return None
+            resolving.add(source)
+            stat = os.stat(source_path(source))
+            seen[source] = [stat.st_size, stat.st_mtime_ns]
+            cached = last_seen.get(source)
+            if (
+                not source.endswith('.css') and cached and cached[:2] == seen[source]
+                and os.path.isfile(os.path.join(root, *cached[2].split('/')))
+            ):
+                manifest[source] = cached[2]
+            else:
+                with open(source_path(source), 'rb') as handle:
+                    data = handle.read()
+                if source.endswith('.css'):
+                    text = _rewrite_css(source, data.decode('utf-8'), resolve, unversioned)
+                    data = text.encode('utf-8')
+                manifest[source] = _emit(root, source, data)
+            seen[source].append(manifest[source])
+            resolving.discard(source)
+        return manifest[source]
+
+    for source in sources:
+        resolve(source)
+
+    _write_atomically(os.path.join(root, MANIFEST_NAME), json.dumps(manifest, indent=1, sort_keys=True).encode())
+    _write_atomically(os.path.join(root, SOURCES_NAME), json.dumps(seen, indent=1, sort_keys=True).encode())
+    _prune(root, set(manifest.values()) | set(previous.values()))
+    app.extensions['club95_assets'] = manifest
+    return manifest
+
+
+def load_manifest(app) -> dict:
+    manifest = _read_json(os.path.join(_asset_root(app), MANIFEST_NAME))
+    app.extensions['club95_assets'] = manifest
+    return manifest
+
+
+def asset_url_for(endpoint, **values):
+    # url_for for templates: static files with a fingerprinted copy get its /assets/ URL.
+    if endpoint == 'static':
+        fingerprinted = current_app.extensions.get('club95_assets', {}).get(values.get('filename'))
+        if fingerprinted:
+            values['filename'] = fingerprinted
+            return url_for('assets', **values)
+    return url_for(endpoint, **values)
+
+
+def serve_asset(filename):
+    # Serve a fingerprinted file, precompressed when the browser accepts it.
+    root = _asset_root(current_app)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in request.accept_encodings and os.path.isfile(os.path.join(root, *f"{filename}{suffix}".split('/'))):
+            response = send_from_directory(root, filename + suffix, mimetype=mimetype, max_age=_ONE_YEAR)
+            response.content_encoding = encoding
+            break
+    if response is None:
+        response = send_from_directory(root, filename, mimetype=mimetype, max_age=_ONE_YEAR)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def init_assets(app) -> None:
+    # Route for the fingerprinted files and the url_for that points templates at them.
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve_asset)
+    app.jinja_env.globals['url_for'] = asset_url_for
+    load_manifest(app)
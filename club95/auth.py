@@ -1,8 +1,8 @@
-import os
-
 from flask import Blueprint, render_template, redirect, url_for, request, flash
 from .form import LoginForm, RegisterForm
 from .models import User
+from .images import queue_derivatives
+from .media import save_media
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from flask_login import login_user, logout_user
@@ -29,21 +29,17 @@ def register():
         streetAddress = form.streetAddress.data
         bio = form.bio.data
         profile_picture_file = form.profilePicture.data
-        profile_picture_path = None
-        if profile_picture_file and getattr(profile_picture_file, 'filename', ''):
-            filename = secure_filename(profile_picture_file.filename)
-            if filename:
-                upload_dir = os.path.join('club95', 'static', 'img')
-                os.makedirs(upload_dir, exist_ok=True)
-                save_path = os.path.join(upload_dir, filename)
-                profile_picture_file.save(save_path)
-                profile_picture_path = os.path.join('img', filename).replace('\\', '/')
 
         # DOES the user already exists
         user = User.query.filter_by(email=email).first()
         if user:
             flash('Email address already exists', 'registration_email_error')
             return redirect(url_for('auth_bp.register'))
+
+        profile_picture_path = None
+        if profile_picture_file and getattr(profile_picture_file, 'filename', ''):
+            if secure_filename(profile_picture_file.filename):
+                profile_picture_path = f"img/{save_media(profile_picture_file)}"
         # create new user with hashed password and add to db
         new_user = User(
             email=email,
@@ -56,6 +52,7 @@ def register():
             profilePicture=profile_picture_path
         )
         db.session.add(new_user)
+        queue_derivatives('profile', profile_picture_path)
         db.session.commit()
 
         #return success and redirect to login page
@@ -0,0 +1,124 @@
+import time
+import zlib
+from datetime import date, datetime
+
+from flask import current_app, request, session
+from flask_login import current_user
+
+from . import db
+from .models import CatalogueRevision, Event
+
+# Revision counters and conditional GET for the event and listing pages.
+#
+# Every change to what an event page shows bumps that event's `revision` and
+# `updated_at`, and every change to anything the public listings show bumps the
+# single catalogue revision. Pages derive an ETag / Last-Modified from those
+# counters, so a browser refresh can be answered with 304 Not Modified after one
+# primary-key lookup, before the page's real queries run or its template renders.
+#
+# Rendered pages also depend on who is looking (navbar, owner controls) and carry
+# CSRF tokens that expire, so the validators include the viewer and a time bucket
+# of half the CSRF lifetime; responses are marked `Vary: Cookie`.
+
+_CATALOGUE_ROW_ID = 1
+
+
+def touch_events(*event_ids) -> None:
+    # Record that these events changed (and with them the catalogue). Caller commits.
+    now = datetime.now()
+    ids = [event_id for event_id in event_ids if event_id]
+    # open event pages are sent the new availability once this commits (see live.py)
+    db.session.info.setdefault('changed_events', set()).update(ids)
+    if ids:
+        db.session.execute(
+            db.update(Event)
+            .where(Event.id.in_(ids))
+            .values(revision=Event.revision + 1, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+    touch_catalogue(now)
+
+
+def touch_catalogue(now=None) -> None:
+    # Record a change that affects the public listings. Caller commits.
+    now = now or datetime.now()
+    updated = db.session.execute(
+        db.update(CatalogueRevision)
+        .where(CatalogueRevision.id == _CATALOGUE_ROW_ID)
+        .values(revision=CatalogueRevision.revision + 1, updated_at=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not updated:
+        db.session.add(CatalogueRevision(id=_CATALOGUE_ROW_ID, revision=1, updated_at=now))
+
+
+def catalogue_revision():
+    # (revision, updated_at) for the listings; (0, None) before anything has changed.
+    row = db.session.execute(
+        db.select(CatalogueRevision.revision, CatalogueRevision.updated_at)
+        .where(CatalogueRevision.id == _CATALOGUE_ROW_ID)
+    ).first()
+    return (row.revision, row.updated_at) if row else (0, None)
+
+
+def _viewer_key() -> str:
+    # Who the page was rendered for: anonymous, or a user (and their display name).
+    if not current_user.is_authenticated:
+        return 'anon'
+    name = f"{current_user.firstName or ''} {current_user.lastName or ''}"
+    return f"u{current_user.id}.{zlib.crc32(name.encode()):x}"
+
+
+def _bucket_start():
+    # Start of the current CSRF time bucket, as a datetime (None if tokens never expire).
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if not limit:
+        return None
+    period = max(1, limit // 2)
+    return datetime.fromtimestamp(int(time.time()) // period * period)
+
+
+def page_validators(scope: str, revision: int, updated_at):
+    # Build (etag, last_modified) for a page whose content follows `revision`.
+    # Returns (None, None) when the response must not be cached, e.g. while a
+    # flash message is waiting to be shown.
+    if session.get('_flashes'):
+        return None, None
+    today = date.today()
+    bucket = _bucket_start()
+    etag = f"{scope}-r{revision}-{today.isoformat()}-{_viewer_key()}"
+    # effective_status depends on the date, and embedded CSRF tokens on the bucket
+    candidates = [updated_at, datetime.combine(today, datetime.min.time())]
+    if bucket:
+        etag += f"-b{int(bucket.timestamp())}"
+        candidates.append(bucket)
+    last_modified = max(value for value in candidates if value)
+    return etag, last_modified
+
+
+def not_modified_response(etag, last_modified):
+    # A 304 response if the request's validators still match, otherwise None.
+    if not etag:
+        return None
+    if request.if_none_match:
+        matches = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        matches = since is not None and last_modified.replace(microsecond=0) <= since.replace(tzinfo=None)
+    if not matches:
+        return None
+    response = current_app.response_class(status=304)
+    return add_validators(response, etag, last_modified)
+
+
+def add_validators(response, etag, last_modified):
+    # Attach the ETag / Last-Modified headers (no-op when the page isn't cacheable).
+    response.vary.add('Cookie')
+    if not etag:
+        return response
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # browsers may keep the page but must check back with us before reusing it
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -1,28 +1,32 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, session, current_app, abort, make_response, stream_with_context
 from flask_login import current_user
-from sqlalchemy import func, or_
-from urllib.parse import quote_plus
+from sqlalchemy import func, or_, cast, String
+from sqlalchemy.orm import selectinload
 from itertools import zip_longest
 from club95 import db
-from club95.form import EventForm, AddGenreForm, TicketPurchaseForm, CommentForm
-from club95.home import _extract_price
-from .models import Event, Genre, Artist, Ticket, Order, OrderTicket, Comment, EventArtist, Venue, EventType, EventImage
-import os
+from club95.form import EventForm, AddGenreForm, TicketPurchaseForm, CommentForm, CheckoutForm, EventImportForm
+from club95.home import _extract_price, _paginate_keyset
+from club95.search import index_event
+from club95.reservations import hold_tickets, confirm_hold, cancel_hold
+from club95.refunds import remove_tier, refund_jobs_for, tiers_being_refunded
+from club95.exports import FORMATS as EXPORT_FORMATS, stream_sales
+from club95.importer import detect_format, import_events
+from club95.idempotency import request_idempotency_key, claim_idempotency_key, find_idempotency_key
+from club95.caching import touch_events, touch_catalogue, page_validators, not_modified_response, add_validators
+from club95.images import queue_derivatives
+from club95.media import save_media, release_media
+from club95.live import availability_snapshots, subscribe as live_subscribe, unsubscribe as live_unsubscribe
+from club95.waiting_room import has_admission, queue_position, estimated_wait_seconds
+from .models import Event, Genre, Artist, Ticket, Order, OrderTicket, Comment, EventArtist, Venue, EventType, EventImage, TicketHold
+from .models import parse_event_date, parse_event_time, build_map_embed_url
+import queue
+import time
 from werkzeug.utils import secure_filename
 from flask_login import current_user, login_required
-from datetime import datetime, date, timezone
+from datetime import datetime, date
 
 events_bp = Blueprint('events_bp', __name__, template_folder='templates')
 
-# helper to build Google Maps embed URL
-def _build_map_embed_url(address: str) -> str:
-    ## Return a Google Maps embed URL for a provided address string.
-    cleaned = (address or '').strip()
-    if not cleaned:
-        return ''
-    query = quote_plus(cleaned)
-    return f"https://www.google.com/maps?q={query}&output=embed"
-
 # Helper to get or create a Venue record
 def _get_or_create_venue(address: str):
     ## Fetch an existing venue or create a new one for the supplied address.
@@ -31,7 +35,7 @@ def _get_or_create_venue(address: str):
         return None
     # Check if the venue already exists
     venue = Venue.query.filter(func.lower(Venue.location) == cleaned.lower()).first()
-    embed_url = _build_map_embed_url(cleaned)
+    embed_url = build_map_embed_url(cleaned)
     # Create a new venue if not found
     if not venue:
         venue = Venue(location=cleaned, venueMap=embed_url)
@@ -49,34 +53,27 @@ def _save_event_media(event, file_storage_list):
     if not event or not file_storage_list:
         return
 
-    # set the save folder
-    media_folder = os.path.join('club95', 'static', 'img', 'event_media')
-    os.makedirs(media_folder, exist_ok=True)
-
     # Get the next order index for the event images
     current_max = db.session.query(func.max(EventImage.order_index)).filter_by(event_id=event.id).scalar()
     next_index = (current_max or 0) + 1
-    # Generate a timestamp for unique file naming, so we don't overwrite files
-    timestamp = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
     # Save each file
     for storage in file_storage_list:
         # Skip empty uploads
         if not storage or not storage.filename:
             continue
         # Secure the filename
-        safe_name = secure_filename(storage.filename)
-        if not safe_name:
+        if not secure_filename(storage.filename):
             continue
-        # Create a unique filename
-        unique_name = f"event_{event.id}_{timestamp}_{next_index}_{safe_name}"
-        destination = os.path.join(media_folder, unique_name)
-        storage.save(destination)
+        # Files are named by their content, so identical uploads are stored once
+        stored_name = save_media(storage)
 
         db.session.add(EventImage(
             event_id=event.id,
-            filename=f"event_media/{unique_name}",
+            filename=stored_name,
             order_index=next_index
         ))
+        # resized copies are made in the background once this commits
+        queue_derivatives('media', stored_name)
         # Increment the order index for the next file
         next_index += 1
 
@@ -87,13 +84,7 @@ def _sync_event_status(event: Event) -> None:
         return
 
     today = date.today()
-
-    event_date = None
-    if event.date:
-        try:
-            event_date = datetime.strptime(event.date, "%Y-%m-%d").date()
-        except (TypeError, ValueError):
-            event_date = None
+    event_date = event.date
 
     current_status = (event.status or '').strip().upper()
 
@@ -113,26 +104,101 @@ def _sync_event_status(event: Event) -> None:
     elif current_status == 'SOLD OUT':
         event.status = 'OPEN'
 
+
+def sweep_event_statuses(today = None) -> int:
+    # Apply the _sync_event_status rules to every event at once, so page views never
+    # have to write: three set-based UPDATEs run in one short transaction by the
+    # background sweeper or `flask sweep-statuses`. Returns the number of events changed.
+    today = today or date.today()
+    status = func.upper(func.trim(Event.status))
+    remaining = (
+        db.select(func.coalesce(func.sum(func.max(Ticket.availability, 0)), 0))
+        .where(Ticket.event_id == Event.id)
+        .scalar_subquery()
+    )
+    upcoming = db.and_(Event.date >= today, status != 'CANCELLED')
+
+    statements = [
+        # past events are closed
+        db.update(Event)
+        .where(Event.date < today, status != 'INACTIVE')
+        .values(status = 'INACTIVE'),
+        # upcoming events with nothing left to sell
+        db.update(Event)
+        .where(upcoming, status != 'SOLD OUT', remaining <= 0)
+        .values(status = 'SOLD OUT'),
+        # sold out events that have tickets again (released holds, refunds, new tiers)
+        db.update(Event)
+        .where(upcoming, status == 'SOLD OUT', remaining > 0)
+        .values(status = 'OPEN'),
+    ]
+    changed = 0
+    for statement in statements:
+        changed += db.session.execute(statement.execution_options(synchronize_session = False)).rowcount
+    # bulk UPDATEs skip the attribute listeners that normally refresh the carousel, so
+    # move the catalogue revision on; every worker's carousel cache checks it
+    if changed:
+        touch_catalogue()
+    db.session.commit()
+    return changed
+
+def _comments_page(event_id: int):
+    # One page of an event's comments, newest first. Pages by (commentDateTime, id)
+    # along the ix_comments_event_id_commentDateTime index, so "load more" stays cheap
+    # however many comments the event has.
+    query = (
+        db.select(Comment)
+        .where(Comment.event_id == event_id)
+        .options(selectinload(Comment.user))
+    )
+    return _paginate_keyset(query, [Comment.commentDateTime, Comment.id], descending=True)
+
 # Event details page
 @events_bp.route('/events/eventdetails/<int:event_id>', methods=['GET'])
 def eventdetails(event_id):
-    event = Event.query.get_or_404(event_id)
-    original_status = event.status
-    _sync_event_status(event)
-    if event.status != original_status:
-        db.session.commit()
+    # Cheap primary-key lookup first: enough to apply the waiting room and to answer
+    # a conditional GET with 304 before anything else is queried or rendered
+    summary = db.session.execute(
+        db.select(Event.id, Event.queue_enabled, Event.revision, Event.updated_at)
+        .where(Event.id == event_id)
+    ).first()
+    if summary is None:
+        abort(404)
+    # Busy on-sales send buyers through the waiting room first
+    if not has_admission(summary):
+        return redirect(url_for('events_bp.waiting_room', event_id = event_id))
+    etag, last_modified = page_validators(f"event{event_id}", summary.revision, summary.updated_at)
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+
+    # Load everything the page shows up front - one query per relationship, however
+    # many tiers, artists or comments the event has - instead of lazy loading in the template
+    event = db.first_or_404(
+        db.select(Event)
+        .where(Event.id == event_id)
+        .options(
+            selectinload(Event.tickets),
+            selectinload(Event.artist_links).selectinload(EventArtist.artist),
+            selectinload(Event.genres),
+            selectinload(Event.venue),
+            selectinload(Event.event_type),
+            selectinload(Event.images),
+        )
+    )
     purchase_form = TicketPurchaseForm(event.tickets)
     comment_form = CommentForm()
-    comments = Comment.query.filter_by(event_id=event.id).order_by(Comment.commentDateTime.desc()).all()
+    comments = _comments_page(event.id)
 
-    return render_template(
+    response = make_response(render_template(
         'events/eventdetails.html',
         event = event,
         purchase_form = purchase_form,
         comment_form = comment_form,
         comments = comments,
         heading = 'Event Details'
-    )
+    ))
+    return add_validators(response, etag, last_modified)
 
 @events_bp.route('/events/myevents', methods=['GET'])
 @login_required
@@ -176,7 +242,7 @@ def myevents():
 
     et_ids, et_names = split_ids_names(et_raw)
     g_ids,  g_names  = split_ids_names(g_raw)
-    # Normalise statuses to upper for DB comparison; also keep originals for ilike fallback
+    # Normalise statuses to upper for DB comparison
     st_norm = [s.upper() for s in st_raw]
 
     # Base query: only the current user's events
@@ -188,7 +254,7 @@ def myevents():
         q = q.where(or_(
             Event.title.ilike(like),
             Event.description.ilike(like),
-            Event.date.ilike(like),
+            cast(Event.date, String).ilike(like),
             Event.venue.has(Venue.location.ilike(like)),
             Event.genres.any(Genre.genreType.ilike(like)),
             Event.artists.any(Artist.artistName.ilike(like))
@@ -209,32 +275,20 @@ def myevents():
         ors = [Event.genres.any(Genre.genreType.ilike(n)) for n in g_names]
         q = q.where(or_(*ors))
 
-    # Status filters (try exact uppercase; if that yields nothing, ilike fallback)
+    # Status filters match the computed status, so they are never stale
     if st_norm:
-        q = q.where(or_(
-            Event.status.in_(st_norm),
-            # fallback: any of the raw values via ilike, in case labels differ
-            *[Event.status.ilike(s) for s in st_raw]
-        ))
-
-    # Order newest first; if date is stored as text it will still be stable enough for now
-    events = db.session.scalars(q.order_by(Event.date.desc())).all()
-
-    status_changed = False
-    for event in events:
-        original_status = event.status
-        _sync_event_status(event)
-        if event.status != original_status:
-            status_changed = True
+        q = q.where(Event.effective_status.in_(st_norm))
 
-    if status_changed:
-        db.session.commit()
+    # Newest first, one page at a time; id breaks ties between events on the same date
+    events = _paginate_keyset(q, [Event.date, Event.id], descending=True)
 
     if not events:
         flash('No events matched your filters. Try a different search term or filter.', 'search_info')
 
     event_type_options = EventType.query.order_by(EventType.typeName).all()
     genre_options = Genre.query.order_by(Genre.genreType).all()
+    # progress of background refunds for removed ticket tiers
+    refund_jobs = refund_jobs_for([event.id for event in events])
 
     return render_template(
         'events/myevents.html',
@@ -242,9 +296,31 @@ def myevents():
         events=events,
         search_term=term,
         event_type_options=event_type_options,
-        genre_options=genre_options
+        genre_options=genre_options,
+        refund_jobs=refund_jobs
     )
 
+# Download the sales for all of the logged-in organizer's events, or for one of them.
+# The file is generated while it is sent (see exports.py), so its size doesn't matter.
+@events_bp.route('/events/myevents/sales.<any(csv, ndjson):fmt>', methods=['GET'])
+@events_bp.route('/events/<int:event_id>/sales.<any(csv, ndjson):fmt>', methods=['GET'])
+@login_required
+def export_sales(fmt, event_id=None):
+    filename = f"sales.{fmt}"
+    if event_id is not None:
+        event = db.get_or_404(Event, event_id)
+        if event.user_id != current_user.id:
+            flash('You can only export sales for events you created.', 'warning')
+            return redirect(url_for('events_bp.myevents'))
+        filename = f"sales-event-{event.id}.{fmt}"
+
+    rows = stream_sales(fmt, current_user.id, event_id)
+    response = current_app.response_class(stream_with_context(rows), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 # Update event endpoint
 
 @events_bp.route('/events/<int:event_id>/update', methods=['POST'])
@@ -270,6 +346,14 @@ def update_event(event_id):
         flash('Title is required to update an event.', 'warning')
         return redirect(url_for('events_bp.myevents'))
 
+    # Schedule fields are typed columns, so reject text that isn't a real date/time
+    parsed_date = parse_event_date(date_value) if date_value else None
+    parsed_start = parse_event_time(start_time) if start_time else None
+    parsed_end = parse_event_time(end_time) if end_time else None
+    if (date_value and not parsed_date) or (start_time and not parsed_start) or (end_time and not parsed_end):
+        flash('Please enter the date as YYYY-MM-DD and times as HH:MM.', 'warning')
+        return redirect(url_for('events_bp.myevents'))
+
     event.title = title
 
     selected_event_type = None
@@ -288,28 +372,22 @@ def update_event(event_id):
     event.event_type = selected_event_type
     if status:
         event.status = status
-    if date_value:
-        event.date = date_value
-    if start_time:
-        event.start_time = start_time
-    else:
-        event.start_time = None
-    if end_time:
-        event.end_time = end_time
-    else:
-        event.end_time = None
+        event.cancelled = status.upper() == 'CANCELLED'
+    event.queue_enabled = request.form.get('queue_enabled') == 'on'
+    if parsed_date:
+        event.date = parsed_date
+    event.start_time = parsed_start
+    event.end_time = parsed_end
     event.description = description or None
 
     image_file = request.files.get('image')
     if image_file and image_file.filename:
-        image_filename = secure_filename(image_file.filename)
-        if image_filename:
-            timestamp = int(datetime.now(timezone.utc).timestamp())
-            unique_filename = f"event_{event_id}_{timestamp}_{image_filename}"
-            image_path = os.path.join('club95', 'static', 'img', unique_filename)
-            os.makedirs(os.path.dirname(image_path), exist_ok=True)
-            image_file.save(image_path)
-            event.image = unique_filename
+        if secure_filename(image_file.filename):
+            stored_name = save_media(image_file)
+            release_media(event.image)
+            event.image = stored_name
+            event.image_widths = None
+            queue_derivatives('poster', stored_name)
 
     if location:
         event.venue = _get_or_create_venue(location)
@@ -344,6 +422,9 @@ def update_event(event_id):
     if ticket_ids or ticket_names or ticket_prices or ticket_quantities or ticket_perks_values or ticket_delete_flags:
         # Map existing tickets by id so we can tell updates from new rows in O(1)
         existing_ticket_map = {str(ticket.id): ticket for ticket in event.tickets}
+        # Tiers a background job is still refunding can't be edited or removed again
+        refunding_ids = {str(ticket_id) for ticket_id in tiers_being_refunded(existing_ticket_map)}
+        skipped_tiers = []
         tickets_to_delete = []
         tickets_to_update = []
         tickets_to_create = []
@@ -369,6 +450,11 @@ def update_event(event_id):
             if not row_id and not tier_name and not price_input and not quantity_input and not perks_input:
                 continue
 
+            # The edit form leaves these rows out, so this is a page opened before the removal
+            if row_id in refunding_ids:
+                skipped_tiers.append(existing_ticket_map[row_id].ticketTier)
+                continue
+
             # Deletion requests are flagged separately so we honour them later
             if delete_requested:
                 if row_id:
@@ -440,37 +526,18 @@ def update_event(event_id):
 
         refunded_tiers = []
         removed_tiers = []
+        queued_tiers = []
         for row_id in tickets_to_delete:
             ticket_obj = existing_ticket_map.pop(row_id, None)
             if not ticket_obj:
                 continue
 
-            refund_total = 0.0
-            if ticket_obj.order_links:
-                affected_orders = set()
-                for order_link in list(ticket_obj.order_links):
-                    quantity = order_link.quantity or 0
-                    line_refund = (order_link.price_at_purchase or 0.0) * quantity
-                    refund_total += line_refund
-
-                    order = order_link.order
-                    if order:
-                        order.amount = max(0.0, (order.amount or 0.0) - line_refund)
-                        affected_orders.add(order)
-                        if order_link in order.line_items:
-                            order.line_items.remove(order_link)
-
-                    if order_link in ticket_obj.order_links:
-                        ticket_obj.order_links.remove(order_link)
-
-                    db.session.delete(order_link)
-
-                for order in affected_orders:
-                    if not order.line_items:
-                        db.session.delete(order)
-                    elif order.amount is None or order.amount < 0:
-                        order.amount = 0.0
-
+            # Buyers are refunded with set-based SQL (see refunds.py); big tiers go to a background job
+            refund_job, refund_total = remove_tier(ticket_obj)
+            if refund_job:
+                queued_tiers.append(ticket_obj.ticketTier)
+                continue
+            if refund_total:
                 refunded_tiers.append((ticket_obj.ticketTier, refund_total))
             else:
                 removed_tiers.append(ticket_obj.ticketTier)
@@ -503,37 +570,33 @@ def update_event(event_id):
             )
             flash(f'Refunds will be issued for removed ticket tiers: {refund_summary}', 'warning')
 
+        if queued_tiers:
+            queued_list = ', '.join(queued_tiers)
+            flash(f'Ticket tiers taken off sale and being refunded in the background: {queued_list}. '
+                  'Progress is shown on the event below.', 'warning')
+
         if removed_tiers:
             removed_list = ', '.join(removed_tiers)
             flash(f'Removed ticket tiers: {removed_list}', 'info')
 
-    _sync_event_status(event)
+        if skipped_tiers:
+            skipped_list = ', '.join(skipped_tiers)
+            flash(f'Ticket tiers still being refunded were left unchanged: {skipped_list}', 'warning')
 
-    # Prepare to replace or remove existing carousel media before adding new files
-    media_folder = os.path.join('club95', 'static', 'img', 'event_media')
+    _sync_event_status(event)
 
+    # Replace or remove existing carousel media before adding new files
     for media in list(event.images):
         # Replace an existing event media image if the user supplied a new file
         replacement_file = request.files.get(f'replace_image_{media.id}')
         if replacement_file and replacement_file.filename:
-            safe_name = secure_filename(replacement_file.filename)
-            if safe_name:
-                os.makedirs(media_folder, exist_ok=True)
-                timestamp = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
-                unique_name = f"event_{event.id}_{timestamp}_{media.id}_{safe_name}"
-                destination = os.path.join(media_folder, unique_name)
-                replacement_file.save(destination)
-
-                if media.filename:
-                    # Remove the obsolete file from disk when possible
-                    old_path = os.path.join('club95', 'static', 'img', media.filename)
-                    if os.path.exists(old_path):
-                        try:
-                            os.remove(old_path)
-                        except OSError:
-                            pass
-
-                media.filename = f"event_media/{unique_name}"
+            if secure_filename(replacement_file.filename):
+                stored_name = save_media(replacement_file)
+                # The old file may be shared with other rows; just drop this reference
+                release_media(media.filename)
+                media.filename = stored_name
+                media.widths = None
+                queue_derivatives('media', media.filename)
 
     # Gather any media IDs flagged for deletion from the form submission
     delete_ids_raw = request.form.getlist('delete_media_ids')
@@ -547,18 +610,16 @@ def update_event(event_id):
     if delete_ids:
         images_to_delete = EventImage.query.filter(EventImage.event_id == event.id, EventImage.id.in_(delete_ids)).all()
         for media in images_to_delete:
-            if media.filename:
-                media_path = os.path.join('club95', 'static', 'img', media.filename)
-                if os.path.exists(media_path):
-                    try:
-                        os.remove(media_path)
-                    except OSError:
-                        pass
+            release_media(media.filename)
             db.session.delete(media)
 
     additional_media_files = request.files.getlist('additional_media')
     _save_event_media(event, additional_media_files)
 
+    # Keep the full-text search row in step with the edited fields
+    index_event(event)
+    touch_events(event.id)
+
     db.session.commit()
     flash('Event updated successfully.', 'success')
     return redirect(url_for('events_bp.myevents'))
@@ -579,6 +640,8 @@ def create_genre():
 
     new_genre = Genre(genreType=genre_name)
     db.session.add(new_genre)
+    # the genre filter on every listing changes
+    touch_catalogue()
     db.session.commit()
 
     return jsonify(success=True, id=new_genre.id, name=new_genre.genreType, created=True)
@@ -625,13 +688,10 @@ def createevent():
     artist_errors = []
 
     if form.validate_on_submit():
-        # Save the uploaded image (if any) into static/img and keep just the filename in the DB
+        # Save the uploaded image (if any) into the media store and keep its name in the DB
         image_filename = None
-        if form.image.data:
-            image_file = form.image.data
-            image_filename = secure_filename(image_file.filename)
-            image_path = os.path.join('club95', 'static', 'img', image_filename)
-            image_file.save(image_path)
+        if form.image.data and secure_filename(form.image.data.filename):
+            image_filename = save_media(form.image.data)
 
         # Turn selected genre IDs back into Genre objects
         selected_genres = Genre.query.filter(Genre.id.in_(form.genres.data)).all()
@@ -694,10 +754,10 @@ def createevent():
             new_event = Event(
                 title=form.title.data,
                 status='OPEN',
-                date=form.date.data.strftime('%Y-%m-%d') if form.date.data else None,
+                date=form.date.data,
                 description=form.description.data,
-                start_time=form.start_time.data.strftime('%H:%M') if form.start_time.data else None,
-                end_time=form.end_time.data.strftime('%H:%M') if form.end_time.data else None,
+                start_time=form.start_time.data,
+                end_time=form.end_time.data,
                 image=image_filename,
             )
 
@@ -790,6 +850,11 @@ def createevent():
                 )
                 db.session.add(ticket)
 
+            # Make the new event findable through the search bar
+            index_event(new_event)
+            touch_events(new_event.id)
+            queue_derivatives('poster', image_filename)
+
             # Finalise the whole transaction: event, any new artists, and tickets
             db.session.commit()
 
@@ -815,6 +880,28 @@ def createevent():
         prefilled_genres=form.genres.data or [],
         min_date=min_date
     )
+
+# Bulk import page: upload a CSV or NDJSON file of events (see importer.py)
+@events_bp.route('/events/import', methods=['GET', 'POST'])
+@login_required
+def import_events_page():
+    form = EventImportForm()
+    report = None
+    if form.validate_on_submit():
+        upload = form.file.data
+        # the upload is already spooled to disk by the request parser and is read row by row
+        report = import_events(upload.stream, detect_format(upload.filename), current_user.id)
+        if report['created']:
+            flash(f"Imported {report['created']} events.", "success")
+        if report['failed']:
+            flash(f"{report['failed']} rows could not be imported; see the list below.", "danger")
+    elif request.method == 'POST':
+        for errors in form.errors.values():
+            for message in errors:
+                flash(message, "danger")
+
+    return render_template('events/import.html', form=form, report=report, heading="Import Events")
+
 @events_bp.route('/events/add_genre', methods=['POST'])
 @login_required
 def add_genre():
@@ -835,6 +922,7 @@ def add_genre():
         if not Genre.query.filter_by(genreType=new_genre_name).first():
             new_genre = Genre(genreType=new_genre_name)
             db.session.add(new_genre)
+            touch_catalogue()
             db.session.commit()
             selected_ids.append(new_genre.id)
             flash(f"Genre '{new_genre_name}' added.", "success")
@@ -877,26 +965,81 @@ def add_comment(event_id):
         user_id=current_user.id
     )
 
-    # Adds comment to Database
+    # Adds comment to Database, bumping the event's count in the same transaction
     db.session.add(new_comment)
+    db.session.execute(
+        db.update(Event)
+        .where(Event.id == event.id)
+        .values(comment_count=Event.comment_count + 1)
+        .execution_options(synchronize_session=False)
+    )
+    touch_events(event.id)
     db.session.commit()
 
     flash("Comment posted successfully!", "success")
     return redirect(url_for('events_bp.eventdetails', event_id=event.id))
 
+# Next page of comments as an HTML fragment, for the "Load more comments" button
+@events_bp.route('/events/eventdetails/<int:event_id>/comments', methods=['GET'])
+def event_comments(event_id):
+    event = db.get_or_404(Event, event_id)
+    return render_template('partials/comments.html', event=event, comments=_comments_page(event.id))
+
+# Live ticket availability for an open event page, as Server-Sent Events.
+# Sends the current snapshot straight away, then a new one whenever a purchase,
+# cancellation or edit commits (see live.py). Each connection ends after
+# LIVE_STREAM_SECONDS so it can't hold a worker indefinitely; the browser
+# reconnects after the `retry:` delay and gets a fresh snapshot.
+@events_bp.route('/events/<int:event_id>/live', methods=['GET'])
+def event_live(event_id):
+    initial = availability_snapshots([event_id]).get(event_id)
+    if initial is None:
+        abort(404)
+    keepalive = current_app.config['LIVE_KEEPALIVE_SECONDS']
+    deadline = time.monotonic() + current_app.config['LIVE_STREAM_SECONDS']
+    subscription = live_subscribe(event_id)
+    # the stream runs after the request has finished, so it must not touch the database
+    db.session.close()
+
+    def stream():
+        try:
+            yield f"retry: 5000\nevent: availability\ndata: {initial}\n\n"
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    payload = subscription.get(timeout=min(keepalive, remaining))
+                except queue.Empty:
+                    # comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: availability\ndata: {payload}\n\n"
+        finally:
+            live_unsubscribe(event_id, subscription)
+
+    response = current_app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # stop nginx-style proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 # Purchase tickets
 @events_bp.route('/events/purchase/<int:event_id>', methods = ['POST'])
 @login_required
 def purchase_tickets(event_id):
     # Lookup event by ID, if not found: return 404
     event = Event.query.get_or_404(event_id)
-    event_status = (event.status or '').strip().upper()
+    event_status = event.effective_status
     if event_status == 'CANCELLED':
         flash('Ticket sales are closed for this event.', 'warning')
         return redirect(url_for('events_bp.eventdetails', event_id = event.id))
     if event_status == 'SOLD OUT':
         flash('This event is sold out.', 'warning')
         return redirect(url_for('events_bp.eventdetails', event_id = event.id))
+    # Buyers must have come through the waiting room (or their pass has run out)
+    if not has_admission(event):
+        return redirect(url_for('events_bp.waiting_room', event_id = event.id))
 
     form = TicketPurchaseForm(event.tickets, formdata = request.form)
 
@@ -942,38 +1085,155 @@ def purchase_tickets(event_id):
         flash("Select at least one ticket to purchase.", "warning")
         return redirect(url_for('events_bp.eventdetails', event_id = event.id))
 
-    # Create order and order tickets table items, update ticket availability
-    # to reflect this on  next visit to same modal
-    order = Order(
-        # ! utcnow is deprecated
-    order_date = datetime.now(timezone.utc),
-        amount = total_amount,
-        user_id = current_user.id
+    # Reserve the tickets rather than selling them outright. The stock is taken now
+    # (one conditional UPDATE per tier, so racing buyers can't oversell) and held for
+    # HOLD_MINUTES while the user reviews the order on the checkout page; holds that
+    # are never confirmed go back on sale when they expire.
+    # A retried submission (same idempotency key) goes to the original reservation
+    # instead of taking the tickets a second time
+    idempotency_key = request_idempotency_key(form.idempotency_key.data)
+    key_record, earlier = claim_idempotency_key(idempotency_key, 'purchase', current_user.id)
+    if earlier:
+        flash("This order was already submitted.", "info")
+        return redirect(earlier.result_url or url_for('events_bp.eventdetails', event_id = event.id))
+
+    token = hold_tickets(order_items, current_user.id, event.id)
+    if token is None:
+        flash("Not enough tickets available for your order.", "danger")
+        return redirect(url_for('events_bp.eventdetails', event_id = event.id))
+
+    _sync_event_status(event)
+    touch_events(event.id)
+
+    checkout_url = url_for('events_bp.checkout', token = token)
+    if key_record:
+        key_record.result_url = checkout_url
+    db.session.commit()
+    return redirect(checkout_url)
+
+
+# Waiting room page for queue-enabled events
+@events_bp.route('/events/<int:event_id>/queue', methods = ['GET'])
+def waiting_room(event_id):
+    event = Event.query.get_or_404(event_id)
+    if not event.queue_enabled:
+        return redirect(url_for('events_bp.eventdetails', event_id = event.id))
+
+    position = queue_position(event.id)
+    if position == 0:
+        return redirect(url_for('events_bp.eventdetails', event_id = event.id))
+
+    return render_template(
+        'events/queue.html',
+        event = event,
+        position = position,
+        wait_seconds = estimated_wait_seconds(event.id, position),
+        poll_seconds = current_app.config['QUEUE_POLL_SECONDS'],
+        heading = 'Waiting Room'
     )
 
-    # Add order object to database
-    db.session.add(order)
-    db.session.flush()
-
-    # Create OrderTicket entries and update ticket availability
-    # for each ticket in order_items, create an OrderTicket entry and update ticket availability
-    for ticket, quantity in order_items:
-        db.session.add(
-            OrderTicket(
-                order_id = order.id,
-                ticket_id = ticket.id,
-                quantity = quantity,
-                price_at_purchase = ticket.price
-            )
+
+# Polled by the waiting room page. Usually a single primary-key read of the queue gate;
+# it only writes when the gate has room to let someone through.
+@events_bp.route('/events/<int:event_id>/queue/status', methods = ['GET'])
+def waiting_room_status(event_id):
+    queue_url = url_for('events_bp.waiting_room', event_id = event_id)
+    # only visitors who joined through the queue page have a place to check
+    if str(event_id) not in session.get('queue_places', {}):
+        return jsonify(admitted = False, position = None, redirect = queue_url)
+
+    position = queue_position(event_id)
+    if position == 0:
+        return jsonify(
+            admitted = True,
+            position = 0,
+            redirect = url_for('events_bp.eventdetails', event_id = event_id)
         )
-        # Update ticket availability
-        ticket.availability -= quantity
+    return jsonify(
+        admitted = False,
+        position = position,
+        wait_seconds = estimated_wait_seconds(event_id, position)
+    )
 
-    _sync_event_status(event)
 
-    # Commit all changes to database
+# Checkout page for a ticket hold
+@events_bp.route('/events/checkout/<token>', methods = ['GET'])
+@login_required
+def checkout(token):
+    holds = (
+        TicketHold.query
+        .filter_by(token = token, user_id = current_user.id)
+        .options(selectinload(TicketHold.ticket), selectinload(TicketHold.event))
+        .all()
+    )
+    if not holds:
+        # an already confirmed hold leads to its order
+        confirmed = find_idempotency_key(token, 'confirm', current_user.id)
+        if confirmed:
+            return redirect(confirmed.result_url)
+    if not holds or holds[0].expires_at <= datetime.now():
+        flash("Your ticket reservation has expired. Please select your tickets again.", "warning")
+        if holds:
+            return redirect(url_for('events_bp.eventdetails', event_id = holds[0].event_id))
+        return redirect(url_for('home_bp.index'))
+
+    return render_template(
+        'events/checkout.html',
+        holds = holds,
+        event = holds[0].event,
+        expires_at = holds[0].expires_at,
+        total_amount = sum(hold.price_at_hold * hold.quantity for hold in holds),
+        form = CheckoutForm(),
+        heading = 'Checkout'
+    )
+
+
+# Confirm a ticket hold, turning it into an order
+@events_bp.route('/events/checkout/<token>/confirm', methods = ['POST'])
+@login_required
+def confirm_checkout(token):
+    form = CheckoutForm()
+    if not form.validate_on_submit():
+        flash("Could not confirm your order, please try again.", "danger")
+        return redirect(url_for('events_bp.checkout', token = token))
+
+    # The hold token doubles as the idempotency key (or the client sends its own),
+    # so a retried confirmation returns the original order
+    idempotency_key = request_idempotency_key(token)
+    key_record, earlier = claim_idempotency_key(idempotency_key, 'confirm', current_user.id)
+    if earlier:
+        flash("This order was already confirmed.", "info")
+        return redirect(earlier.result_url or url_for('user_bp.mytickets'))
+
+    hold = TicketHold.query.filter_by(token = token, user_id = current_user.id).first()
+    order = confirm_hold(token, current_user.id)
+    if order is None:
+        db.session.rollback()
+        flash("Your ticket reservation has expired. Please select your tickets again.", "warning")
+        if hold:
+            return redirect(url_for('events_bp.eventdetails', event_id = hold.event_id))
+        return redirect(url_for('home_bp.index'))
+
+    if key_record:
+        key_record.result_url = url_for('user_bp.mytickets', _anchor = f"order-{order.id}")
     db.session.commit()
-    # Confirm successful purchase
     flash("Tickets purchased successfully!", "success")
-    # Redirect to the user's tickets page so they can see the new order
-    return redirect(url_for('user_bp.mytickets'))
\ No newline at end of file
+    return redirect(url_for('user_bp.mytickets'))
+
+
+# Cancel a ticket hold, putting the tickets back on sale straight away
+@events_bp.route('/events/checkout/<token>/cancel', methods = ['POST'])
+@login_required
+def cancel_checkout(token):
+    form = CheckoutForm()
+    hold = TicketHold.query.filter_by(token = token, user_id = current_user.id).first()
+    if form.validate_on_submit() and hold:
+        event = hold.event
+        cancel_hold(token, current_user.id)
+        db.session.expire(event)
+        _sync_event_status(event)
+        touch_events(event.id)
+        db.session.commit()
+        flash("Your reservation was cancelled.", "info")
+        return redirect(url_for('events_bp.eventdetails', event_id = event.id))
+    return redirect(url_for('home_bp.index'))
@@ -0,0 +1,117 @@
+import csv
+import io
+import json
+
+from flask import current_app
+
+from . import db
+from .models import Event, Order, OrderTicket, Ticket, User
+
+# Sales exports for organizers: one row per order line (who bought how many of
+# which tier, at what price) across one event or all of an organizer's events.
+#
+# The rows are read in keyset batches of EXPORT_BATCH_SIZE, ordered by
+# (event, order, ticket) and each starting after the last row of the one before.
+# A batch is fetched completely and its read transaction ended before it is written
+# out as CSV or NDJSON and sent, so a slow download never keeps SQLite's shared lock
+# (which would stop every purchase and edit until the client caught up). Plain
+# columns are selected rather than ORM objects, so nothing piles up in the session
+# either; memory stays the same however many attendees an event has.
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+COLUMNS = (
+    'event_id', 'event_title', 'event_date', 'order_id', 'order_date', 'buyer_name',
+    'buyer_email', 'ticket_tier', 'quantity', 'unit_price', 'line_total',
+)
+
+# spreadsheet apps run cells starting with these as formulas
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _sales_query(organizer_id: int, event_id: int = None):
+    query = (
+        db.select(
+            Event.id, Event.title, Event.date, Order.id, Order.order_date,
+            User.firstName, User.lastName, User.email,
+            Ticket.ticketTier, OrderTicket.quantity, OrderTicket.price_at_purchase, Ticket.id,
+        )
+        .select_from(OrderTicket)
+        .join(Ticket, Ticket.id == OrderTicket.ticket_id)
+        .join(Event, Event.id == Ticket.event_id)
+        .join(Order, Order.id == OrderTicket.order_id)
+        .join(User, User.id == Order.user_id)
+        .where(Event.user_id == organizer_id)
+        .order_by(Event.id, Order.id, Ticket.id)
+    )
+    if event_id is not None:
+        query = query.where(Event.id == event_id)
+    return query
+
+
+def _sales_batches(organizer_id: int, event_id: int, batch_size: int):
+    # Yield lists of up to batch_size rows, one short query per list.
+    query = _sales_query(organizer_id, event_id).limit(batch_size)
+    last = None
+    while True:
+        batch_query = query
+        if last is not None:
+            batch_query = query.where(db.tuple_(Event.id, Order.id, Ticket.id) > db.tuple_(*last))
+        rows = db.session.execute(batch_query).all()
+        # end the read transaction before the rows are handed to the client
+        db.session.rollback()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last = (rows[-1][0], rows[-1][3], rows[-1][11])
+
+
+def _record(row) -> dict:
+    event_id, title, event_date, order_id, order_date, first_name, last_name, email, tier, quantity, price, _ = row
+    quantity = quantity or 0
+    price = price or 0.0
+    return {
+        'event_id': event_id,
+        'event_title': title,
+        'event_date': event_date.isoformat() if event_date else None,
+        'order_id': order_id,
+        'order_date': order_date.isoformat(sep=' ', timespec='seconds') if order_date else None,
+        'buyer_name': ' '.join(part for part in (first_name, last_name) if part),
+        'buyer_email': email,
+        'ticket_tier': tier,
+        'quantity': quantity,
+        'unit_price': round(price, 2),
+        'line_total': round(price * quantity, 2),
+    }
+
+
+def _cell(value):
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def stream_sales(fmt: str, organizer_id: int, event_id: int = None, batch_size: int = None):
+    # Generator of CSV / NDJSON text for an organizer's sales, one chunk per batch of rows.
+    # Run it inside stream_with_context so the session lives as long as the response.
+    if batch_size is None:
+        batch_size = current_app.config.get('EXPORT_BATCH_SIZE', 1000)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(COLUMNS)
+        yield buffer.getvalue()
+
+    for rows in _sales_batches(organizer_id, event_id, batch_size):
+        buffer.seek(0)
+        buffer.truncate()
+        for row in rows:
+            record = _record(row)
+            if fmt == 'csv':
+                writer.writerow([_cell(record[column]) for column in COLUMNS])
+            else:
+                buffer.write(json.dumps(record))
+                buffer.write('\n')
+        yield buffer.getvalue()
@@ -1,3 +1,4 @@
+import uuid
 from datetime import datetime, date
 from . import db
 from flask_login import UserMixin
@@ -6,7 +7,7 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, SelectField, SelectMultipleField, IntegerField, HiddenField, TextAreaField
 from wtforms.fields import DateField, TimeField
 from wtforms.validators import DataRequired, Length, ValidationError
-from flask_wtf.file import FileField, FileAllowed
+from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms.validators import NumberRange, Optional, EqualTo, Regexp, Email
 
 #Sets up forms for use thorughout the application using Flask-WTF and WTForms
@@ -136,6 +137,8 @@ class UpdateProfileForm(FlaskForm):
 
 class TicketPurchaseForm(FlaskForm):
     submit = SubmitField('Purchase')
+    # fresh per page load, so a resubmitted form is recognised as the same purchase
+    idempotency_key = HiddenField(default = lambda: uuid.uuid4().hex)
 
     def __init__(self, ticket_tiers, formdata = None, *args, **kwargs):
         # call constructor of parent class (FlaskForm)
@@ -182,6 +185,15 @@ class TicketPurchaseForm(FlaskForm):
             # Grab form and assign it a name (provided by database), grab integer that was bound
             setattr(self, field_name, bound_field)
 
+# confirm/cancel buttons on the checkout page for a ticket hold
+class CheckoutForm(FlaskForm):
+    submit = SubmitField('Confirm Purchase')
+
+# upload form for bulk-importing events from a CSV or NDJSON file
+class EventImportForm(FlaskForm):
+    file = FileField('Events File', validators=[FileRequired(), FileAllowed(['csv', 'ndjson', 'jsonl', 'json'], 'CSV or NDJSON files only!')])
+    submit = SubmitField('Import Events')
+
 # form for creating a comment on an event
 class CommentForm(FlaskForm):
     content = TextAreaField('Comment', validators=[DataRequired(), Length(max=300)])
@@ -1,8 +1,15 @@
+import base64
+import json
 import re
-from flask import Blueprint, render_template, request, redirect, url_for, flash
-from sqlalchemy import func
+import threading
+import time
+from flask import Blueprint, current_app, make_response, render_template, request, redirect, url_for, flash
+from sqlalchemy import event as sa_event, func, tuple_
+from sqlalchemy.orm import Session, object_session, selectinload
 from datetime import date, datetime
-from .models import Artist, Event, Genre, Ticket, Venue
+from .models import Event, EventArtist, Genre, Ticket
+from .search import search_match_subquery
+from .caching import catalogue_revision, page_validators, not_modified_response, add_validators
 from . import db
 
 home_bp = Blueprint('home_bp', __name__, template_folder='templates')
@@ -10,47 +17,206 @@ home_bp = Blueprint('home_bp', __name__, template_folder='templates')
 
 def _active_event_clause():
     # Return a SQL clause that excludes inactive events from public browsing.
-    return db.or_(Event.status.is_(None), func.upper(Event.status) != 'INACTIVE')
+    return Event.effective_status != 'INACTIVE'
 
-def _parse_event_date(raw_value: str):
-    # Attempt to convert a stored event date string into a real date object.
-    if not raw_value:
+def _event_listing_query():
+    # Build the base SELECT used by event listings (home page, search results).
+    # Every relationship the event cards touch is eager-loaded with selectinload,
+    # so a page costs one query per relationship instead of one per event.
+    return db.select(Event).options(
+        selectinload(Event.tickets),
+        selectinload(Event.artist_links).selectinload(EventArtist.artist),
+        selectinload(Event.genres),
+        selectinload(Event.venue),
+        selectinload(Event.event_type),
+    )
+
+class KeysetPage:
+    # One page of a keyset-paginated listing plus the cursors either side of it.
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+def _encode_cursor(values) -> str:
+    # Pack the sort key of a row into an opaque, URL-safe cursor string.
+    plain = [v.isoformat() if isinstance(v, (date, datetime)) else v for v in values]
+    raw = json.dumps(plain, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def _decode_cursor(raw_cursor: str):
+    # Unpack a cursor produced by _encode_cursor; tampered or stale cursors are ignored.
+    if not raw_cursor:
         return None
     try:
-        return datetime.strptime(raw_value, "%Y-%m-%d").date()
-    except (TypeError, ValueError):
+        padded = raw_cursor + '=' * (-len(raw_cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
         return None
+    return values if isinstance(values, list) else None
+
+def _coerce_cursor_value(column, value):
+    # JSON has no date type, so turn ISO strings back into dates for typed columns.
+    try:
+        python_type = column.type.python_type
+    except (AttributeError, NotImplementedError):
+        return value
+    if isinstance(value, str) and python_type in (date, datetime):
+        try:
+            return python_type.fromisoformat(value)
+        except ValueError:
+            return value
+    return value
+
+def _page_size() -> int:
+    # Configured page size, optionally overridden by ?per_page= up to MAX_PAGE_SIZE.
+    default_size = current_app.config.get('PAGE_SIZE', 12)
+    max_size = current_app.config.get('MAX_PAGE_SIZE', 48)
+    requested = request.args.get('per_page', type=int)
+    if requested and requested > 0:
+        return min(requested, max_size)
+    return default_size
+
+def _paginate_keyset(query, sort_columns, descending=False):
+    # Fetch one page of `query` using the ?after= / ?before= cursors in the request.
+    # sort_columns must end in a unique column (the id) so every row has a distinct key.
+    # Each page is a single indexed range scan with LIMIT, so deep pages cost the
+    # same as the first one (unlike OFFSET, which walks every skipped row).
+    page_size = _page_size()
+    before = _decode_cursor(request.args.get('before'))
+    after = None if before else _decode_cursor(request.args.get('after'))
+    cursor = before or after
+    backwards = before is not None
+
+    # Walking "forward" through a descending listing means moving to smaller keys
+    towards_smaller = descending != backwards
+    if cursor and len(cursor) == len(sort_columns):
+        bound = tuple_(*[
+            db.literal(_coerce_cursor_value(column, value), type_=column.type)
+            for column, value in zip(sort_columns, cursor)
+        ])
+        keys = tuple_(*sort_columns)
+        query = query.where(keys < bound if towards_smaller else keys > bound)
+    else:
+        cursor, backwards = None, False
+
+    ordering = [column.desc() if towards_smaller else column.asc() for column in sort_columns]
+    rows = db.session.execute(
+        query.add_columns(*sort_columns).order_by(*ordering).limit(page_size + 1)
+    ).unique().all()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+
+    items = [row[0] for row in rows]
+    first_key = _encode_cursor(rows[0][1:]) if rows else None
+    last_key = _encode_cursor(rows[-1][1:]) if rows else None
+
+    if backwards:
+        # We came from the page after this one, so there is always a way forward
+        return KeysetPage(items, next_cursor=last_key, prev_cursor=first_key if has_more else None)
+    return KeysetPage(items, next_cursor=last_key if has_more else None, prev_cursor=first_key if cursor else None)
+
+@home_bp.app_template_global()
+def page_url(**cursor):
+    # Rebuild the current URL (filters included) pointing at another page.
+    args = request.args.to_dict(flat=False)
+    args.pop('after', None)
+    args.pop('before', None)
+    args.update({key: value for key, value in cursor.items() if value})
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+# Cached carousel rows: (catalogue revision, day computed, monotonic timestamp, rows).
+# Rows are plain (id, title, image, image_widths, date) tuples so they outlive the request session.
+_upcoming_cache = {}
+_upcoming_cache_lock = threading.Lock()
 
-def _select_upcoming_events(events, limit=3):
-    # Extract the nearest upcoming OPEN events from an iterable of Event objects.
+def _invalidate_upcoming_events():
+    # Drop the cached carousel; the next page view recomputes it.
+    with _upcoming_cache_lock:
+        _upcoming_cache.clear()
+
+def _select_upcoming_events(limit=3, revision=None):
+    # Return the nearest upcoming OPEN events for the carousel.
+    # One ORDER BY date LIMIT query over the indexed date column, cached until the
+    # catalogue revision moves on (touch_events / touch_catalogue, in any worker
+    # process), an event's date/status changes here, the day rolls over, or
+    # UPCOMING_CACHE_SECONDS pass. Pages that already read the revision pass it in.
     today = date.today()
-    upcoming = []
-    # simple sorting
-    for ev in events:
-        parsed_date = _parse_event_date(ev.date)
-        status = (ev.status or '').strip().upper()
-        if parsed_date and parsed_date >= today and status == 'OPEN':
-            upcoming.append((parsed_date, ev))
-
-    upcoming.sort(key=lambda item: item[0])
-    return [ev for _, ev in upcoming[:limit]]
+    if revision is None:
+        revision = catalogue_revision()[0]
+    max_age = current_app.config.get('UPCOMING_CACHE_SECONDS', 300)
+    with _upcoming_cache_lock:
+        cached = _upcoming_cache.get(limit)
+    if cached and cached[:2] == (revision, today) and time.monotonic() - cached[2] < max_age:
+        return cached[3]
+
+    rows = db.session.execute(
+        db.select(Event.id, Event.title, Event.image, Event.image_widths, Event.date)
+        .where(Event.date >= today, Event.effective_status == 'OPEN')
+        .order_by(Event.date, Event.id)
+        .limit(limit)
+    ).all()
+    with _upcoming_cache_lock:
+        _upcoming_cache[limit] = (revision, today, time.monotonic(), rows)
+    return rows
+
+def _note_upcoming_change(target, value, oldvalue, initiator):
+    # Attribute listener: flag the session so the carousel is refreshed once it commits.
+    session = object_session(target)
+    if session is None:
+        _invalidate_upcoming_events()
+    else:
+        session.info['upcoming_events_changed'] = True
+
+for _attribute in (Event.date, Event.status, Event.cancelled, Event.title, Event.image):
+    sa_event.listen(_attribute, 'set', _note_upcoming_change)
+
+@sa_event.listens_for(Session, 'after_commit')
+def _refresh_upcoming_after_commit(session):
+    if session.info.pop('upcoming_events_changed', False):
+        _invalidate_upcoming_events()
+
 # Home page
 @home_bp.route('/')
 def index():
-    events = db.session.scalars(
-        db.select(Event).where(_active_event_clause())
-    ).all()
+    # Answer a refresh with 304 while the catalogue is unchanged (see caching.py)
+    revision, updated_at = catalogue_revision()
+    etag, last_modified = page_validators('index', revision, updated_at)
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
 
-    top_three = _select_upcoming_events(events)
-    return render_template(
+    events = _paginate_keyset(
+        _event_listing_query().where(_active_event_clause()),
+        [Event.date, Event.id]
+    )
+
+    top_three = _select_upcoming_events(revision=revision)
+    response = make_response(render_template(
         'index.html',
         heading='Browse Events',
         events=events,
         upcoming_events=top_three
-    )
+    ))
+    return add_validators(response, etag, last_modified)
 
 @home_bp.route('/search')
 def search():
+    revision, updated_at = catalogue_revision()
+    etag, last_modified = page_validators('search', revision, updated_at)
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+
     term = (request.args.get('search') or '').strip()
 
     # accept both [] and non-[] parameter names
@@ -62,27 +228,23 @@ def search():
         for value in status_vals
     )
 
-    upcoming_three = _select_upcoming_events(
-        db.session.scalars(
-            db.select(Event).where(_active_event_clause())
-        ).all()
-    )
+    upcoming_three = _select_upcoming_events(revision=revision)
 
-    q = db.select(Event)
+    q = _event_listing_query()
     if not include_inactive:
         q = q.where(_active_event_clause())
 
-    # ---- text & price search (only if term provided) ----
+    # ---- full-text & price search (only if term provided) ----
+    relevance = None
     if term:
-        query = f"%{term}%"
-        filters = [
-            Event.title.ilike(query),
-            Event.description.ilike(query),
-            Event.date.ilike(query),
-            Event.venue.has(Venue.location.ilike(query)),
-            Event.genres.any(Genre.genreType.ilike(query)),
-            Event.artists.any(Artist.artistName.ilike(query)),
-        ]
+        filters = []
+
+        # FTS5 index covers title, description, date, venue, genres and artists
+        matches = search_match_subquery(term)
+        if matches is not None:
+            q = q.outerjoin(matches, matches.c.event_id == Event.id)
+            filters.append(matches.c.event_id.is_not(None))
+            relevance = matches.c.rank
 
         price_value = _extract_price(term)
         if price_value is not None:
@@ -93,7 +255,7 @@ def search():
             )
             filters.append(Event.id.in_(min_price_ids))
 
-        q = q.where(db.or_(*filters))
+        q = q.where(db.or_(*filters) if filters else db.false())
 
     # ---- event type filter (ids or names) ----
     if type_vals:
@@ -132,20 +294,27 @@ def search():
     if status_vals:
         wanted = [s.strip().upper() for s in status_vals if s.strip()]
         if wanted:
-            q = q.where(func.upper(Event.status).in_(wanted))
+            q = q.where(Event.effective_status.in_(wanted))
 
-    events = db.session.scalars(q).all()
+    # Best text matches first (bm25 scores are negative); price-only matches follow.
+    # Without a term, results page through by date like the home page.
+    if relevance is not None:
+        sort_columns = [func.coalesce(relevance, 0.0), Event.id]
+    else:
+        sort_columns = [Event.date, Event.id]
+    events = _paginate_keyset(q, sort_columns)
 
     if not events:
         flash('No events matched your filters. Try different filters or a keyword.', 'search_info')
 
-    return render_template(
+    response = make_response(render_template(
         'index.html',
         heading='Browse Events',
         events=events,
         search_term=term,
         upcoming_events=upcoming_three
-    )
+    ))
+    return add_validators(response, etag, last_modified)
 
 
 @home_bp.route('/help/faq')
@@ -182,4 +351,4 @@ def _extract_price(raw_term: str):
     try:
         return round(float(match.group()), 2)
     except ValueError:
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+from flask import current_app, request
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .models import IdempotencyKey
+
+# Idempotency keys for POSTs that clients retry (double clicks, flaky mobile networks).
+#
+# The key comes from the `Idempotency-Key` header or a hidden form field. It is
+# inserted in the same transaction as the work it protects, so the unique
+# constraint on (user, scope, key) decides which request wins: a retry either
+# blocks on SQLite's write lock and then hits the constraint, or finds the row
+# already committed. Either way it is sent to the first request's result instead
+# of running again. If the work fails and rolls back, the key goes with it and
+# the client may simply retry.
+
+MAX_KEY_LENGTH = 64
+
+
+def request_idempotency_key(form_value=None):
+    # The key for this request: the header wins over the form field. None if neither is usable.
+    key = (request.headers.get('Idempotency-Key') or form_value or '').strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return None
+    return key
+
+
+def find_idempotency_key(key, scope: str, user_id: int):
+    if not key:
+        return None
+    return IdempotencyKey.query.filter_by(key=key, scope=scope, user_id=user_id).first()
+
+
+def claim_idempotency_key(key, scope: str, user_id: int):
+    # Insert the key inside the current transaction.
+    # Returns (record, None) if this request owns the key, or (None, existing) when
+    # the key was already used - the session is rolled back in that case.
+    if not key:
+        return None, None
+    record = IdempotencyKey(key=key, scope=scope, user_id=user_id, created_at=datetime.now())
+    db.session.add(record)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return None, find_idempotency_key(key, scope, user_id)
+    return record, None
+
+
+def purge_idempotency_keys(batch_size: int = None) -> int:
+    # Delete keys older than IDEMPOTENCY_KEY_HOURS, committing after each batch
+    # so the purge never holds the write lock for long.
+    if batch_size is None:
+        batch_size = current_app.config.get('MIGRATION_BATCH_SIZE', 500)
+    cutoff = datetime.now() - timedelta(hours=current_app.config['IDEMPOTENCY_KEY_HOURS'])
+    purged = 0
+    while True:
+        expired_ids = (
+            db.select(IdempotencyKey.id)
+            .where(IdempotencyKey.created_at < cutoff)
+            .limit(batch_size)
+            .scalar_subquery()
+        )
+        deleted = db.session.execute(
+            db.delete(IdempotencyKey)
+            .where(IdempotencyKey.id.in_(expired_ids))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        purged += deleted
+        if deleted < batch_size:
+            return purged
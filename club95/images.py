@@ -0,0 +1,234 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, url_for
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import Session
+
+from . import db
+from .caching import touch_events
+from .models import Event, EventImage, User
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; pages fall back to the original uploads
+    Image = ImageOps = None
+
+# Resized copies of uploaded images, so listings don't ship full-size posters.
+#
+# Uploads are still saved as-is under static/img. Once the upload's transaction
+# commits, a small worker pool writes WebP and JPEG copies at each width in
+# IMAGE_WIDTHS that is narrower than the original, under static/img/derived/, and
+# records the widths it made on the row ("320,640"; '' when the original is already
+# small). Templates build `srcset` from those widths (partials/images.html) and keep
+# the original as `src`, so a row that hasn't been processed yet - or an install
+# without Pillow - simply serves the original.
+#
+# Rows are matched by their stored filename rather than id, so a job for an image
+# that has since been replaced updates nothing.
+
+DERIVED_DIR = 'img/derived'
+DERIVED_FORMATS = (('webp', 'WEBP'), ('jpg', 'JPEG'))
+
+# what to update for each kind of upload: (filename column, widths column, folder under static)
+_TARGETS = {
+    'poster': (Event.image, Event.image_widths, 'img'),
+    'media': (EventImage.filename, EventImage.widths, 'img'),
+    'profile': (User.profilePicture, User.profilePictureWidths, ''),
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def parse_widths(widths) -> list:
+    # "320,640" -> [320, 640]
+    return [int(width) for width in (widths or '').split(',') if width.strip().isdigit()]
+
+
+def derived_filename(source: str, width: int, extension: str) -> str:
+    # Static path of one derivative, e.g. img/event_media/a.png -> img/derived/event_media/a-320.webp
+    relative = source[len('img/'):] if source.startswith('img/') else source
+    stem = os.path.splitext(relative)[0]
+    return f"{DERIVED_DIR}/{stem}-{width}.{extension}"
+
+
+def image_srcset(source: str, widths, extension: str) -> str:
+    # srcset attribute value for the derivatives of a static image, or '' if there are none.
+    return ', '.join(
+        f"{url_for('static', filename=derived_filename(source, width, extension))} {width}w"
+        for width in parse_widths(widths)
+    )
+
+
+def _static_path(relative: str) -> str:
+    return os.path.join(current_app.static_folder, *relative.split('/'))
+
+
+def _save_atomically(image, path: str, image_format: str, quality: int) -> None:
+    # Write next to the target and rename, so a half-written file is never served.
+    # The temporary name is unique because two jobs may be deriving the same file.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.derive-')
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            image.save(out, image_format, quality=quality)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def make_derivatives(source: str) -> list:
+    # Write the resized copies of one static image and return the widths made.
+    widths = sorted(current_app.config.get('IMAGE_WIDTHS', (320, 640, 1280)))
+    quality = current_app.config.get('IMAGE_QUALITY', 80)
+    with Image.open(_static_path(source)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # JPEG has no transparency; flatten onto white
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        made = []
+        for width in widths:
+            if width >= image.width:
+                break
+            targets = [
+                (_static_path(derived_filename(source, width, extension)), image_format)
+                for extension, image_format in DERIVED_FORMATS
+            ]
+            made.append(width)
+            # a stored file shared by several rows only needs resizing once
+            if all(os.path.exists(path) for path, _ in targets):
+                continue
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+            for path, image_format in targets:
+                _save_atomically(resized, path, image_format, quality)
+    return made
+
+
+def remove_derivatives(source: str, widths) -> None:
+    # Delete the files written by make_derivatives (missing files are ignored).
+    for width in parse_widths(widths):
+        for extension, _ in DERIVED_FORMATS:
+            try:
+                os.remove(_static_path(derived_filename(source, width, extension)))
+            except OSError:
+                pass
+
+
+def derive_and_record(kind: str, stored_name: str) -> list:
+    # Make the derivatives for one stored upload and record them on every row using it.
+    # Caller commits.
+    name_column, widths_column, folder = _TARGETS[kind]
+    source = f"{folder}/{stored_name}" if folder else stored_name
+    try:
+        widths = make_derivatives(source)
+    except Exception:
+        # unreadable or unsupported file: record no widths and keep serving the original
+        current_app.logger.warning("Could not make derivatives of %s", source, exc_info=True)
+        widths = []
+    model = name_column.class_
+    db.session.execute(
+        db.update(model)
+        .where(name_column == stored_name)
+        .values({widths_column: ','.join(str(width) for width in widths)})
+        .execution_options(synchronize_session=False)
+    )
+    # the pages showing these images now render differently
+    if kind == 'poster':
+        touch_events(*db.session.scalars(db.select(Event.id).where(Event.image == stored_name)))
+    elif kind == 'media':
+        touch_events(*db.session.scalars(db.select(EventImage.event_id).where(EventImage.filename == stored_name)))
+    return widths
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=max(1, current_app.config.get('IMAGE_WORKERS', 2)),
+                thread_name_prefix='club95-images',
+            )
+        return _pool
+
+
+def _run_job(app, kind: str, stored_name: str) -> None:
+    with app.app_context():
+        try:
+            derive_and_record(kind, stored_name)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Image derivatives for %s failed", stored_name)
+
+
+def queue_derivatives(kind: str, stored_name: str) -> None:
+    # Make derivatives of an upload in the background once the current transaction commits.
+    # `kind` is 'poster', 'media' or 'profile'; `stored_name` is the value saved on the row.
+    if Image is None or not stored_name or '://' in stored_name:
+        return
+    db.session.info.setdefault('pending_images', []).append((kind, stored_name))
+
+
+def queue_missing() -> int:
+    # Queue every upload that has never been through the pipeline for the background
+    # workers, e.g. the sample images of a freshly seeded database. Caller commits.
+    if Image is None:
+        return 0
+    queued = 0
+    for kind, (name_column, widths_column, _) in _TARGETS.items():
+        names = db.session.scalars(
+            db.select(name_column).distinct()
+            .where(name_column.is_not(None), name_column != '', widths_column.is_(None))
+        ).all()
+        for stored_name in names:
+            queue_derivatives(kind, stored_name)
+        queued += len(names)
+    return queued
+
+
+def derive_missing(batch_size: int = 100) -> int:
+    # Process every upload that has never been through the pipeline, in batches. Runs inline.
+    if Image is None:
+        return 0
+    processed = 0
+    for kind, (name_column, widths_column, _) in _TARGETS.items():
+        while True:
+            names = db.session.scalars(
+                db.select(name_column).distinct()
+                .where(name_column.is_not(None), name_column != '', widths_column.is_(None))
+                .limit(batch_size)
+            ).all()
+            if not names:
+                break
+            for stored_name in names:
+                derive_and_record(kind, stored_name)
+            db.session.commit()
+            processed += len(names)
+    return processed
+
+
+@sa_event.listens_for(Session, 'after_commit')
+def _submit_pending(session):
+    pending = session.info.pop('pending_images', None)
+    if not pending:
+        return
+    app = current_app._get_current_object()
+    executor = _executor()
+    for kind, stored_name in pending:
+        executor.submit(_run_job, app, kind, stored_name)
+
+
+@sa_event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('pending_images', None)
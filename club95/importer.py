@@ -0,0 +1,375 @@
+import codecs
+import csv
+import json
+import math
+import os
+from datetime import date, datetime
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import db
+from .caching import touch_events
+from .models import Artist, Event, EventArtist, EventType, Genre, Ticket, Venue, event_genre
+from .models import build_map_embed_url, parse_event_date, parse_event_time
+from .search import insert_documents
+
+# Bulk import of events from CSV or NDJSON.
+#
+# Rows are read one at a time from the file and validated the way the Create Event
+# form validates them; a bad row is reported with its line number and skipped, the
+# rest carry on. Valid rows are imported IMPORT_CHUNK_SIZE at a time, one
+# transaction per chunk: the chunk's artist, genre, venue and event type names are
+# looked up with one IN query each (names already seen by an earlier chunk come from
+# an in-memory map), missing artists, genres and venues are inserted together, and
+# the events, their lineups, genres and ticket tiers go in as multi-row INSERTs.
+# If a chunk still fails in the database its rows are retried one by one, so only
+# the offending rows are lost.
+#
+# Columns (CSV header names / NDJSON keys):
+#   title, date (YYYY-MM-DD)             required
+#   start_time, end_time (HH:MM), description, location, type
+#   genres    'Jazz|Blues'                 or a JSON list of names
+#   artists   'Band A@20:00|Band B'        or a JSON list of names / {"name", "set_time"}
+#   tickets   'GA:25:100|VIP:80:20:Perks'  or a JSON list of {"tier", "price", "quantity", "perks"}
+
+FORMATS = ('csv', 'ndjson')
+
+# list columns in CSV hold several values separated by this
+_LIST_SEPARATOR = '|'
+
+# names per IN query; well inside SQLite's bound parameter limit
+_LOOKUP_BATCH = 500
+
+
+class ImportRowError(ValueError):
+    pass
+
+
+def detect_format(filename):
+    # 'csv' / 'ndjson' from a file name, or None if the extension isn't one we read.
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.ndjson', '.jsonl', '.json'):
+        return 'ndjson'
+    return None
+
+
+def _read_rows(stream, fmt):
+    # Yield (line number, row dict or error message) from a binary stream.
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        if reader.fieldnames:
+            reader.fieldnames = [(name or '').strip().lower() for name in reader.fieldnames]
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, "not valid JSON."
+            continue
+        if not isinstance(row, dict):
+            yield line_number, "expected a JSON object."
+            continue
+        yield line_number, {str(key).strip().lower(): value for key, value in row.items()}
+
+
+def _text(row, key):
+    value = row.get(key)
+    return '' if value is None else str(value).strip()
+
+
+def _list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [part.strip() for part in str(value).split(_LIST_SEPARATOR) if part.strip()]
+
+
+def _parse_artists(value):
+    artists = []
+    seen = set()
+    for item in _list(value):
+        if isinstance(item, dict):
+            name = _text(item, 'name')
+            set_time = _text(item, 'set_time')
+        else:
+            name, _, set_time = str(item).partition('@')
+            name, set_time = name.strip(), set_time.strip()
+        if not name:
+            raise ImportRowError("every artist needs a name.")
+        if len(name) > 150:
+            raise ImportRowError(f"artist '{name[:20]}...' must be 150 characters or fewer.")
+        normalized_time = None
+        if set_time:
+            try:
+                normalized_time = datetime.strptime(set_time, "%H:%M").strftime("%H:%M")
+            except ValueError:
+                raise ImportRowError(f"set time for artist '{name}' must use 24hr format hh:mm.")
+        if name.lower() in seen:
+            raise ImportRowError(f"artist '{name}' is listed more than once.")
+        seen.add(name.lower())
+        artists.append((name, normalized_time))
+    return artists
+
+
+def _parse_tickets(value):
+    tickets = []
+    for item in _list(value):
+        if isinstance(item, dict):
+            tier, price, quantity, perks = (item.get(key) for key in ('tier', 'price', 'quantity', 'perks'))
+        else:
+            parts = str(item).split(':', 3)
+            if len(parts) < 3:
+                raise ImportRowError(f"ticket '{item}' must be written tier:price:quantity[:perks].")
+            tier, price, quantity = parts[:3]
+            perks = parts[3] if len(parts) > 3 else None
+        tier = '' if tier is None else str(tier).strip()
+        perks = '' if perks is None else str(perks).strip()
+        if not tier:
+            raise ImportRowError("every ticket tier needs a name.")
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            price = None
+        if price is None or not math.isfinite(price):
+            raise ImportRowError(f"ticket price for tier '{tier}' must be a number.")
+        try:
+            quantity = int(quantity)
+        except (TypeError, ValueError):
+            raise ImportRowError(f"ticket quantity for tier '{tier}' must be a whole number.")
+        if price < 0:
+            raise ImportRowError(f"ticket price for tier '{tier}' cannot be negative.")
+        if quantity < 1:
+            raise ImportRowError(f"ticket quantity for tier '{tier}' must be at least 1.")
+        if len(perks) > 120:
+            raise ImportRowError(f"ticket perks for tier '{tier}' must be 120 characters or fewer.")
+        tickets.append((tier, price, quantity, perks or None))
+    return tickets
+
+
+def _parse_row(row, today):
+    # Validate one raw row into the values needed to insert it.
+    title = _text(row, 'title')
+    if not title:
+        raise ImportRowError("title is required.")
+    if len(title) > 100:
+        raise ImportRowError("title must be 100 characters or fewer.")
+    event_date = parse_event_date(_text(row, 'date'))
+    if not event_date:
+        raise ImportRowError("date is required, as YYYY-MM-DD.")
+    if event_date < today:
+        raise ImportRowError("date is in the past.")
+    times = {}
+    for key in ('start_time', 'end_time'):
+        raw = _text(row, key)
+        times[key] = parse_event_time(raw) if raw else None
+        if raw and times[key] is None:
+            raise ImportRowError(f"{key} must use 24hr format hh:mm.")
+    genres = []
+    for name in _list(row.get('genres')):
+        name = str(name).strip()
+        if len(name) > 50:
+            raise ImportRowError(f"genre '{name[:20]}...' must be 50 characters or fewer.")
+        if name and name not in genres:
+            genres.append(name)
+    location = _text(row, 'location')
+    if len(location) > 150:
+        raise ImportRowError("location must be 150 characters or fewer.")
+    return {
+        'title': title,
+        'date': event_date,
+        'start_time': times['start_time'],
+        'end_time': times['end_time'],
+        'description': _text(row, 'description') or None,
+        'location': location,
+        'type': _text(row, 'type'),
+        'genres': genres,
+        'artists': _parse_artists(row.get('artists')),
+        'tickets': _parse_tickets(row.get('tickets')),
+    }
+
+
+class _Lookups:
+    # name -> id maps kept across chunks, so each name is queried at most once per import.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # ids created in a rolled-back transaction are gone, so forget everything
+        self.artists = {}
+        self.genres = {}
+        self.venues = {}
+        self.types = {
+            name.lower(): type_id
+            for type_id, name in db.session.execute(db.select(EventType.id, EventType.typeName))
+        }
+
+    def resolve(self, cache, column, names, make, ignore_case=False):
+        # Fill `cache` for every name: unknown names are queried in batches, the ones
+        # that don't exist yet are inserted with one executemany and read back.
+        key = str.lower if ignore_case else str
+        wanted = {}
+        for name in names:
+            if key(name) not in cache:
+                wanted.setdefault(key(name), name)
+        if not wanted:
+            return
+        model = column.class_
+        compare = func.lower(column) if ignore_case else column
+
+        def load(keys):
+            for start in range(0, len(keys), _LOOKUP_BATCH):
+                found = db.session.execute(
+                    db.select(model.id, column).where(compare.in_(keys[start:start + _LOOKUP_BATCH])).order_by(model.id)
+                )
+                for record_id, name in found:
+                    cache.setdefault(key(name), record_id)
+
+        load(list(wanted))
+        # flushing new ORM objects would insert them one at a time to read back each
+        # id, so they go in as plain rows and are looked up again instead
+        missing = [lookup for lookup in wanted if lookup not in cache]
+        if missing:
+            db.session.execute(model.__table__.insert(), [make(wanted[lookup]) for lookup in missing])
+            load(missing)
+
+
+def _import_chunk(rows, lookups, user_id):
+    # Insert one chunk of parsed rows; returns the new event ids. Caller commits.
+    lookups.resolve(
+        lookups.artists, Artist.artistName,
+        [name for row in rows for name, _ in row['artists']],
+        lambda name: {'artistName': name},
+    )
+    lookups.resolve(
+        lookups.genres, Genre.genreType,
+        [name for row in rows for name in row['genres']],
+        lambda name: {'genreType': name},
+    )
+    lookups.resolve(
+        lookups.venues, Venue.location,
+        [row['location'] for row in rows if row['location']],
+        lambda name: {'location': name, 'venueMap': build_map_embed_url(name)},
+        ignore_case=True,
+    )
+
+    # The events need their ids for the rows that point at them; the database hands
+    # them out and RETURNING reads them back in the order the rows were given. (SQLite
+    # can't promise that order for a multi-row INSERT, so there this runs row by row,
+    # still inside the chunk's one transaction.)
+    # Core inserts: the ORM's bulk insert splits the batch wherever an optional value is None
+    events = Event.__table__
+    event_ids = db.session.scalars(
+        events.insert().returning(events.c.id, sort_by_parameter_order=True),
+        [
+            {
+                'title': row['title'],
+                'status': 'OPEN',
+                'date': row['date'],
+                'description': row['description'],
+                'start_time': row['start_time'],
+                'end_time': row['end_time'],
+                'user_id': user_id,
+                'venue_id': lookups.venues.get(row['location'].lower()) if row['location'] else None,
+                'event_type_id': lookups.types.get(row['type'].lower()) if row['type'] else None,
+            }
+            for row in rows
+        ],
+    ).all()
+
+    genre_links, artist_links, tickets, documents = [], [], [], []
+    for event_id, row in zip(event_ids, rows):
+        genre_ids = {lookups.genres[name] for name in row['genres']}
+        genre_links.extend({'event_id': event_id, 'genre_id': genre_id} for genre_id in genre_ids)
+        artist_links.extend(
+            {'event_id': event_id, 'artist_id': lookups.artists[name], 'set_time': set_time}
+            for name, set_time in row['artists']
+        )
+        tickets.extend(
+            {'event_id': event_id, 'ticketTier': tier, 'price': price, 'availability': quantity, 'perks': perks}
+            for tier, price, quantity, perks in row['tickets']
+        )
+        documents.append({
+            'rowid': event_id,
+            'title': row['title'],
+            'description': row['description'] or '',
+            'date': str(row['date']),
+            'location': row['location'],
+            'genres': ' '.join(row['genres']),
+            'artists': ' '.join(name for name, _ in row['artists']),
+        })
+    if genre_links:
+        db.session.execute(event_genre.insert(), genre_links)
+    if artist_links:
+        db.session.execute(EventArtist.__table__.insert(), artist_links)
+    if tickets:
+        db.session.execute(Ticket.__table__.insert(), tickets)
+    insert_documents(documents)
+
+    touch_events(*event_ids)
+    return event_ids
+
+
+def import_events(stream, fmt, user_id, chunk_size=None, max_errors=100, today=None) -> dict:
+    # Import events from a binary CSV/NDJSON stream, owned by user_id.
+    # Returns counts and the first `max_errors` row errors as (line, message).
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown import format {fmt!r}; expected one of {', '.join(FORMATS)}.")
+    if chunk_size is None:
+        chunk_size = current_app.config.get('IMPORT_CHUNK_SIZE', 200)
+    today = today or date.today()
+    report = {'rows': 0, 'created': 0, 'failed': 0, 'errors': []}
+    lookups = _Lookups()
+
+    def fail(line_number, message):
+        report['failed'] += 1
+        if len(report['errors']) < max_errors:
+            report['errors'].append((line_number, message))
+
+    def flush(chunk):
+        try:
+            event_ids = _import_chunk([row for _, row in chunk], lookups, user_id)
+            db.session.commit()
+        except SQLAlchemyError as exc:
+            db.session.rollback()
+            lookups.reset()
+            if len(chunk) == 1:
+                fail(chunk[0][0], f"could not be saved ({exc.__class__.__name__}).")
+                return
+            # find the rows at fault; the others are saved on their own
+            for item in chunk:
+                flush([item])
+            return
+        # only counted once the chunk is committed, so a retried chunk isn't counted twice
+        report['created'] += len(event_ids)
+
+    chunk = []
+    for line_number, row in _read_rows(stream, fmt):
+        report['rows'] += 1
+        if isinstance(row, str):
+            fail(line_number, row)
+            continue
+        try:
+            parsed = _parse_row(row, today)
+            if parsed['type'] and parsed['type'].lower() not in lookups.types:
+                raise ImportRowError(f"unknown event type '{parsed['type']}'.")
+        except ImportRowError as exc:
+            fail(line_number, str(exc))
+            continue
+        chunk.append((line_number, parsed))
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    return report
@@ -0,0 +1,111 @@
+import json
+import queue
+import threading
+
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import Event, Ticket
+
+# Live ticket availability for open event pages (Server-Sent Events).
+#
+# Each open page holds one subscription: a one-slot queue in this process. When a
+# transaction that touched an event commits (touch_events() records the ids in
+# session.info), one snapshot of that event's tiers and status is read just
+# before the commit and pushed to every subscriber after it. A change costs one
+# query however many pages are watching, and nothing at all when nobody is.
+#
+# Subscriptions are per process; with several workers each one only hears about
+# changes committed by its own requests and jobs, and pages fall back to the
+# snapshot sent when they (re)connect.
+
+_subscribers = {}
+_subscribers_lock = threading.Lock()
+
+
+def subscribe(event_id: int):
+    # Returns the queue new snapshots for this event will be delivered to.
+    # Only the latest snapshot matters, so the queue holds one.
+    subscription = queue.Queue(maxsize=1)
+    with _subscribers_lock:
+        _subscribers.setdefault(event_id, set()).add(subscription)
+    return subscription
+
+
+def unsubscribe(event_id: int, subscription) -> None:
+    with _subscribers_lock:
+        watchers = _subscribers.get(event_id)
+        if watchers:
+            watchers.discard(subscription)
+            if not watchers:
+                del _subscribers[event_id]
+
+
+def _watched(event_ids) -> list:
+    with _subscribers_lock:
+        return [event_id for event_id in event_ids if event_id in _subscribers]
+
+
+def publish(event_id: int, payload: str) -> int:
+    # Hand a snapshot to every subscriber of the event; returns how many there were.
+    with _subscribers_lock:
+        watchers = list(_subscribers.get(event_id, ()))
+    for subscription in watchers:
+        # a slow client just skips to the newest snapshot
+        try:
+            subscription.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            subscription.put_nowait(payload)
+        except queue.Full:
+            pass
+    return len(watchers)
+
+
+def availability_snapshots(event_ids, session=None) -> dict:
+    # {event_id: JSON payload} with each event's status and remaining tickets per tier.
+    if not event_ids:
+        return {}
+    session = session or db.session
+    statuses = session.execute(
+        db.select(Event.id, Event.effective_status).where(Event.id.in_(event_ids))
+    ).all()
+    tiers = session.execute(
+        db.select(Ticket.event_id, Ticket.id, Ticket.ticketTier, Ticket.availability)
+        .where(Ticket.event_id.in_(event_ids))
+        .order_by(Ticket.id)
+    ).all()
+    snapshots = {}
+    for event_id, status in statuses:
+        snapshots[event_id] = {'event_id': event_id, 'status': status, 'tiers': []}
+    for event_id, ticket_id, tier, availability in tiers:
+        if event_id in snapshots:
+            snapshots[event_id]['tiers'].append(
+                {'id': ticket_id, 'tier': tier, 'availability': max(0, availability or 0)}
+            )
+    return {event_id: json.dumps(snapshot) for event_id, snapshot in snapshots.items()}
+
+
+@sa_event.listens_for(Session, 'before_commit')
+def _snapshot_changed_events(session):
+    # Read the snapshots inside the committing transaction, only for watched events.
+    changed = session.info.pop('changed_events', None)
+    if not changed:
+        return
+    watched = _watched(changed)
+    if watched:
+        session.info['live_snapshots'] = availability_snapshots(watched, session)
+
+
+@sa_event.listens_for(Session, 'after_commit')
+def _publish_snapshots(session):
+    for event_id, payload in session.info.pop('live_snapshots', {}).items():
+        publish(event_id, payload)
+
+
+@sa_event.listens_for(Session, 'after_rollback')
+def _discard_snapshots(session):
+    session.info.pop('changed_events', None)
+    session.info.pop('live_snapshots', None)
@@ -0,0 +1,254 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert
+from werkzeug.utils import secure_filename
+
+from . import db
+from .images import remove_derivatives
+from .models import Event, EventImage, MediaFile, User
+from .uploads import check_upload_size
+
+# Content-addressed store for uploaded images.
+#
+# An upload is streamed into a temporary file while it is hashed, then renamed to
+# static/img/media/<aa>/<bb>/<sha256>.<ext>, where aa/bb are the first two byte
+# pairs of the hash (so no directory grows past a few hundred entries). The same
+# picture uploaded twice - by two users, or as two events' posters - is stored
+# once, and two different files can never overwrite each other.
+#
+# Each stored file has a media_files row whose ref_count counts the
+# Event.image / EventImage.filename / User.profilePicture values using it.
+# save_media() adds a reference and release_media() drops one, in the caller's
+# transaction. Files whose count reaches zero stay on disk until collect_orphans()
+# (`flask gc-media`) removes them, outside any request.
+
+MEDIA_DIR = 'media'
+_CHUNK_SIZE = 64 * 1024
+
+
+def _img_root() -> str:
+    return os.path.join(current_app.static_folder, 'img')
+
+
+def media_path(name: str) -> str:
+    # Absolute path of a name stored on a row (relative to static/img).
+    return os.path.join(_img_root(), *name.split('/'))
+
+
+def is_stored_media(name: str) -> bool:
+    return bool(name) and name.startswith(f"{MEDIA_DIR}/")
+
+
+def _store(file_storage) -> tuple:
+    # Stream the upload to disk through sha256; returns (name, size).
+    # The file is normally already spooled by the request parser, which enforced the
+    # per-file limit; the limit is checked again here for files that came another way.
+    extension = os.path.splitext(secure_filename(file_storage.filename or ''))[1].lower()
+    root = os.path.join(_img_root(), MEDIA_DIR)
+    os.makedirs(root, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    handle, temporary = tempfile.mkstemp(dir=root, prefix='.upload-')
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            while True:
+                chunk = file_storage.stream.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                check_upload_size(file_storage.filename, size)
+                digest.update(chunk)
+                out.write(chunk)
+
+        key = digest.hexdigest()
+        name = f"{MEDIA_DIR}/{key[:2]}/{key[2:4]}/{key}{extension}"
+        destination = media_path(name)
+        try:
+            # Already stored? Touching it keeps the collector's grace period from
+            # expiring under us; identical bytes, so the copy just written can go.
+            os.utime(destination)
+        except FileNotFoundError:
+            # new, or collected just now (the collector renames before it looks at the time)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(temporary, destination)
+        else:
+            os.remove(temporary)
+        return name, size
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def add_reference(name: str, size: int = 0) -> None:
+    # Count one more row using a stored file. Caller commits.
+    db.session.execute(
+        insert(MediaFile)
+        .values(path=name, size=size, ref_count=1, created_at=datetime.now())
+        .on_conflict_do_update(
+            index_elements=[MediaFile.path],
+            set_={'ref_count': MediaFile.ref_count + 1},
+        )
+    )
+
+
+def save_media(file_storage) -> str:
+    # Store an upload (or find the identical file already stored), add a reference
+    # to it and return the name to save on the row, relative to static/img.
+    # Caller commits.
+    name, size = _store(file_storage)
+    add_reference(name, size)
+    return name
+
+
+def release_media(name: str) -> None:
+    # A row stopped using `name`. Caller commits.
+    # The file itself is left for collect_orphans(), which also handles uploads
+    # from before the media store.
+    if is_stored_media(name):
+        db.session.execute(
+            db.update(MediaFile)
+            .where(MediaFile.path == name, MediaFile.ref_count > 0)
+            .values(ref_count=MediaFile.ref_count - 1)
+            .execution_options(synchronize_session=False)
+        )
+
+
+# Where uploads live under static/img. Everything else there is the site's own
+# artwork, which no row references, so the collector never looks at it.
+# Legacy poster uploads from update_event sit in img/ itself as event_<id>_<timestamp>_<name>.
+_UPLOAD_DIRS = (MEDIA_DIR, 'event_media')
+_LEGACY_POSTER = re.compile(r'^event_\d+_\d+_')
+
+
+def _walk_files(directory: str, relative: str):
+    # Yield (relative name, DirEntry) for every file below `directory`, depth first.
+    # One open scandir per level, so memory stays flat however many files there are.
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            name = f"{relative}/{entry.name}" if relative else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_files(entry.path, name)
+            elif entry.is_file(follow_symlinks=False):
+                yield name, entry
+
+
+def _upload_files():
+    root = _img_root()
+    for folder in _UPLOAD_DIRS:
+        yield from _walk_files(os.path.join(root, folder), folder)
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and _LEGACY_POSTER.match(entry.name):
+                yield entry.name, entry
+
+
+def _referenced(names) -> set:
+    # Which of these names (relative to static/img) any row still uses, in four queries.
+    referenced = set(db.session.scalars(db.select(Event.image).where(Event.image.in_(names))))
+    referenced.update(db.session.scalars(db.select(EventImage.filename).where(EventImage.filename.in_(names))))
+    referenced.update(
+        name[len('img/'):] for name in db.session.scalars(
+            db.select(User.profilePicture).where(User.profilePicture.in_([f"img/{name}" for name in names]))
+        )
+    )
+    # a positive count may belong to an upload that hasn't committed its row yet
+    referenced.update(db.session.scalars(
+        db.select(MediaFile.path).where(MediaFile.path.in_(names), MediaFile.ref_count > 0)
+    ))
+    return referenced
+
+
+def _collect(name: str, quarantine_dir, cutoff: float) -> bool:
+    # Remove one orphan (or move it under quarantine_dir), with its resized copies.
+    # Returns False if the file turned out to be in use after all.
+    #
+    # The row is deleted first, and its write transaction stays open (so no upload can
+    # add a reference) until the file is gone. The file is renamed out of the way
+    # before its time is read one last time: an identical upload that touched it
+    # before the rename shows up as a recent mtime and the file is put back, and one
+    # that comes after finds nothing to touch and stores its own copy.
+    if is_stored_media(name):
+        db.session.execute(db.delete(MediaFile).where(MediaFile.path == name, MediaFile.ref_count == 0))
+        if db.session.scalar(db.select(MediaFile.id).where(MediaFile.path == name)):
+            # referenced again since the batch was checked
+            db.session.rollback()
+            return False
+    path = media_path(name)
+    claimed = os.path.join(os.path.dirname(path), f".collect-{os.path.basename(path)}")
+    try:
+        os.rename(path, claimed)
+        if os.stat(claimed).st_mtime > cutoff:
+            os.replace(claimed, path)
+            db.session.rollback()
+            return False
+        if quarantine_dir:
+            destination = os.path.join(quarantine_dir, *name.split('/'))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.move(claimed, destination)
+        else:
+            os.remove(claimed)
+    except BaseException:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    remove_derivatives(f"img/{name}", ','.join(str(width) for width in current_app.config.get('IMAGE_WIDTHS', ())))
+    return True
+
+
+def collect_orphans(grace_hours=None, batch_size=500, dry_run=False, quarantine_dir=None, echo=None) -> dict:
+    # Delete (or quarantine) uploaded files no row references that are older than
+    # grace_hours. Files are streamed from disk and checked against the database one
+    # batch at a time. With dry_run nothing changes; each orphan is reported through
+    # `echo` (e.g. click.echo) either way. Returns counts for the report.
+    if grace_hours is None:
+        grace_hours = current_app.config.get('MEDIA_GC_GRACE_HOURS', 24)
+    report = {'scanned': 0, 'referenced': 0, 'recent': 0, 'orphaned': 0, 'bytes': 0}
+
+    def process(batch):
+        referenced = _referenced([name for name, _ in batch])
+        cutoff = time.time() - grace_hours * 3600
+        for name, entry in batch:
+            report['scanned'] += 1
+            if name in referenced:
+                report['referenced'] += 1
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                # re-read just before removing: an identical upload touches the file
+                if stat.st_mtime > cutoff or os.stat(entry.path).st_mtime > cutoff:
+                    report['recent'] += 1
+                    continue
+                if not dry_run and not _collect(name, quarantine_dir, cutoff):
+                    report['referenced'] += 1
+                    continue
+            except FileNotFoundError:
+                continue
+            report['orphaned'] += 1
+            report['bytes'] += stat.st_size
+            if echo:
+                echo(f"{'Would remove' if dry_run else 'Quarantined' if quarantine_dir else 'Removed'} {name}")
+
+    batch = []
+    for item in _upload_files():
+        batch.append(item)
+        if len(batch) >= batch_size:
+            process(batch)
+            batch = []
+    if batch:
+        process(batch)
+    return report
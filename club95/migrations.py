@@ -0,0 +1,231 @@
+from flask import current_app
+from sqlalchemy import inspect, text
+
+from . import db
+from .models import parse_event_date, parse_event_time
+from .search import ensure_search_index
+
+# Versioned upgrades for databases created by older versions of the app.
+#
+# The schema version lives in SQLite's `PRAGMA user_version` header field, so it
+# travels with the database file. Fresh databases are built by db.create_all()
+# and stamped with the latest version straight away; existing ones run every
+# migration newer than their stamp, in order, recording each version as it lands.
+#
+# Migrations must be safe to re-run (a crash between a migration finishing and its
+# version being recorded just repeats it) and should commit in batches of
+# `batch_size` rows so a big backfill never holds SQLite's write lock for long.
+
+# Text layouts SQLAlchemy's SQLite Date/Time types write and expect to read back
+_DATE_GLOB = '[0-9][0-9][0-9][0-9]-[0-1][0-9]-[0-3][0-9]'
+_TIME_GLOB = '[0-2][0-9]:[0-5][0-9]:[0-5][0-9].[0-9][0-9][0-9][0-9][0-9][0-9]'
+
+# Stand-in for event dates that can't be read at all (events.date is NOT NULL)
+_UNREADABLE_DATE = '1970-01-01'
+
+
+def current_version() -> int:
+    return db.session.execute(text("PRAGMA user_version")).scalar() or 0
+
+
+def _record_version(version: int) -> None:
+    # PRAGMA values can't be bound parameters; int() keeps this injection-safe
+    db.session.execute(text(f"PRAGMA user_version = {int(version)}"))
+    db.session.commit()
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def pending_migrations() -> list:
+    version = current_version()
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+
+def missing_tables() -> list:
+    # Model tables an older database doesn't have yet (upgrade_database creates them).
+    existing = set(inspect(db.engine).get_table_names())
+    return [table.name for table in db.metadata.sorted_tables if table.name not in existing]
+
+
+def stamp_latest_version() -> None:
+    # Mark a database built by create_all() as already up to date.
+    _record_version(latest_version())
+
+
+def upgrade_database(batch_size: int = None, echo=None) -> list:
+    # Apply every pending migration in order and return the versions applied.
+    # `echo` is an optional callable used to report progress (e.g. click.echo).
+    if batch_size is None:
+        batch_size = current_app.config.get('MIGRATION_BATCH_SIZE', 500)
+
+    # Tables added since the database was created; existing tables are untouched
+    db.create_all()
+
+    applied = []
+    for version, description, migrate in pending_migrations():
+        if echo:
+            echo(f"Applying migration {version}: {description}")
+        migrate(batch_size)
+        _record_version(version)
+        applied.append(version)
+    return applied
+
+
+def create_missing_indexes(batch_size: int = 500) -> list:
+    # create_all() only builds indexes alongside new tables, so add any index
+    # declared on the models that an older database doesn't have yet.
+    inspector = inspect(db.engine)
+    # read names straight from sqlite_master; the inspector skips expression indexes
+    existing = set(db.session.scalars(text("SELECT name FROM sqlite_master WHERE type = 'index'")))
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.session.connection())
+                created.append(index.name)
+    db.session.commit()
+    return created
+
+
+def _add_column(table_name: str, column_name: str, definition: str) -> bool:
+    # ALTER TABLE ... ADD COLUMN, skipped when the column already exists.
+    existing = {row.name for row in db.session.execute(text(f"PRAGMA table_info({table_name})"))}
+    if column_name in existing:
+        return False
+    db.session.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {definition}"))
+    db.session.commit()
+    return True
+
+
+def add_event_queue_flag(batch_size: int = 500) -> bool:
+    # New events.queue_enabled column; existing events default to no waiting room.
+    return _add_column('events', 'queue_enabled', 'BOOLEAN NOT NULL DEFAULT 0')
+
+
+def add_event_cancelled_flag(batch_size: int = 500) -> int:
+    # New events.cancelled column, backfilled from the stored status in batches.
+    _add_column('events', 'cancelled', 'BOOLEAN NOT NULL DEFAULT 0')
+    mark_batch = text(
+        "UPDATE events SET cancelled = 1 WHERE id IN ("
+        "  SELECT id FROM events"
+        "  WHERE cancelled = 0 AND upper(trim(status)) = 'CANCELLED'"
+        "  LIMIT :batch_size"
+        ")"
+    )
+    marked = 0
+    while True:
+        updated = db.session.execute(mark_batch, {'batch_size': batch_size}).rowcount
+        db.session.commit()
+        marked += updated
+        if updated < batch_size:
+            return marked
+
+
+def add_event_comment_count(batch_size: int = 500) -> int:
+    # New events.comment_count column, backfilled one batch of events at a time.
+    _add_column('events', 'comment_count', 'INTEGER NOT NULL DEFAULT 0')
+    count_batch = text(
+        "UPDATE events SET comment_count = ("
+        "  SELECT count(*) FROM comments WHERE comments.event_id = events.id"
+        ") WHERE id > :last_id AND id <= :last_id + :batch_size"
+    )
+    max_id = db.session.execute(text("SELECT max(id) FROM events")).scalar() or 0
+    last_id = 0
+    while last_id < max_id:
+        db.session.execute(count_batch, {'last_id': last_id, 'batch_size': batch_size})
+        db.session.commit()
+        last_id += batch_size
+    return max_id
+
+
+def add_event_revisions(batch_size: int = 500) -> bool:
+    # New events.revision / events.updated_at columns for conditional GETs.
+    # (the catalogue_revision table itself comes from create_all)
+    added = _add_column('events', 'revision', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column('events', 'updated_at', 'DATETIME')
+    return added
+
+
+def add_image_widths(batch_size: int = 500) -> bool:
+    # New columns recording the resized copies of uploaded images.
+    # Existing uploads stay NULL until `flask derive-images` processes them.
+    added = _add_column('events', 'image_widths', 'VARCHAR(64)')
+    _add_column('event_images', 'widths', 'VARCHAR(64)')
+    _add_column('users', 'profilePictureWidths', 'VARCHAR(64)')
+    return added
+
+
+def _stored_time(value):
+    parsed = parse_event_time(value)
+    return parsed.strftime('%H:%M:%S.%f') if parsed else None
+
+
+def backfill_event_schedule(batch_size: int = 500) -> int:
+    # Rewrite legacy text dates/times ('2025-11-16', '19:00', '24:00') into the
+    # storage format of the typed Date/Time columns, one short transaction per batch.
+    # Only rows that don't already match the typed layout are selected, so this is
+    # a cheap no-op once the data has been converted.
+    select_batch = text(
+        "SELECT id, date, start_time, end_time FROM events "
+        "WHERE id > :last_id AND ("
+        "  date NOT GLOB :date_glob"
+        "  OR (start_time IS NOT NULL AND start_time NOT GLOB :time_glob)"
+        "  OR (end_time IS NOT NULL AND end_time NOT GLOB :time_glob)"
+        ") ORDER BY id LIMIT :batch_size"
+    )
+    update_row = text(
+        "UPDATE events SET date = :date, start_time = :start_time, end_time = :end_time "
+        "WHERE id = :id"
+    )
+
+    converted = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(select_batch, {
+            'last_id': last_id,
+            'date_glob': _DATE_GLOB,
+            'time_glob': _TIME_GLOB,
+            'batch_size': batch_size,
+        }).all()
+        if not rows:
+            break
+
+        updates = []
+        for row in rows:
+            parsed_date = parse_event_date(row.date)
+            if parsed_date is None:
+                current_app.logger.warning(
+                    "Event %s: unreadable date %r, setting it to %s", row.id, row.date, _UNREADABLE_DATE
+                )
+            updates.append({
+                'id': row.id,
+                'date': parsed_date.isoformat() if parsed_date else _UNREADABLE_DATE,
+                'start_time': _stored_time(row.start_time),
+                'end_time': _stored_time(row.end_time),
+            })
+
+        db.session.execute(update_row, updates)
+        # Commit per batch so a large backfill never holds the write lock for long
+        db.session.commit()
+        converted += len(updates)
+        last_id = rows[-1].id
+
+    return converted
+
+
+# Ordered list of (version, description, migration). Append new entries; never
+# renumber or remove old ones, since deployed databases record these versions.
+MIGRATIONS = [
+    (1, 'Typed event date/time columns', backfill_event_schedule),
+    (2, 'Secondary indexes on foreign keys and filter columns', create_missing_indexes),
+    (3, 'Full-text search index for events', ensure_search_index),
+    (4, 'Waiting room flag on events', add_event_queue_flag),
+    (5, 'Cancelled flag on events', add_event_cancelled_flag),
+    (6, 'Comment count on events', add_event_comment_count),
+    (7, 'Revision counters for conditional GET', add_event_revisions),
+    (8, 'Resized image widths', add_image_widths),
+]
@@ -1,6 +1,10 @@
+from datetime import date, datetime, time
 from flask_login import UserMixin
 from . import db
+from sqlalchemy import func
 from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.ext.hybrid import hybrid_property
+from urllib.parse import quote_plus
 
 
 
@@ -22,6 +26,8 @@ class User(db.Model, UserMixin):
     streetAddress = db.Column(db.String(200), nullable=True)
     bio = db.Column(db.Text(300), nullable=True)
     profilePicture = db.Column(db.String(200), nullable=True)
+    # widths of the resized copies of the profile picture (see images.py)
+    profilePictureWidths = db.Column(db.String(64), nullable=True)
     # relationship to events - one to many 
     events = db.relationship('Event', backref='user')
     # relationship to comments - one to many
@@ -63,20 +69,35 @@ class Event(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     genres = db.relationship('Genre', secondary=event_genre, backref='events')
-    status = db.Column(db.String(20), nullable=False)
-    date = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False, index=True)
+    date = db.Column(db.Date, nullable=False, index=True)
     description = db.Column(db.Text, nullable=True)
     image = db.Column(db.String(200), nullable=True)
+    # widths of the resized copies of the poster, e.g. "320,640" (see images.py)
+    image_widths = db.Column(db.String(64), nullable=True)
 
-    start_time = db.Column(db.String(10), nullable=True)
-    end_time = db.Column(db.String(10), nullable=True)
+    start_time = db.Column(db.Time, nullable=True)
+    end_time = db.Column(db.Time, nullable=True)
+
+    # bumped whenever anything shown on the event page changes (see caching.py)
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    # number of comments, kept up to date by add_comment so listings don't have to count
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # set when the organiser cancels the event; effective_status reports CANCELLED
+    cancelled = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+
+    # send buyers through the waiting room (club95/waiting_room.py) before they can buy tickets
+    queue_enabled = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
 
     # relationship to event images - so that events can have multiple images
     images = db.relationship("EventImage", back_populates="event", cascade="all, delete-orphan")
 
     # link event to user - many to one 
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    venue_id = db.Column(db.Integer, db.ForeignKey('venues.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    venue_id = db.Column(db.Integer, db.ForeignKey('venues.id'), index=True)
     # link event to tickets - one to many
     tickets = db.relationship('Ticket', backref='event')
     # relationship to comments - one to many
@@ -89,12 +110,84 @@ class Event(db.Model):
         creator=lambda artist: EventArtist(artist=artist)
     )
     # link event to event type - many to one
-    event_type_id = db.Column(db.Integer, db.ForeignKey('event_types.id'), nullable=True)
-    
+    event_type_id = db.Column(db.Integer, db.ForeignKey('event_types.id'), nullable=True, index=True)
+
+    # The status buyers see, worked out from the event's data rather than read from
+    # the stored `status` column, so it can never be stale:
+    #   past date            -> INACTIVE
+    #   cancelled            -> CANCELLED
+    #   no tickets remaining -> SOLD OUT
+    #   closed by organiser  -> INACTIVE (stored status INACTIVE)
+    #   otherwise            -> OPEN
+    # Works on loaded events (Python) and in queries (SQL CASE), so filters and sorts
+    # can use Event.effective_status directly.
+    @hybrid_property
+    def effective_status(self):
+        if self.date and self.date < date.today():
+            return 'INACTIVE'
+        if self.cancelled:
+            return 'CANCELLED'
+        if sum(max(0, ticket.availability or 0) for ticket in self.tickets) <= 0:
+            return 'SOLD OUT'
+        if (self.status or '').strip().upper() == 'INACTIVE':
+            return 'INACTIVE'
+        return 'OPEN'
+
+    @effective_status.inplace.expression
+    @classmethod
+    def _effective_status_expression(cls):
+        remaining = (
+            db.select(func.coalesce(func.sum(func.max(Ticket.availability, 0)), 0))
+            .where(Ticket.event_id == cls.id)
+            .correlate_except(Ticket)
+            .scalar_subquery()
+        )
+        return db.case(
+            (cls.date < date.today(), 'INACTIVE'),
+            (cls.cancelled, 'CANCELLED'),
+            (remaining <= 0, 'SOLD OUT'),
+            (func.upper(func.trim(cls.status)) == 'INACTIVE', 'INACTIVE'),
+            else_='OPEN',
+        )
 
     def __repr__(self):
         return f"<Event {self.title}>"
 
+# Helpers for turning form/seed text into values for the typed schedule columns
+def parse_event_date(value):
+    # Accept a date or 'YYYY-MM-DD' text; return None if it can't be read.
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime((value or '').strip(), "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+def parse_event_time(value):
+    # Accept a time or 'HH:MM' / 'HH:MM:SS' text; return None if it can't be read.
+    if isinstance(value, time):
+        return value
+    cleaned = (value or '').strip()
+    # "24:00" was used for events that run until midnight; TIME stops at 23:59:59
+    if cleaned.startswith('24:00'):
+        return time(23, 59)
+    for fmt in ("%H:%M", "%H:%M:%S", "%H:%M:%S.%f"):
+        try:
+            return datetime.strptime(cleaned, fmt).time()
+        except ValueError:
+            continue
+    return None
+
+def build_map_embed_url(address: str) -> str:
+    # Google Maps embed URL for a venue address ('' when there is no address).
+    cleaned = (address or '').strip()
+    if not cleaned:
+        return ''
+    query = quote_plus(cleaned)
+    return f"https://www.google.com/maps?q={query}&output=embed"
+
 class EventType(db.Model):
     __tablename__ = 'event_types'
     id = db.Column(db.Integer, primary_key=True)
@@ -109,6 +202,10 @@ class EventType(db.Model):
 class Comment(db.Model):
     # define the name of the table in the database
     __tablename__ = 'comments'
+    # event pages list comments newest first, so index them in that order per event
+    __table_args__ = (
+        db.Index('ix_comments_event_id_commentDateTime', 'event_id', 'commentDateTime'),
+    )
     # define the columns of the table
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text(300))
@@ -123,7 +220,8 @@ class Comment(db.Model):
 class OrderTicket(db.Model):
     __tablename__ = 'order_ticket'
     order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), primary_key=True)
-    ticket_id = db.Column(db.Integer, db.ForeignKey('tickets.id'), primary_key=True)
+    # the primary key starts with order_id, so ticket lookups need their own index
+    ticket_id = db.Column(db.Integer, db.ForeignKey('tickets.id'), primary_key=True, index=True)
     quantity = db.Column(db.Integer, nullable=False, default=1)
     price_at_purchase = db.Column(db.Float, nullable=False)
     # orders to tickets relationships defined below
@@ -135,7 +233,7 @@ class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     order_date = db.Column(db.DateTime)
     amount = db.Column(db.Float)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     tickets = db.relationship(
         'Ticket',
         secondary='order_ticket',
@@ -159,7 +257,7 @@ class Ticket(db.Model):
     price = db.Column(db.Float, nullable=False)
     availability = db.Column(db.Integer, default=1, nullable=False)
     perks = db.Column(db.String(120), nullable=True)
-    event_id = db.Column(db.Integer, db.ForeignKey('events.id'))
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), index=True)
     orders = db.relationship(
         'Order',
         secondary='order_ticket',
@@ -176,6 +274,134 @@ class Ticket(db.Model):
     def __repr__(self):
         return f"<Ticket {self.ticketTier} (${self.price}) x{self.availability}"
 
+class TicketHold(db.Model):
+    # A short-lived cart reservation. The quantity has already been taken off
+    # ticket.availability; confirming turns the hold into an Order, and an expired
+    # hold is handed back to the tier by the sweeper (see reservations.py).
+    __tablename__ = 'ticket_holds'
+    id = db.Column(db.Integer, primary_key=True)
+    # every tier picked in one checkout shares a token
+    token = db.Column(db.String(36), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
+    ticket_id = db.Column(db.Integer, db.ForeignKey('tickets.id'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    price_at_hold = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    # the sweeper looks holds up by expiry time
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    ticket = db.relationship('Ticket')
+    event = db.relationship('Event')
+
+    def __repr__(self):
+        return f"<TicketHold {self.token} ticket={self.ticket_id} x{self.quantity}>"
+
+class QueueGate(db.Model):
+    # Waiting room state for one queue-enabled event, shared by every worker process
+    # (see waiting_room.py): numbers handed out, numbers let through so far, and the
+    # token bucket that paces admissions.
+    __tablename__ = 'queue_gates'
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), primary_key=True)
+    # identifies this gate in visitors' sessions, so numbers from an older gate are ignored
+    epoch = db.Column(db.String(16), nullable=False)
+    issued = db.Column(db.Integer, nullable=False, default=0)
+    serving = db.Column(db.Integer, nullable=False, default=0)
+    tokens = db.Column(db.Float, nullable=False)
+    # Unix time of the last refill (wall clock, so every process agrees on it)
+    updated = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f"<QueueGate event={self.event_id} {self.serving}/{self.issued}>"
+
+class RefundJob(db.Model):
+    # Removal of a ticket tier that has buyers: every order line for the tier is
+    # refunded (see refunds.py), then the tier is deleted. Small tiers are done inside
+    # the edit request; large ones are worked through in batches in the background.
+    __tablename__ = 'refund_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False, index=True)
+    # no foreign key: the tier is deleted when the job finishes
+    ticket_id = db.Column(db.Integer, nullable=False)
+    ticket_tier = db.Column(db.String(100), nullable=False)
+    # PENDING -> RUNNING -> DONE
+    status = db.Column(db.String(10), nullable=False, default='PENDING', index=True)
+    total_orders = db.Column(db.Integer, nullable=False, default=0)
+    processed_orders = db.Column(db.Integer, nullable=False, default=0)
+    refund_total = db.Column(db.Float, nullable=False, default=0.0)
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # a worker owns the job until then, so two processes never refund the same batch
+    claimed_until = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<RefundJob {self.ticket_tier} {self.processed_orders}/{self.total_orders} {self.status}>"
+
+class Refund(db.Model):
+    # Ledger of money owed back to buyers: one row per order line refunded.
+    # Orders left empty by a refund are deleted, so order_id is kept without a foreign key.
+    __tablename__ = 'refunds'
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False, index=True)
+    ticket_id = db.Column(db.Integer, nullable=False)
+    ticket_tier = db.Column(db.String(100), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    # the background job that issued it, if any
+    job_id = db.Column(db.Integer, db.ForeignKey('refund_jobs.id'), nullable=True)
+
+    def __repr__(self):
+        return f"<Refund order={self.order_id} ${self.amount:.2f}>"
+
+class CatalogueRevision(db.Model):
+    # Single-row table: a revision counter for the public listings as a whole.
+    # Any change to an event, its tickets or comments, or the genre list bumps it (see caching.py).
+    __tablename__ = 'catalogue_revision'
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<CatalogueRevision {self.revision}>"
+
+class IdempotencyKey(db.Model):
+    # Remembers the outcome of a POST that clients may retry (see idempotency.py).
+    # A retry with the same key is sent to the stored result instead of running again.
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'scope', 'key', name='uq_idempotency_keys_user_scope_key'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), nullable=False)
+    # which action the key belongs to, e.g. 'purchase' or 'confirm'
+    scope = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # where the original request redirected to
+    result_url = db.Column(db.String(255), nullable=True)
+    # old keys are purged by creation time
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.scope}:{self.key} user={self.user_id}>"
+
+class MediaFile(db.Model):
+    # One uploaded file in the content-addressed media store (see media.py).
+    # ref_count is the number of Event.image, EventImage.filename and
+    # User.profilePicture values pointing at it.
+    __tablename__ = 'media_files'
+    id = db.Column(db.Integer, primary_key=True)
+    # path under static/img, e.g. media/3f/a2/3fa2...c1.jpg
+    path = db.Column(db.String(255), unique=True, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<MediaFile {self.path} refs={self.ref_count}>"
+
 class Genre(db.Model):
     # define the name of the table in the database
     __tablename__ = 'genres'
@@ -221,12 +447,18 @@ class Venue(db.Model):
 
     def __repr__(self):
         return f"<Venue {self.location}>"
+
+# venue lookups match on lower(location), so index that expression rather than the raw column
+db.Index('ix_venues_location_lower', func.lower(Venue.location))
+
 class EventImage(db.Model):
     __tablename__ = "event_images"
     id = db.Column(db.Integer, primary_key=True)
-    event_id = db.Column(db.Integer, db.ForeignKey("events.id"), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey("events.id"), nullable=False, index=True)
     filename = db.Column(db.String(255), nullable=False)
     order_index = db.Column(db.Integer, nullable=True)
+    # widths of the resized copies of the image (see images.py)
+    widths = db.Column(db.String(64), nullable=True)
 
     event = db.relationship("Event", back_populates="images")
 
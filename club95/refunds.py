@@ -0,0 +1,225 @@
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+
+from . import db
+from .caching import touch_events
+from .models import Order, OrderTicket, Refund, RefundJob, Ticket, TicketHold
+
+# Refunds for ticket tiers removed from an event.
+#
+# Removing a tier refunds every order line for it with a handful of set-based
+# statements per batch of orders: the lines are copied into the `refunds` ledger,
+# each order's amount is reduced by its line, the lines are deleted, and orders
+# left with no lines are deleted. A tier with up to REFUND_INLINE_ORDERS buyers is
+# refunded inside the edit request. A bigger one is taken off sale and handed to a
+# RefundJob, which the background worker processes REFUND_BATCH_SIZE orders per
+# transaction so the write lock is only ever held briefly; My Events shows its
+# progress. The tier itself is deleted once no order lines point at it.
+
+# how long a worker owns a job before another process may pick it up
+_CLAIM_SECONDS = 300
+
+
+def _order_count(ticket_id: int) -> int:
+    return db.session.scalar(
+        db.select(func.count()).select_from(OrderTicket).where(OrderTicket.ticket_id == ticket_id)
+    )
+
+
+def _refund_batch(ticket_id: int, ticket_tier: str, event_id: int, limit: int, job_id=None) -> tuple:
+    # Refund the first `limit` orders holding this tier; returns (orders, amount). Caller commits.
+    order_ids = db.session.scalars(
+        db.select(OrderTicket.order_id)
+        .where(OrderTicket.ticket_id == ticket_id)
+        .order_by(OrderTicket.order_id)
+        .limit(limit)
+    ).all()
+    if not order_ids:
+        return 0, 0.0
+
+    in_batch = (OrderTicket.ticket_id == ticket_id) & OrderTicket.order_id.in_(order_ids)
+    line_amount = func.coalesce(OrderTicket.price_at_purchase, 0.0) * func.coalesce(OrderTicket.quantity, 0)
+    now = datetime.now()
+
+    amount = db.session.scalar(db.select(func.coalesce(func.sum(line_amount), 0.0)).where(in_batch))
+
+    # one ledger row per refunded order line
+    db.session.execute(
+        db.insert(Refund).from_select(
+            ['order_id', 'user_id', 'event_id', 'ticket_id', 'ticket_tier', 'quantity', 'amount', 'created_at', 'job_id'],
+            db.select(
+                OrderTicket.order_id,
+                Order.user_id,
+                db.literal(event_id),
+                db.literal(ticket_id),
+                db.literal(ticket_tier),
+                func.coalesce(OrderTicket.quantity, 0),
+                line_amount,
+                db.literal(now),
+                db.literal(job_id),
+            )
+            .join(Order, Order.id == OrderTicket.order_id)
+            .where(in_batch)
+        )
+    )
+
+    line_refund = (
+        db.select(line_amount)
+        .where(OrderTicket.order_id == Order.id, OrderTicket.ticket_id == ticket_id)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        db.update(Order)
+        .where(Order.id.in_(order_ids))
+        .values(amount=func.max(0.0, func.coalesce(Order.amount, 0.0) - func.coalesce(line_refund, 0.0)))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(db.delete(OrderTicket).where(in_batch).execution_options(synchronize_session=False))
+    db.session.execute(
+        db.delete(Order)
+        .where(Order.id.in_(order_ids), ~db.exists().where(OrderTicket.order_id == Order.id))
+        .execution_options(synchronize_session=False)
+    )
+    return len(order_ids), amount
+
+
+def _drop_holds(ticket_id: int) -> None:
+    # Checkout reservations on a removed tier can no longer be confirmed.
+    db.session.execute(
+        db.delete(TicketHold).where(TicketHold.ticket_id == ticket_id).execution_options(synchronize_session=False)
+    )
+
+
+def remove_tier(ticket: Ticket) -> tuple:
+    # Refund a tier that is being removed. Returns (job, amount refunded):
+    #   (None, amount) - done now; the caller deletes the ticket and commits
+    #   (job, None)    - too many buyers: the tier is taken off sale and a background
+    #                    job will refund and delete it; the caller must not delete it
+    pending = db.session.scalar(
+        db.select(RefundJob).where(RefundJob.ticket_id == ticket.id, RefundJob.status != 'DONE')
+    )
+    if pending:
+        # removed again before its job finished
+        return pending, None
+    orders = _order_count(ticket.id)
+    if orders > current_app.config.get('REFUND_INLINE_ORDERS', 200):
+        # off sale until the job deletes it: open checkouts can't confirm and nothing goes back into stock
+        ticket.availability = 0
+        _drop_holds(ticket.id)
+        job = RefundJob(
+            event_id=ticket.event_id,
+            ticket_id=ticket.id,
+            ticket_tier=ticket.ticketTier,
+            status='PENDING',
+            total_orders=orders,
+            processed_orders=0,
+            refund_total=0.0,
+            created_at=datetime.now(),
+        )
+        db.session.add(job)
+        return job, None
+
+    refunded = 0.0
+    while orders:
+        orders, amount = _refund_batch(ticket.id, ticket.ticketTier, ticket.event_id, max(orders, 1))
+        refunded += amount
+    # the order lines were deleted in SQL; don't let the ORM cascade try again
+    db.session.expire(ticket, ['order_links', 'orders'])
+    _drop_holds(ticket.id)
+    return None, refunded
+
+
+def _claim(job_id: int) -> bool:
+    now = datetime.now()
+    claimed = db.session.execute(
+        db.update(RefundJob)
+        .where(
+            RefundJob.id == job_id,
+            RefundJob.status != 'DONE',
+            (RefundJob.claimed_until.is_(None)) | (RefundJob.claimed_until < now),
+        )
+        .values(status='RUNNING', claimed_until=now + timedelta(seconds=_CLAIM_SECONDS))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return bool(claimed)
+
+
+def _run_job(job: RefundJob, batch_size: int) -> int:
+    refunded_orders = 0
+    while True:
+        orders, amount = _refund_batch(job.ticket_id, job.ticket_tier, job.event_id, batch_size, job.id)
+        if not orders:
+            break
+        db.session.execute(
+            db.update(RefundJob)
+            .where(RefundJob.id == job.id)
+            .values(
+                processed_orders=RefundJob.processed_orders + orders,
+                refund_total=RefundJob.refund_total + amount,
+                claimed_until=datetime.now() + timedelta(seconds=_CLAIM_SECONDS),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        # one short transaction per batch
+        db.session.commit()
+        refunded_orders += orders
+
+    _drop_holds(job.ticket_id)
+    db.session.execute(db.delete(Ticket).where(Ticket.id == job.ticket_id).execution_options(synchronize_session=False))
+    db.session.execute(
+        db.update(RefundJob)
+        .where(RefundJob.id == job.id)
+        .values(status='DONE', finished_at=datetime.now(), claimed_until=None)
+        .execution_options(synchronize_session=False)
+    )
+    touch_events(job.event_id)
+    db.session.commit()
+    return refunded_orders
+
+
+def process_refund_jobs(batch_size: int = None) -> int:
+    # Work through every unfinished refund job; returns the number of orders refunded.
+    if batch_size is None:
+        batch_size = current_app.config.get('REFUND_BATCH_SIZE', 500)
+    refunded = 0
+    job_ids = db.session.scalars(
+        db.select(RefundJob.id).where(RefundJob.status != 'DONE').order_by(RefundJob.id)
+    ).all()
+    for job_id in job_ids:
+        # another process may already be on it
+        if not _claim(job_id):
+            continue
+        refunded += _run_job(db.session.get(RefundJob, job_id), batch_size)
+    return refunded
+
+
+def tiers_being_refunded(ticket_ids) -> set:
+    # Ids among ticket_ids whose tier has an unfinished refund job; those tiers are
+    # read-only until the job has refunded its buyers and deleted them.
+    ids = [int(ticket_id) for ticket_id in ticket_ids]
+    if not ids:
+        return set()
+    return set(db.session.scalars(
+        db.select(RefundJob.ticket_id).where(RefundJob.ticket_id.in_(ids), RefundJob.status != 'DONE')
+    ))
+
+
+def refund_jobs_for(event_ids) -> dict:
+    # {event_id: [RefundJob, ...]} for My Events: unfinished jobs, and ones finished in the last day.
+    if not event_ids:
+        return {}
+    jobs = db.session.scalars(
+        db.select(RefundJob)
+        .where(
+            RefundJob.event_id.in_(event_ids),
+            (RefundJob.status != 'DONE') | (RefundJob.finished_at >= datetime.now() - timedelta(days=1)),
+        )
+        .order_by(RefundJob.id)
+    ).all()
+    by_event = {}
+    for job in jobs:
+        by_event.setdefault(job.event_id, []).append(job)
+    return by_event
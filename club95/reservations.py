@@ -0,0 +1,166 @@
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy import func
+
+from . import db
+from .caching import touch_events
+from .models import Order, OrderTicket, RefundJob, Ticket, TicketHold
+
+# Ticket holds (cart reservations).
+#
+# Selecting quantities takes the stock straight away with a conditional UPDATE and
+# records a TicketHold row per tier, so the hot ticket rows are only locked for the
+# length of that statement rather than the whole checkout. Confirming claims the
+# hold rows and writes the Order; holds that run out are handed back to their tiers
+# in bulk by release_expired_holds().
+#
+# A tier being refunded by a background job (see refunds.py) is off sale for good:
+# it can't be held or confirmed, and holds on it are dropped rather than restocked.
+
+
+def _refunding_tiers():
+    # Ids of the tiers with an unfinished refund job, as a subquery.
+    return db.select(RefundJob.ticket_id).where(RefundJob.status != 'DONE')
+
+
+def hold_tickets(selections, user_id: int, event_id: int):
+    # Reserve (ticket, quantity) pairs for a user. Returns the hold token, or None
+    # (with the session rolled back) if any tier no longer has enough tickets.
+    # Caller commits.
+    now = datetime.now()
+    expires_at = now + timedelta(minutes=current_app.config.get('HOLD_MINUTES', 10))
+    token = uuid.uuid4().hex
+
+    for ticket, quantity in selections:
+        # Check and decrement in one statement so concurrent buyers can't oversell a tier;
+        # if one tier fails the rollback undoes the tiers already taken
+        result = db.session.execute(
+            db.update(Ticket)
+            .where(Ticket.id == ticket.id, Ticket.availability >= quantity, Ticket.id.not_in(_refunding_tiers()))
+            .values(availability=Ticket.availability - quantity)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            db.session.rollback()
+            return None
+        # reload the new figure on next access instead of trusting the copy read earlier
+        db.session.expire(ticket, ['availability'])
+
+        db.session.add(TicketHold(
+            token=token,
+            user_id=user_id,
+            event_id=event_id,
+            ticket_id=ticket.id,
+            quantity=quantity,
+            price_at_hold=ticket.price,
+            created_at=now,
+            expires_at=expires_at,
+        ))
+
+    return token
+
+
+def _claim_holds(*conditions):
+    # Delete matching holds and return what they held, in a single statement.
+    # Whoever deletes a hold row owns it, so confirm, cancel and the sweeper can
+    # never both act on the same hold.
+    return db.session.execute(
+        db.delete(TicketHold)
+        .where(*conditions)
+        .returning(TicketHold.event_id, TicketHold.ticket_id, TicketHold.quantity, TicketHold.price_at_hold)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+
+def _return_to_stock(claimed_rows) -> int:
+    # Add held quantities back onto their tiers, one UPDATE per tier.
+    per_ticket = defaultdict(int)
+    for row in claimed_rows:
+        per_ticket[row.ticket_id] += row.quantity
+    returned = 0
+    for ticket_id, quantity in per_ticket.items():
+        returned += quantity * db.session.execute(
+            db.update(Ticket)
+            .where(Ticket.id == ticket_id, Ticket.id.not_in(_refunding_tiers()))
+            .values(availability=Ticket.availability + quantity)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    return returned
+
+
+def confirm_hold(token: str, user_id: int):
+    # Turn a live hold into an Order. Returns the order, or None if the hold has
+    # expired or was already used. Caller commits.
+    claimed = _claim_holds(
+        TicketHold.token == token,
+        TicketHold.user_id == user_id,
+        TicketHold.expires_at > datetime.now(),
+    )
+    # tickets held on a tier that has since gone to a refund job are gone, not sold
+    if claimed:
+        refunding = set(db.session.scalars(
+            _refunding_tiers().where(RefundJob.ticket_id.in_({row.ticket_id for row in claimed}))
+        ))
+        claimed = [row for row in claimed if row.ticket_id not in refunding]
+    if not claimed:
+        return None
+
+    order = Order(
+        order_date=datetime.now(timezone.utc),
+        amount=sum(row.price_at_hold * row.quantity for row in claimed),
+        user_id=user_id,
+    )
+    db.session.add(order)
+    db.session.flush()
+
+    for row in claimed:
+        db.session.add(OrderTicket(
+            order_id=order.id,
+            ticket_id=row.ticket_id,
+            quantity=row.quantity,
+            price_at_purchase=row.price_at_hold,
+        ))
+    return order
+
+
+def cancel_hold(token: str, user_id: int) -> int:
+    # Give a user's hold back to stock straight away. Returns tickets released. Caller commits.
+    claimed = _claim_holds(TicketHold.token == token, TicketHold.user_id == user_id)
+    return _return_to_stock(claimed)
+
+
+def release_expired_holds(now=None) -> int:
+    # Sweep every expired hold back into stock with two set-based statements:
+    # one correlated UPDATE across the affected tiers, then one DELETE.
+    # Both run in the same transaction, so a hold is never released twice.
+    now = now or datetime.now()
+    expired = TicketHold.expires_at <= now
+
+    # the released tickets change what these events' pages show
+    affected_events = db.session.scalars(db.select(TicketHold.event_id).where(expired).distinct()).all()
+    if not affected_events:
+        return 0
+
+    released_per_ticket = (
+        db.select(func.sum(TicketHold.quantity))
+        .where(TicketHold.ticket_id == Ticket.id, expired)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        db.update(Ticket)
+        .where(
+            Ticket.id.in_(db.select(TicketHold.ticket_id).where(expired)),
+            Ticket.id.not_in(_refunding_tiers()),
+        )
+        .values(availability=Ticket.availability + released_per_ticket)
+        .execution_options(synchronize_session=False)
+    )
+    released = db.session.execute(
+        db.delete(TicketHold).where(expired).execution_options(synchronize_session=False)
+    ).rowcount
+    touch_events(*affected_events)
+    db.session.commit()
+    return released
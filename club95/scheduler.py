@@ -0,0 +1,70 @@
+import threading
+
+from . import db
+
+# Minimal in-process scheduler for periodic maintenance jobs.
+# Each job gets its own daemon thread and runs inside an app context, so it can use
+# db.session exactly like a request does. Jobs should be short, set-based statements.
+#
+# The jobs belong in one process only: the web server starts them with the first
+# request it serves (so `flask` commands and tests never do), and a multi-worker
+# deployment turns them off in the workers (RUN_BACKGROUND_JOBS=false) and runs
+# `flask run-jobs` once instead. They are still safe to run concurrently, since
+# SQLite serialises the writes.
+
+
+def start_periodic_job(app, name, interval_seconds, job):
+    # Call job() every interval_seconds until the process exits.
+    # Returns a threading.Event that stops the job when set, or None if disabled (interval <= 0).
+    if not interval_seconds or interval_seconds <= 0:
+        return None
+
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval_seconds):
+            with app.app_context():
+                try:
+                    job()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Background job '%s' failed", name)
+
+    thread = threading.Thread(target=run, name=f"club95-{name}", daemon=True)
+    thread.start()
+    return stop
+
+
+def start_jobs_with_first_request(app, jobs):
+    # Start every (name, interval_seconds, job) in `jobs` when the app serves its first request.
+    started = threading.Event()
+    lock = threading.Lock()
+
+    @app.before_request
+    def start_background_jobs():
+        if started.is_set():
+            return
+        with lock:
+            if started.is_set():
+                return
+            for name, interval_seconds, job in jobs:
+                start_periodic_job(app, name, interval_seconds, job)
+            started.set()
+
+
+def run_jobs(app, jobs, echo=None):
+    # Run every (name, interval_seconds, job) in `jobs` until interrupted (Ctrl+C / SIGINT).
+    stops = []
+    for name, interval_seconds, job in jobs:
+        stop = start_periodic_job(app, name, interval_seconds, job)
+        if stop is not None:
+            stops.append(stop)
+            if echo:
+                echo(f"Running '{name}' every {interval_seconds} seconds")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for stop in stops:
+            stop.set()
@@ -0,0 +1,127 @@
+import re
+
+from sqlalchemy import column, func, literal_column, table, text
+from sqlalchemy.orm import configure_mappers, load_only, selectinload
+
+from . import db
+from .models import Event, EventArtist
+
+# Full-text search over events, backed by an SQLite FTS5 virtual table.
+# The table's rowid is the event id, so matches join straight back onto events.
+# https://www.sqlite.org/fts5.html - reference for MATCH syntax and bm25()
+SEARCH_TABLE = 'event_search'
+
+# Columns in the FTS table, in the order bm25() expects its weights
+SEARCH_COLUMNS = ('title', 'description', 'date', 'location', 'genres', 'artists')
+
+# Relative bm25 weights - a hit in the title or lineup outranks one in the description
+SEARCH_WEIGHTS = (10.0, 1.0, 1.0, 3.0, 4.0, 6.0)
+
+_search_table = table(SEARCH_TABLE, column('rowid'))
+
+
+def ensure_search_index(batch_size: int = 500) -> None:
+    # Create the FTS table if it is missing and fill it when it is empty.
+    db.session.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+        f"USING fts5({', '.join(SEARCH_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2')"
+    ))
+    has_rows = db.session.execute(text(f"SELECT 1 FROM {SEARCH_TABLE} LIMIT 1")).first()
+    if not has_rows:
+        rebuild_search_index(batch_size)
+    db.session.commit()
+
+
+def _search_document(event: Event) -> dict:
+    # Flatten an event and its related names into the FTS column values.
+    return {
+        'rowid': event.id,
+        'title': event.title or '',
+        'description': event.description or '',
+        'date': str(event.date or ''),
+        'location': event.venue.location if event.venue else '',
+        'genres': ' '.join(g.genreType for g in event.genres if g.genreType),
+        'artists': ' '.join(
+            link.artist.artistName for link in event.artist_links
+            if link.artist and link.artist.artistName
+        ),
+    }
+
+
+def insert_documents(documents) -> None:
+    # Add rows (dicts with rowid and the SEARCH_COLUMNS) to the index. Caller commits.
+    if not documents:
+        return
+    db.session.execute(
+        text(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, {', '.join(SEARCH_COLUMNS)}) "
+            f"VALUES (:rowid, {', '.join(':' + name for name in SEARCH_COLUMNS)})"
+        ),
+        documents,
+    )
+
+
+def index_event(event: Event) -> None:
+    # Refresh the search row for a single event. Caller commits.
+    if not event or event.id is None:
+        return
+    remove_event_from_index(event.id)
+    insert_documents([_search_document(event)])
+
+
+def remove_event_from_index(event_id: int) -> None:
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid"), {'rowid': event_id})
+
+
+def rebuild_search_index(batch_size: int = 500) -> int:
+    # Repopulate the whole index from the events table, one batch at a time.
+    # Backrefs such as Event.venue only exist once the mappers are configured,
+    # which may not have happened yet when this runs at startup.
+    # Only the indexed columns are loaded, so this also works from a migration
+    # that runs before later columns have been added to the events table.
+    configure_mappers()
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    query = (
+        db.select(Event)
+        .options(
+            load_only(Event.id, Event.title, Event.description, Event.date, Event.venue_id),
+            selectinload(Event.venue),
+            selectinload(Event.genres),
+            selectinload(Event.artist_links).selectinload(EventArtist.artist),
+        )
+        .order_by(Event.id)
+    )
+    indexed = 0
+    last_id = 0
+    while True:
+        batch = db.session.scalars(query.where(Event.id > last_id).limit(batch_size)).all()
+        if not batch:
+            break
+        insert_documents([_search_document(event) for event in batch])
+        indexed += len(batch)
+        last_id = batch[-1].id
+    return indexed
+
+
+def build_match_expression(raw_term: str) -> str:
+    # Turn free text into an FTS5 query: every word must match, as a prefix.
+    # Words are quoted so user input can never be parsed as FTS operators.
+    words = re.findall(r"\w+", raw_term or '')
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_match_subquery(raw_term: str):
+    # Return a (event_id, rank) subquery of matching events, or None if the term has no words.
+    # Lower rank is a better match, as with bm25().
+    match_expression = build_match_expression(raw_term)
+    if not match_expression:
+        return None
+    fts = literal_column(SEARCH_TABLE)
+    return (
+        db.select(
+            _search_table.c.rowid.label('event_id'),
+            func.bm25(fts, *SEARCH_WEIGHTS).label('rank'),
+        )
+        .where(fts.op('MATCH')(match_expression))
+        .subquery('search_matches')
+    )
@@ -0,0 +1,65 @@
+from tempfile import SpooledTemporaryFile
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Size limits for uploaded files, enforced while the request body is parsed.
+#
+# A request whose Content-Length is over MAX_CONTENT_LENGTH is refused by Flask
+# before its body is read. Within a request, every file part is written into its
+# own spool that raises 413 as soon as it grows past MAX_UPLOAD_FILE_BYTES, so an
+# oversized file is rejected mid-upload rather than after it has been written out.
+# Spools keep at most UPLOAD_SPOOL_BYTES in memory before moving to a temporary
+# file, which bounds the memory a many-file upload can take; media.py then streams
+# each file from its spool through the hash into the media store.
+
+
+def _format_size(size: int) -> str:
+    return f"{size / (1024 * 1024):g} MB"
+
+
+class UploadTooLarge(RequestEntityTooLarge):
+    def __init__(self, filename, limit):
+        name = f'"{filename}"' if filename else 'An uploaded file'
+        super().__init__(f"{name} is larger than the {_format_size(limit)} limit for a single file.")
+
+
+class _LimitedSpool:
+    # File-like wrapper that refuses writes beyond `limit` bytes.
+
+    def __init__(self, spool, limit, filename):
+        self._spool = spool
+        self._limit = limit
+        self._filename = filename
+        self._written = 0
+
+    def write(self, data):
+        self._written += len(data)
+        if self._written > self._limit:
+            raise UploadTooLarge(self._filename, self._limit)
+        return self._spool.write(data)
+
+    def __iter__(self):
+        return iter(self._spool)
+
+    def __getattr__(self, name):
+        return getattr(self._spool, name)
+
+
+def check_upload_size(filename, size) -> None:
+    # Raise 413 if a file of `size` bytes is over the per-file limit.
+    limit = current_app.config.get('MAX_UPLOAD_FILE_BYTES')
+    if limit and size > limit:
+        raise UploadTooLarge(filename, limit)
+
+
+class UploadRequest(Request):
+    # Request class (app.request_class) applying the per-file limit and spool size.
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # a part that declares its own length can be turned away before it is read
+        if content_length:
+            check_upload_size(filename, content_length)
+        spool = SpooledTemporaryFile(max_size=current_app.config.get('UPLOAD_SPOOL_BYTES', 64 * 1024), mode='rb+')
+        limit = current_app.config.get('MAX_UPLOAD_FILE_BYTES')
+        return _LimitedSpool(spool, limit, filename) if limit else spool
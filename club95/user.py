@@ -1,12 +1,14 @@
-import os
-
 from flask import Blueprint, render_template, request, flash
 from flask_login import login_required, current_user
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import selectinload
 from sqlalchemy import func, cast
 
+from club95.caching import touch_events
 from club95.form import UpdateProfileForm
-from .models import Order, OrderTicket, Ticket, Event, Venue, Genre, EventType
+from club95.home import _paginate_keyset
+from club95.images import queue_derivatives
+from club95.media import save_media, release_media
+from .models import Order, OrderTicket, Ticket, Event, Venue, Genre, EventType, Comment
 from . import db
 from werkzeug.security import generate_password_hash
 from werkzeug.utils import secure_filename
@@ -41,111 +43,72 @@ def mytickets():
     g_ids    = [int(v) for v in genres_raw if v.isdigit()]
     g_names  = [v for v in genres_raw if not v.isdigit()]
 
-    q = (
-        db.select(Order)
-        .join(OrderTicket, OrderTicket.order_id == Order.id)
-        .join(Ticket, Ticket.id == OrderTicket.ticket_id)
-        .join(Event, Event.id == Ticket.event_id)
-        .outerjoin(Venue, Venue.id == Event.venue_id)
-        .options(
-            joinedload(Order.line_items)
-            .joinedload(OrderTicket.ticket)
-            .joinedload(Ticket.event)
-            .joinedload(Event.venue)
-        )
-        .where(Order.user_id == current_user.id)
-    )
+    # Conditions on a line item's event. Orders are paged on the line items that meet
+    # them and only those line items are shown, so the filtering happens in SQL before
+    # the page is cut and every order on a page has something to show.
+    conditions = []
 
     if term:
-        like = f"%{term}%"
-        q = q.where(
+        # the term is matched literally: % and _ in it are not wildcards
+        conditions.append(
             db.or_(
-                Event.title.ilike(like),
-                Event.description.ilike(like),
-                cast(Event.date, db.String).ilike(like),
-                Venue.location.ilike(like),
-                Event.genres.any(Genre.genreType.ilike(like)),
+                Event.title.icontains(term, autoescape=True),
+                Event.description.icontains(term, autoescape=True),
+                cast(Event.date, db.String).icontains(term, autoescape=True),
+                Venue.location.icontains(term, autoescape=True),
+                Event.genres.any(Genre.genreType.icontains(term, autoescape=True)),
             )
         )
 
     if et_ids:
-        q = q.where(Event.event_type.has(EventType.id.in_(et_ids)))
+        conditions.append(Event.event_type.has(EventType.id.in_(et_ids)))
     if et_names:
-        q = q.where(Event.event_type.has(EventType.typeName.in_(et_names)))
+        conditions.append(Event.event_type.has(EventType.typeName.in_(et_names)))
 
     if g_ids:
-        q = q.where(Event.genres.any(Genre.id.in_(g_ids)))
+        conditions.append(Event.genres.any(Genre.id.in_(g_ids)))
     if g_names:
-        q = q.where(Event.genres.any(Genre.genreType.in_(g_names)))
+        conditions.append(Event.genres.any(Genre.genreType.in_(g_names)))
 
     if statuses:
-        q = q.where(func.upper(Event.status).in_(statuses))
-
-    # Execute query
-    orders = db.session.scalars(q.distinct()).unique().all()
-
-    # --- Keep only the line items whose event matches the active filters ---
-    # Helper: checks if an event satisfies current filters/search.
-    def _event_matches(ev) -> bool:
-        if not ev:
-            return False
-
-        # Text search (case-insensitive, covers title/description/venue/genres/date as string)
-        if term:
-            t = term.lower()
-            if not (
-                (getattr(ev, "title", None) and t in ev.title.lower()) or
-                (getattr(ev, "description", None) and t in ev.description.lower()) or
-                (getattr(getattr(ev, "venue", None), "location", None) and t in ev.venue.location.lower()) or
-                any(getattr(g, "genreType", None) and t in g.genreType.lower() for g in getattr(ev, "genres", []) or []) or
-                (str(getattr(ev, "date", "")) and t in str(getattr(ev, "date", "")).lower())
-            ):
-                return False
-
-        # Event type filter (IDs or names)
-        if et_ids or et_names:
-            et = getattr(ev, "event_type", None)
-            et_ok = False
-            if et:
-                if et_ids and getattr(et, "id", None) in et_ids:
-                    et_ok = True
-                if et_names and getattr(et, "typeName", None) in et_names:
-                    et_ok = True
-            if not et_ok:
-                return False
-
-        # Genre filter (IDs and/or names)
-        if g_ids or g_names:
-            ev_genres = getattr(ev, "genres", []) or []
-            g_ids_ok = (not g_ids) or any(getattr(g, "id", None) in g_ids for g in ev_genres)
-            g_names_ok = (not g_names) or any(getattr(g, "genreType", None) in g_names for g in ev_genres)
-            if not (g_ids_ok and g_names_ok):
-                return False
-
-        # Status filter (already upper-cased in request parsing)
-        if statuses:
-            ev_status = (getattr(ev, "status", "") or "").upper()
-            if ev_status not in statuses:
-                return False
-
-        return True
-
-    # Build a filtered view-model per order
-    orders_vm = []
-    for od in orders:
-        visible_items = []
-        for li in od.line_items:
-            tk = getattr(li, "ticket", None)
-            ev = getattr(tk, "event", None) if tk else None
-            if _event_matches(ev):
-                visible_items.append(li)
-        if visible_items:
-            # Attach a transient attribute for the template to iterate
-            od.visible_items = visible_items
-            orders_vm.append(od)
-
-    if orders_vm:
-        orders_vm.sort(key=lambda od: getattr(od, "id", 0), reverse=True)
+        conditions.append(Event.effective_status.in_(statuses))
+
+    visible = db.true()
+    if conditions:
+        visible = OrderTicket.ticket_id.in_(
+            db.select(Ticket.id)
+            .join(Event, Event.id == Ticket.event_id)
+            .outerjoin(Venue, Venue.id == Event.venue_id)
+            .where(*conditions)
+        )
+
+    # Execute query - newest orders first, one page at a time
+    q = db.select(Order).where(Order.user_id == current_user.id, Order.line_items.any(visible))
+    orders = _paginate_keyset(q, [Order.order_date, Order.id], descending=True)
+
+    # The visible line items of the orders on this page, in one query
+    line_items = db.session.scalars(
+        db.select(OrderTicket)
+        .where(OrderTicket.order_id.in_([od.id for od in orders]), visible)
+        .order_by(OrderTicket.order_id, OrderTicket.ticket_id)
+        .options(
+            selectinload(OrderTicket.ticket)
+            .selectinload(Ticket.event)
+            .options(
+                selectinload(Event.venue),
+                # effective_status sums the event's ticket tiers
+                selectinload(Event.tickets),
+            )
+        )
+    ).all() if orders.items else []
+    items_by_order = {}
+    for li in line_items:
+        items_by_order.setdefault(li.order_id, []).append(li)
+
+    # Attach a transient attribute for the template to iterate
+    orders_vm = list(orders)
+    for od in orders_vm:
+        od.visible_items = items_by_order.get(od.id, [])
 
     if not orders_vm:
         flash("No tickets matched your filters. Try a different keyword or filter.", "search_info")
@@ -154,6 +117,7 @@ def mytickets():
         "user/mytickets.html",
         heading="My Tickets",
         orders=orders_vm,   # pass filtered orders with per-order visible_items
+        page=orders,        # cursors for the next/previous page links
         search_term=term,
     )
 
@@ -181,6 +145,8 @@ def profile():
         editing = True
         populate_form_from_user()
     elif form.validate_on_submit():
+        # What the user's comments show about them (the email stands in for a missing name)
+        shown_before = (current_user.firstName, current_user.lastName, current_user.email, current_user.profilePicture)
         # Only update fields if provided
         if form.email.data:
             current_user.email = form.email.data
@@ -197,13 +163,21 @@ def profile():
         if form.bio.data:
             current_user.bio = form.bio.data
         if form.profilePicture.data and getattr(form.profilePicture.data, 'filename', ''):
-            filename = secure_filename(form.profilePicture.data.filename)
-            if filename:
-                upload_dir = os.path.join('club95', 'static', 'img')
-                os.makedirs(upload_dir, exist_ok=True)
-                save_path = os.path.join(upload_dir, filename)
-                form.profilePicture.data.save(save_path)
-                current_user.profilePicture = os.path.join('img', filename).replace('\\', '/')
+            if secure_filename(form.profilePicture.data.filename):
+                # stored by content, so users uploading "photo.jpg" no longer overwrite each other
+                stored_name = save_media(form.profilePicture.data)
+                if current_user.profilePicture and current_user.profilePicture.startswith('img/'):
+                    release_media(current_user.profilePicture[len('img/'):])
+                current_user.profilePicture = f"img/{stored_name}"
+                current_user.profilePictureWidths = None
+                queue_derivatives('profile', current_user.profilePicture)
+        # Event pages with this user's comments have to be rendered again
+        if (current_user.firstName, current_user.lastName, current_user.email, current_user.profilePicture) != shown_before:
+            commented = db.session.scalars(
+                db.select(Comment.event_id).where(Comment.user_id == current_user.id).distinct()
+            ).all()
+            if commented:
+                touch_events(*commented)
         db.session.commit()
         db.session.refresh(current_user)
         editing = False
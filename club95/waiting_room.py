@@ -0,0 +1,116 @@
+import secrets
+import time
+
+from flask import current_app, session
+from sqlalchemy import Integer, cast, func
+from sqlalchemy.dialects.sqlite import insert
+
+from . import db
+from .models import QueueGate
+
+# Virtual waiting room for busy on-sales.
+#
+# Each queue-enabled event gets an admission gate, a row in queue_gates shared by
+# every worker process. Visitors take a ticket number when they join; a token
+# bucket refills at QUEUE_ADMISSIONS_PER_MINUTE and every token moves the "now
+# serving" counter on by one. A visitor is admitted once the counter reaches their
+# number, and then carries a signed admission pass in their session for
+# QUEUE_PASS_MINUTES, which is what eventdetails and purchase_tickets check.
+#
+# Refilling, admitting and taking a number happen in one UPDATE ... RETURNING, so
+# concurrent workers can't hand out the same number or admit anyone twice. Joining
+# writes once per visitor; a poll only reads the row unless the bucket holds a whole
+# token, so admission writes are paced by the admission rate rather than by how many
+# people are waiting. Each write commits straight away to keep SQLite's write lock short.
+
+
+def _rate_per_second() -> float:
+    return current_app.config['QUEUE_ADMISSIONS_PER_MINUTE'] / 60
+
+
+def _burst() -> int:
+    return max(1, current_app.config['QUEUE_BURST'])
+
+
+def _advance(event_id: int, joining: int):
+    # Refill the bucket, spend whole tokens on waiting visitors and hand out `joining`
+    # new numbers, atomically. Returns the gate's (epoch, issued, serving) afterwards.
+    now = time.time()
+    db.session.execute(
+        insert(QueueGate)
+        .values(event_id=event_id, epoch=secrets.token_hex(4), issued=0, serving=0,
+                tokens=float(_burst()), updated=now)
+        .on_conflict_do_nothing(index_elements=[QueueGate.event_id])
+    )
+    refilled = func.min(_burst(), QueueGate.tokens + func.max(0, now - QueueGate.updated) * _rate_per_second())
+    admitted = func.min(cast(refilled, Integer), QueueGate.issued + joining - QueueGate.serving)
+    gate = db.session.execute(
+        db.update(QueueGate)
+        .where(QueueGate.event_id == event_id)
+        .values(
+            issued=QueueGate.issued + joining,
+            serving=QueueGate.serving + admitted,
+            tokens=refilled - admitted,
+            updated=now,
+        )
+        .returning(QueueGate.epoch, QueueGate.issued, QueueGate.serving)
+    ).one()
+    db.session.commit()
+    return gate
+
+
+def _can_admit(gate) -> bool:
+    # True if someone is waiting and the bucket has refilled to a whole token since the row was written.
+    tokens = gate.tokens + max(0.0, time.time() - gate.updated) * _rate_per_second()
+    return gate.issued > gate.serving and min(_burst(), tokens) >= 1
+
+
+def has_admission(event) -> bool:
+    # True if the event doesn't queue, or this visitor holds an unexpired pass for it.
+    if not event.queue_enabled:
+        return True
+    expires = session.get('queue_passes', {}).get(str(event.id))
+    return expires is not None and expires > time.time()
+
+
+def _grant_pass(event_id: int) -> None:
+    passes = {
+        key: expires for key, expires in session.get('queue_passes', {}).items()
+        if expires > time.time()
+    }
+    passes[str(event_id)] = time.time() + current_app.config['QUEUE_PASS_MINUTES'] * 60
+    session['queue_passes'] = passes
+    places = session.get('queue_places', {})
+    places.pop(str(event_id), None)
+    session['queue_places'] = places
+
+
+def queue_position(event_id: int) -> int:
+    # Join the queue on the first call, then report this visitor's position.
+    # Returns 0 (and grants the admission pass) once they have been let through.
+    gate = db.session.execute(
+        db.select(QueueGate.epoch, QueueGate.issued, QueueGate.serving, QueueGate.tokens, QueueGate.updated)
+        .where(QueueGate.event_id == event_id)
+    ).first()
+    places = session.get('queue_places', {})
+    place = places.get(str(event_id))
+    if gate is None or not place or place[0] != gate.epoch:
+        joined = _advance(event_id, 1)
+        place = [joined.epoch, joined.issued]
+        places[str(event_id)] = place
+        session['queue_places'] = places
+        serving = joined.serving
+    elif _can_admit(gate):
+        serving = _advance(event_id, 0).serving
+    else:
+        serving = gate.serving
+
+    position = max(0, place[1] - serving)
+    if position == 0:
+        _grant_pass(event_id)
+    return position
+
+
+def estimated_wait_seconds(event_id: int, position: int) -> int:
+    rate = _rate_per_second()
+    return int(position / rate) if rate > 0 else 0
@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event as sa_event
+
+from club95 import create_app, db
+from club95.home import _invalidate_upcoming_events
+
+
+@pytest.fixture
+def app(tmp_path):
+    # A fresh, seeded database per test; TESTING keeps the background jobs off.
+    app = create_app({
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{(tmp_path / 'test.sqlite').as_posix()}",
+        'MEDIA_QUARANTINE_DIR': str(tmp_path / 'quarantine'),
+    })
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def count_queries(app):
+    # `with count_queries() as statements:` collects the SQL run inside the block.
+    @contextmanager
+    def counting():
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+        sa_event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            sa_event.remove(engine, 'before_cursor_execute', record)
+
+    return counting
+
+
+@pytest.fixture
+def page_queries(client, count_queries):
+    # page_queries(path) requests a page and returns how many statements it ran,
+    # starting from an empty carousel cache so every request does the same work.
+    def count(path):
+        _invalidate_upcoming_events()
+        with count_queries() as statements:
+            response = client.get(path)
+        assert response.status_code == 200
+        return len(statements)
+
+    return count
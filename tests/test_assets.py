@@ -0,0 +1,63 @@
+import os
+import shutil
+
+from club95 import create_app
+from club95.assets import ASSET_DIR, build_assets, load_manifest
+
+
+def _static_copy(app, tmp_path):
+    static = tmp_path / 'static'
+    shutil.copytree(app.static_folder, static, ignore=shutil.ignore_patterns(ASSET_DIR, 'media', 'derived', 'event_media'))
+    app.static_folder = str(static)
+    return static
+
+
+def test_images_stay_out_of_the_build(app, tmp_path):
+    static = _static_copy(app, tmp_path)
+    manifest = build_assets(app)
+
+    assert 'styles/styles.css' in manifest
+    assert not [source for source in manifest if source.startswith('img/')]
+    assert not (static / ASSET_DIR / 'img').exists()
+
+
+def test_rebuild_reuses_unchanged_files_and_prunes_old_ones(app, tmp_path):
+    static = _static_copy(app, tmp_path)
+    dist = static / ASSET_DIR
+    initial = build_assets(app)
+    font = next(source for source in initial if source.startswith('fonts/'))
+    font_path = static / font
+
+    # same size and mtime: taken from the last build without being read again
+    stat = font_path.stat()
+    data = font_path.read_bytes()
+    font_path.write_bytes(bytes(len(data)))
+    os.utime(font_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    first = build_assets(app)
+    font_path.write_bytes(data)
+    os.utime(font_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    variables = static / 'styles' / 'variables.css'
+    variables.write_text(variables.read_text() + '\n/* one */\n')
+    second = build_assets(app)
+    variables.write_text(variables.read_text() + '\n/* two */\n')
+    third = build_assets(app)
+
+    assert first[font] == initial[font]
+    # the build before the last one is kept for pages rendered just before it
+    assert (dist / second['styles/variables.css']).exists()
+    assert (dist / second['styles/styles.css']).exists()
+    assert not (dist / first['styles/variables.css']).exists()
+    assert not (dist / first['styles/styles.css']).exists()
+
+
+def test_app_start_only_loads_the_manifest(app, tmp_path):
+    # creating the app didn't build anything
+    assert app.config['BUILD_ASSETS_ON_STARTUP'] is False
+    assert not os.path.exists(os.path.join(app.static_folder, ASSET_DIR))
+
+    _static_copy(app, tmp_path)
+    manifest = build_assets(app)
+    worker = create_app(dict(app.config))
+    worker.static_folder = app.static_folder
+    assert load_manifest(worker) == manifest
@@ -0,0 +1,34 @@
+import threading
+
+from club95 import create_app
+
+
+def _job_threads():
+    return {thread.name for thread in threading.enumerate() if thread.name.startswith('club95-')}
+
+
+def test_jobs_are_off_under_testing(app, client):
+    assert app.config['RUN_BACKGROUND_JOBS'] is False
+    client.get('/')
+    assert not _job_threads()
+
+
+def test_jobs_start_with_the_first_request_only(app):
+    # long intervals: the threads start but never get to run a job during the test
+    worker = create_app(dict(
+        app.config,
+        RUN_BACKGROUND_JOBS=True,
+        HOLD_SWEEP_SECONDS=3600,
+        STATUS_SWEEP_SECONDS=3600,
+        REFUND_JOB_SECONDS=0,
+    ))
+    assert not _job_threads()
+
+    client = worker.test_client()
+    client.get('/')
+    client.get('/')
+    started = [thread for thread in threading.enumerate() if thread.name.startswith('club95-')]
+
+    assert sorted(thread.name for thread in started) == [
+        'club95-purge-idempotency-keys', 'club95-release-holds', 'club95-sweep-statuses',
+    ]
@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+from club95 import db
+from club95.models import Comment, Event, EventImage, Ticket, User
+
+
+def _add_comments_and_tiers(app, event_id, comments, tiers):
+    # Comments from distinct users (so each needs its author loaded), extra tiers and images.
+    with app.app_context():
+        now = datetime.now()
+        for index in range(comments):
+            user = User(email=f"fan{index}@club95.com", firstName=f"Fan{index}", lastName='Test')
+            db.session.add(Comment(
+                content=f"Great show {index}",
+                commentDateTime=now - timedelta(minutes=index),
+                event_id=event_id,
+                user=user,
+            ))
+        for index in range(tiers):
+            db.session.add(Ticket(ticketTier=f"Tier {index}", price=10.0 + index, availability=50, event_id=event_id))
+        for index in range(3):
+            db.session.add(EventImage(event_id=event_id, filename=f"extra{index}.jpg", order_index=index + 10))
+        db.session.commit()
+
+
+def test_event_details_query_count_does_not_grow_with_comments_and_tiers(app, client, page_queries):
+    with app.app_context():
+        event_id = db.session.scalars(db.select(Event.id).order_by(Event.id)).first()
+    path = f"/events/eventdetails/{event_id}"
+    # first request warms up per-process state (mappers, catalogue revision row)
+    client.get(path)
+
+    before = page_queries(path)
+    _add_comments_and_tiers(app, event_id, comments=30, tiers=12)
+    after = page_queries(path)
+
+    assert after == before
@@ -0,0 +1,71 @@
+import io
+
+from sqlalchemy.exc import OperationalError
+
+from club95 import db
+from club95.importer import import_events
+from club95.models import Event, Ticket
+
+
+def _csv(*rows):
+    lines = ["title,date,location,genres,artists,tickets", *rows]
+    return io.BytesIO("\n".join(lines).encode())
+
+
+def test_import_links_rows_to_their_own_events(app):
+    rows = [f"Show {index},2099-01-{index + 1:02d},Hall {index % 3},Jazz,Band {index}@20:00,GA:{index}:100" for index in range(25)]
+    with app.app_context():
+        report = import_events(_csv(*rows), 'csv', user_id=1, chunk_size=10)
+        assert (report['rows'], report['created'], report['failed']) == (25, 25, 0)
+        events = db.session.scalars(db.select(Event).where(Event.title.like('Show %'))).all()
+        assert len(events) == 25
+        for event in events:
+            number = event.title.split()[1]
+            assert [ticket.price for ticket in event.tickets] == [float(number)]
+            assert [link.artist.artistName for link in event.artist_links] == [f"Band {number}"]
+
+
+def test_failed_chunk_is_retried_without_counting_twice(app):
+    rows = [f"Show {index},2099-02-01,,,,GA:10:5" for index in range(6)]
+    rows.insert(3, "Boom,2099-02-01,,,,GA:10:5")
+    with app.app_context():
+        # a database-side failure that row validation can't see
+        db.session.execute(db.text(
+            "CREATE TRIGGER reject_boom BEFORE INSERT ON events WHEN NEW.title = 'Boom' "
+            "BEGIN SELECT RAISE(ABORT, 'boom'); END"
+        ))
+        db.session.commit()
+        before = db.session.scalar(db.select(db.func.count()).select_from(Event))
+
+        report = import_events(_csv(*rows), 'csv', user_id=1, chunk_size=4)
+
+        assert (report['rows'], report['created'], report['failed']) == (7, 6, 1)
+        assert report['errors'][0][0] == 5
+        after = db.session.scalar(db.select(db.func.count()).select_from(Event))
+        assert after - before == 6
+        assert db.session.scalar(
+            db.select(db.func.count()).select_from(Ticket).join(Event).where(Event.title.like('Show %'))
+        ) == 6
+
+
+def test_chunk_whose_commit_fails_is_counted_once(app, monkeypatch):
+    rows = [f"Show {index},2099-03-01,,,,GA:10:5" for index in range(4)]
+    with app.app_context():
+        commit = db.session.commit
+        calls = []
+
+        def flaky_commit():
+            # the first commit (the whole chunk) fails, e.g. the database was locked
+            calls.append(None)
+            if len(calls) == 1:
+                raise OperationalError("COMMIT", {}, Exception("database is locked"))
+            commit()
+
+        monkeypatch.setattr(db.session, 'commit', flaky_commit)
+        report = import_events(_csv(*rows), 'csv', user_id=1, chunk_size=4)
+        monkeypatch.undo()
+
+        assert (report['created'], report['failed']) == (4, 0)
+        assert db.session.scalar(
+            db.select(db.func.count()).select_from(Event).where(Event.title.like('Show %'))
+        ) == 4
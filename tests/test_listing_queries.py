@@ -0,0 +1,79 @@
+from datetime import date, timedelta
+
+from club95 import db
+from club95.caching import touch_events
+from club95.models import Artist, Event, EventArtist, EventType, Genre, Ticket, Venue
+from club95.search import rebuild_search_index
+
+
+def _add_events(app, count):
+    # Events with every relationship a listing card shows.
+    with app.app_context():
+        event_type = db.session.scalars(db.select(EventType)).first()
+        genre = db.session.scalars(db.select(Genre)).first()
+        for index in range(count):
+            event = Event(
+                title=f"Jazz Night {index}",
+                status='OPEN',
+                date=date.today() + timedelta(days=index + 1),
+                description='Late set',
+                event_type=event_type,
+                venue=Venue(location=f"Hall {index}", venueMap=''),
+            )
+            event.genres = [genre]
+            event.artist_links = [EventArtist(artist=Artist(artistName=f"Trio {index}"), set_time='20:00')]
+            event.tickets = [
+                Ticket(ticketTier='General', price=20.0, availability=100),
+                Ticket(ticketTier='VIP', price=60.0, availability=10),
+            ]
+            db.session.add(event)
+        db.session.commit()
+        rebuild_search_index()
+        db.session.commit()
+
+
+def test_listing_query_count_does_not_grow_with_events(app, client, page_queries):
+    pages = ['/', '/search?search=jazz', '/search?search=']
+    # first requests warm up per-process state (mappers, catalogue revision row)
+    for path in pages:
+        client.get(path)
+
+    with app.app_context():
+        assert db.session.scalar(db.select(db.func.count()).select_from(Event)) < 12
+
+    before = {path: page_queries(path) for path in pages}
+    _add_events(app, 40)
+    after = {path: page_queries(path) for path in pages}
+
+    assert after == before
+
+
+def test_upcoming_carousel_follows_touch_events(app, client):
+    client.get('/')
+    with app.app_context():
+        first_id = db.session.scalars(
+            db.select(Event.id)
+            .where(Event.date >= date.today(), Event.effective_status == 'OPEN')
+            .order_by(Event.date, Event.id)
+        ).first()
+        # a bulk UPDATE, as another worker or the importer would run it, skips the
+        # in-process listeners; touching the event is what the cache has to notice
+        db.session.execute(db.update(Event).where(Event.id == first_id).values(title='Renamed Headliner'))
+        touch_events(first_id)
+        db.session.commit()
+
+    page = client.get('/').data
+    carousel = page[page.index(b'id="upcoming-events-window"'):page.index(b'carousel-control-prev')]
+    assert b'Renamed Headliner' in carousel
+
+
+def test_upcoming_carousel_offers_resized_posters(app, client):
+    with app.app_context():
+        db.session.execute(db.update(Event).values(image_widths='320,640'))
+        touch_events()
+        db.session.commit()
+
+    page = client.get('/').data
+    carousel = page[page.index(b'id="upcoming-events-window"'):page.index(b'carousel-control-prev')]
+    assert b'srcset="' in carousel
+    assert b'-640.webp 640w' in carousel
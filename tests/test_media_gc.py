@@ -0,0 +1,56 @@
+import io
+import os
+import time
+
+from werkzeug.datastructures import FileStorage
+
+from club95 import db, media
+from club95.models import MediaFile
+
+
+def _upload():
+    return FileStorage(stream=io.BytesIO(b'poster bytes'), filename='poster.jpg')
+
+
+def test_collector_spares_a_file_an_identical_upload_just_touched(app, monkeypatch):
+    with app.app_context():
+        name = media.save_media(_upload())
+        media.release_media(name)
+        db.session.commit()
+        path = media.media_path(name)
+        old = time.time() - 48 * 3600
+        os.utime(path, (old, old))
+
+        collect = media._collect
+
+        def upload_lands_first(*args):
+            # An identical upload between the batch check and the removal: _store has
+            # touched the file, its add_reference hasn't run yet.
+            media._store(_upload())
+            return collect(*args)
+
+        monkeypatch.setattr(media, '_collect', upload_lands_first)
+        report = media.collect_orphans(grace_hours=24)
+
+        assert report['orphaned'] == 0
+        assert os.path.exists(path)
+        media.add_reference(name)
+        db.session.commit()
+        assert db.session.scalar(db.select(MediaFile.ref_count).where(MediaFile.path == name)) == 1
+
+
+def test_collector_removes_an_old_orphan(app):
+    with app.app_context():
+        name = media.save_media(_upload())
+        media.release_media(name)
+        db.session.commit()
+        path = media.media_path(name)
+        old = time.time() - 48 * 3600
+        os.utime(path, (old, old))
+
+        report = media.collect_orphans(grace_hours=24, quarantine_dir=app.config['MEDIA_QUARANTINE_DIR'])
+
+        assert report['orphaned'] == 1
+        assert not os.path.exists(path)
+        assert os.path.exists(os.path.join(app.config['MEDIA_QUARANTINE_DIR'], *name.split('/')))
+        assert db.session.scalar(db.select(MediaFile.id).where(MediaFile.path == name)) is None
@@ -0,0 +1,52 @@
+from sqlalchemy import text
+
+from club95 import create_app, db
+from club95.migrations import current_version, latest_version, missing_tables
+
+
+def _set_version(app, version):
+    with app.app_context():
+        db.session.execute(text(f"PRAGMA user_version = {version}"))
+        db.session.commit()
+        db.engine.dispose()
+
+
+def test_app_start_leaves_migrations_to_the_cli(app):
+    _set_version(app, latest_version() - 1)
+
+    # another worker starting against the same database doesn't migrate it
+    worker = create_app(dict(app.config, MIGRATE_ON_STARTUP=False))
+    with worker.app_context():
+        assert current_version() == latest_version() - 1
+
+    # pages answer with a maintenance message until the upgrade has run
+    response = worker.test_client().get('/')
+    assert response.status_code == 503
+    assert b"down for maintenance" in response.data
+
+    result = worker.test_cli_runner().invoke(args=['db-upgrade'])
+    assert result.exit_code == 0, result.output
+    assert f"Applying migration {latest_version()}" in result.output
+    with worker.app_context():
+        assert current_version() == latest_version()
+
+    assert worker.test_client().get('/').status_code == 200
+    with worker.app_context():
+        db.engine.dispose()
+
+
+def test_new_tables_are_created_by_the_upgrade(app):
+    with app.app_context():
+        db.session.execute(text("DROP TABLE refund_jobs"))
+        db.session.commit()
+        db.engine.dispose()
+
+    worker = create_app(dict(app.config))
+    with worker.app_context():
+        assert missing_tables() == ['refund_jobs']
+
+    result = worker.test_cli_runner().invoke(args=['db-upgrade'])
+    assert result.exit_code == 0, result.output
+    with worker.app_context():
+        assert missing_tables() == []
+        db.engine.dispose()
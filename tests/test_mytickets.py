@@ -0,0 +1,47 @@
+import re
+from datetime import datetime, timedelta
+
+from club95 import db
+from club95.models import Event, Order, OrderTicket, Ticket, User
+
+
+def _orders(app, event_ids, count, start):
+    # `count` orders for the sample user, each with one ticket for every event in `event_ids`.
+    with app.app_context():
+        user_id = db.session.scalar(db.select(User.id).where(User.email == 'sample@club95.com'))
+        tickets = [db.session.scalars(db.select(Ticket).where(Ticket.event_id == event_id)).first() for event_id in event_ids]
+        for index in range(count):
+            order = Order(order_date=start + timedelta(minutes=index), amount=10.0 * len(tickets), user_id=user_id)
+            db.session.add(order)
+            db.session.flush()
+            db.session.add_all([
+                OrderTicket(order_id=order.id, ticket_id=ticket.id, quantity=1, price_at_purchase=10.0)
+                for ticket in tickets
+            ])
+        db.session.commit()
+
+
+def _titled(app, *titles):
+    with app.app_context():
+        events = db.session.scalars(db.select(Event).join(Event.tickets).distinct().order_by(Event.id).limit(len(titles))).all()
+        for event, title in zip(events, titles):
+            event.title = title
+        db.session.commit()
+        return [event.id for event in events]
+
+
+def test_filtered_ticket_pages_are_full_and_show_only_matching_items(app, client):
+    matching, other, lookalike = _titled(app, 'Needle_Gig', 'Haystack Night', 'NeedleXGig')
+    # newer than the sample orders, so these fill the first pages
+    start = datetime.now() + timedelta(days=1)
+    _orders(app, [matching, other], 3, start)
+    # the newest orders are only for an event the term doesn't match literally
+    _orders(app, [lookalike], 3, start + timedelta(hours=1))
+    client.post('/auth/login', data={'email': 'sample@club95.com', 'password': 'samplepassword'})
+
+    page = client.get('/user/mytickets?search=needle_gig&per_page=2').get_data(as_text=True)
+
+    assert len(re.findall(r'class="window" id="order-', page)) == 2
+    assert 'Needle_Gig' in page
+    assert 'Haystack Night' not in page
+    assert 'NeedleXGig' not in page
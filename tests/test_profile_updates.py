@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from club95 import db
+from club95.models import Comment, Event, User
+
+
+def test_renaming_a_commenter_refreshes_their_event_pages(app, client):
+    with app.app_context():
+        user = db.session.scalar(db.select(User).where(User.email == 'sample@club95.com'))
+        event_id = db.session.scalars(db.select(Event.id).order_by(Event.id)).first()
+        db.session.add(Comment(content='See you there', commentDateTime=datetime.now(), event_id=event_id, user_id=user.id))
+        db.session.commit()
+        phone = user.phoneNumber
+
+    # another visitor has the page cached
+    visitor = app.test_client()
+    path = f"/events/eventdetails/{event_id}"
+    etag = visitor.get(path).headers['ETag']
+
+    client.post('/auth/login', data={'email': 'sample@club95.com', 'password': 'samplepassword'})
+    client.post('/user/profile', data={
+        'email': 'sample@club95.com', 'firstName': 'Renamed', 'lastName': 'Commenter', 'phonenumber': phone or '',
+    })
+    with app.app_context():
+        assert db.session.scalar(db.select(User.firstName).where(User.email == 'sample@club95.com')) == 'Renamed'
+
+    response = visitor.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'Renamed Commenter' in response.get_data(as_text=True)
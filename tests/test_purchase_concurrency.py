@@ -0,0 +1,156 @@
+import threading
+
+import pytest
+from sqlalchemy import func
+
+from club95 import db
+from club95.models import Event, OrderTicket, Ticket, TicketHold, User
+from club95.reservations import confirm_hold, hold_tickets
+
+
+def _buyers(app, count):
+    # `count` extra users, so every thread buys under its own account
+    with app.app_context():
+        users = [User(email=f"buyer{index}@club95.com", firstName='Buyer', lastName=str(index)) for index in range(count)]
+        db.session.add_all(users)
+        db.session.commit()
+        return [user.id for user in users]
+
+
+def _tier(app, capacity):
+    with app.app_context():
+        ticket = db.session.scalars(db.select(Ticket).order_by(Ticket.id)).first()
+        ticket.availability = capacity
+        db.session.commit()
+        return ticket.id, ticket.event_id
+
+
+def _race(app, user_ids, ticket_id, event_id, quantity):
+    # Every buyer holds and confirms `quantity` tickets at the same moment.
+    start = threading.Barrier(len(user_ids))
+    results = []
+    results_lock = threading.Lock()
+
+    def buy(user_id):
+        start.wait()
+        with app.app_context():
+            ticket = db.session.get(Ticket, ticket_id)
+            outcome = 'sold out'
+            try:
+                token = hold_tickets([(ticket, quantity)], user_id, event_id)
+                if token:
+                    db.session.commit()
+                    if confirm_hold(token, user_id):
+                        db.session.commit()
+                        outcome = 'sold'
+            except Exception as exc:
+                db.session.rollback()
+                outcome = f"error: {exc}"
+            finally:
+                db.session.remove()
+            with results_lock:
+                results.append(outcome)
+
+    threads = [threading.Thread(target=buy, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _race_through_routes(app, user_ids, ticket_id, event_id, quantity):
+    # Like _race, but each buyer is a signed-in client going through the purchase
+    # form and the checkout confirmation, as a browser would.
+    start = threading.Barrier(len(user_ids))
+    results = []
+    results_lock = threading.Lock()
+
+    def buy(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        start.wait()
+        outcome = 'sold out'
+        try:
+            response = client.post(f"/events/purchase/{event_id}", data={f"quantity_{ticket_id}": quantity})
+            location = response.headers.get('Location', '')
+            if '/events/checkout/' in location:
+                response = client.post(f"{location}/confirm")
+                if response.status_code != 302 or '/mytickets' not in response.headers.get('Location', ''):
+                    outcome = f"error: confirm answered {response.status_code}"
+                else:
+                    outcome = 'sold'
+            elif response.status_code != 302:
+                outcome = f"error: purchase answered {response.status_code}"
+        except Exception as exc:
+            outcome = f"error: {exc}"
+        with results_lock:
+            results.append(outcome)
+
+    threads = [threading.Thread(target=buy, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _stock(app, ticket_id):
+    with app.app_context():
+        sold = db.session.scalar(
+            db.select(func.coalesce(func.sum(OrderTicket.quantity), 0)).where(OrderTicket.ticket_id == ticket_id)
+        )
+        held = db.session.scalar(
+            db.select(func.coalesce(func.sum(TicketHold.quantity), 0)).where(TicketHold.ticket_id == ticket_id)
+        )
+        return sold, held, db.session.get(Ticket, ticket_id).availability
+
+
+def _assert_never_oversold(results, sold_now, held, availability, capacity, quantity):
+    assert not [result for result in results if result.startswith('error')]
+    assert results.count('sold') * quantity == sold_now
+    assert sold_now <= capacity
+    assert availability >= 0
+    assert held == 0
+    # every ticket is either sold or still on sale
+    assert sold_now + availability == capacity
+    # nobody was turned away while a full lot was still available
+    assert availability < quantity
+
+
+@pytest.mark.parametrize('buyers, capacity, quantity', [(40, 10, 1), (30, 20, 3)])
+def test_concurrent_purchases_never_oversell(app, buyers, capacity, quantity):
+    # More buyers than seats: the conditional UPDATE in hold_tickets must let through
+    # exactly as many as fit and turn the rest away.
+    ticket_id, event_id = _tier(app, capacity)
+    sold_before, _, _ = _stock(app, ticket_id)
+
+    results = _race(app, _buyers(app, buyers), ticket_id, event_id, quantity)
+
+    sold, held, availability = _stock(app, ticket_id)
+    _assert_never_oversold(results, sold - sold_before, held, availability, capacity, quantity)
+
+
+def test_concurrent_checkouts_never_oversell_a_large_tier(app):
+    # A 5,000-seat tier and 300 buyers after 20 tickets each (6,000 asked for), all
+    # going through the purchase route and the checkout confirmation at once.
+    buyers, capacity, quantity = 300, 5000, 20
+    with app.app_context():
+        # an event on sale that buyers can go straight to
+        ticket = db.session.scalars(
+            db.select(Ticket).join(Ticket.event)
+            .where(Event.effective_status == 'OPEN', Event.queue_enabled.is_(False))
+            .order_by(Ticket.id)
+        ).first()
+        ticket.availability = capacity
+        db.session.commit()
+        ticket_id, event_id = ticket.id, ticket.event_id
+    sold_before, _, _ = _stock(app, ticket_id)
+
+    results = _race_through_routes(app, _buyers(app, buyers), ticket_id, event_id, quantity)
+
+    sold, held, availability = _stock(app, ticket_id)
+    assert results.count('sold') == capacity // quantity
+    _assert_never_oversold(results, sold - sold_before, held, availability, capacity, quantity)
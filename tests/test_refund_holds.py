@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+
+from club95 import db
+from club95.models import Ticket, TicketHold, User
+from club95.refunds import remove_tier
+from club95.reservations import cancel_hold, confirm_hold, hold_tickets, release_expired_holds
+
+
+def _tier_with_buyer(app):
+    # A tier with one order and spare stock; REFUND_INLINE_ORDERS=0 sends its removal to a job.
+    app.config['REFUND_INLINE_ORDERS'] = 0
+    with app.app_context():
+        user_id = db.session.scalar(db.select(User.id).where(User.email == 'sample@club95.com'))
+        ticket = db.session.scalars(db.select(Ticket).order_by(Ticket.id)).first()
+        ticket.availability = 10
+        db.session.commit()
+        confirm_hold(hold_tickets([(ticket, 1)], user_id, ticket.event_id), user_id)
+        db.session.commit()
+        return ticket.id, ticket.event_id, user_id
+
+
+def _hold(ticket_id, event_id, user_id, token, expires_in):
+    db.session.add(TicketHold(
+        token=token, user_id=user_id, event_id=event_id, ticket_id=ticket_id, quantity=2,
+        price_at_hold=10.0, created_at=datetime.now(), expires_at=datetime.now() + expires_in,
+    ))
+
+
+def _availability(ticket_id):
+    return db.session.scalar(db.select(Ticket.availability).where(Ticket.id == ticket_id))
+
+
+def test_queued_refund_drops_holds_and_keeps_the_tier_off_sale(app):
+    ticket_id, event_id, user_id = _tier_with_buyer(app)
+    with app.app_context():
+        ticket = db.session.get(Ticket, ticket_id)
+        live = hold_tickets([(ticket, 2)], user_id, event_id)
+        expired = hold_tickets([(ticket, 2)], user_id, event_id)
+        db.session.execute(db.update(TicketHold).where(TicketHold.token == expired).values(expires_at=datetime.now() - timedelta(minutes=1)))
+        db.session.commit()
+
+        job, _ = remove_tier(db.session.get(Ticket, ticket_id))
+        db.session.commit()
+        assert job is not None
+
+        assert db.session.scalar(db.select(db.func.count()).select_from(TicketHold).where(TicketHold.ticket_id == ticket_id)) == 0
+        assert confirm_hold(live, user_id) is None
+        release_expired_holds()
+        assert _availability(ticket_id) == 0
+        assert hold_tickets([(db.session.get(Ticket, ticket_id), 1)], user_id, event_id) is None
+
+
+def test_holds_left_on_a_refunding_tier_are_dropped_not_restocked(app):
+    ticket_id, event_id, user_id = _tier_with_buyer(app)
+    with app.app_context():
+        remove_tier(db.session.get(Ticket, ticket_id))
+        db.session.commit()
+        # holds that slipped in around the job being queued
+        _hold(ticket_id, event_id, user_id, 'live', timedelta(minutes=5))
+        _hold(ticket_id, event_id, user_id, 'cancelled', timedelta(minutes=5))
+        _hold(ticket_id, event_id, user_id, 'expired', -timedelta(minutes=1))
+        db.session.commit()
+
+        assert confirm_hold('live', user_id) is None
+        assert cancel_hold('cancelled', user_id) == 0
+        release_expired_holds()
+        db.session.commit()
+
+        assert _availability(ticket_id) == 0
+        assert db.session.scalar(db.select(db.func.count()).select_from(TicketHold).where(TicketHold.ticket_id == ticket_id)) == 0
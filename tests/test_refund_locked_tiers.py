@@ -0,0 +1,60 @@
+from datetime import datetime
+
+from club95 import db
+from club95.models import Event, RefundJob, Ticket, User
+
+
+def _login(client):
+    client.post('/auth/login', data={'email': 'sample@club95.com', 'password': 'samplepassword'})
+
+
+def _event_with_refunding_tier(app):
+    # Two tiers on one of the sample user's events; a background refund is under way for the first.
+    with app.app_context():
+        owner = db.session.scalar(db.select(User).where(User.email == 'sample@club95.com'))
+        event = db.session.scalars(db.select(Event).where(Event.user_id == owner.id).order_by(Event.id)).first()
+        locked, other = Ticket(ticketTier='Locked', price=30.0, availability=0), Ticket(ticketTier='Other', price=10.0, availability=5)
+        event.tickets.extend([locked, other])
+        db.session.flush()
+        db.session.add(RefundJob(
+            event_id=event.id, ticket_id=locked.id, ticket_tier='Locked', status='RUNNING',
+            total_orders=500, processed_orders=100, refund_total=0.0, created_at=datetime.now(),
+        ))
+        db.session.commit()
+        return event.id, event.title, locked.id, other.id
+
+
+def test_refunding_tier_is_read_only_in_my_events(app, client):
+    _, _, locked_id, other_id = _event_with_refunding_tier(app)
+    _login(client)
+
+    page = client.get('/events/myevents').get_data(as_text=True)
+
+    row_id = 'name="ticket_row_id[]"\n' + ' ' * 76 + 'value="{}"'
+    assert row_id.format(other_id) in page
+    assert row_id.format(locked_id) not in page
+    assert 'This tier is being removed' in page
+
+
+def test_update_skips_a_tier_being_refunded(app, client):
+    event_id, title, locked_id, other_id = _event_with_refunding_tier(app)
+    _login(client)
+
+    # a page opened before the removal still posts the tier; saving it must not put it back on sale
+    client.post(f'/events/{event_id}/update', data={
+        'title': title,
+        'ticket_row_id[]': [str(locked_id), str(other_id)],
+        'ticket_row_name[]': ['Locked', 'Other'],
+        'ticket_row_price[]': ['99', '12'],
+        'ticket_row_quantity[]': ['50', '6'],
+        'ticket_row_perks[]': ['', ''],
+        'ticket_row_delete[]': ['0', '0'],
+    })
+
+    with app.app_context():
+        locked = db.session.get(Ticket, locked_id)
+        assert (locked.price, locked.availability) == (30.0, 0)
+        assert db.session.get(Ticket, other_id).price == 12.0
+        assert db.session.scalar(
+            db.select(db.func.count()).select_from(RefundJob).where(RefundJob.ticket_id == locked_id)
+        ) == 1
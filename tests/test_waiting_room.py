@@ -0,0 +1,53 @@
+from club95 import create_app, db
+from club95.models import Event, QueueGate
+
+
+def test_queue_is_shared_by_every_worker(app):
+    # two "workers" on the same database, no refills: only the burst gets straight in
+    config = dict(app.config, QUEUE_BURST=2, QUEUE_ADMISSIONS_PER_MINUTE=0)
+    workers = [create_app(config), create_app(config)]
+    with app.app_context():
+        event = db.session.scalars(db.select(Event).order_by(Event.id)).first()
+        event.queue_enabled = True
+        db.session.commit()
+        event_id = event.id
+
+    admitted, positions = 0, []
+    for visitor in range(6):
+        client = workers[visitor % 2].test_client()
+        response = client.get(f"/events/{event_id}/queue")
+        if response.status_code == 302:
+            admitted += 1
+            continue
+        positions.append(client.get(f"/events/{event_id}/queue/status").get_json()['position'])
+
+    assert admitted == 2
+    assert positions == [1, 2, 3, 4]
+    with app.app_context():
+        gate = db.session.get(QueueGate, event_id)
+        assert (gate.issued, gate.serving) == (6, 2)
+    for worker in workers:
+        with worker.app_context():
+            db.engine.dispose()
+
+
+def test_waiting_visitors_are_let_through_as_the_bucket_refills(app, client):
+    app.config.update(QUEUE_BURST=1, QUEUE_ADMISSIONS_PER_MINUTE=60)
+    with app.app_context():
+        event = db.session.scalars(db.select(Event).order_by(Event.id)).first()
+        event.queue_enabled = True
+        db.session.commit()
+        event_id = event.id
+
+    assert app.test_client().get(f"/events/{event_id}/queue").status_code == 302
+    assert client.get(f"/events/{event_id}/queue").status_code == 200
+    assert client.get(f"/events/{event_id}/queue/status").get_json()['position'] == 1
+
+    # a second later there is a token for the next visitor
+    with app.app_context():
+        gate = db.session.get(QueueGate, event_id)
+        gate.updated -= 1.5
+        db.session.commit()
+    status = client.get(f"/events/{event_id}/queue/status").get_json()
+    assert status['admitted'] is True
+    assert client.get(f"/events/eventdetails/{event_id}").status_code == 200